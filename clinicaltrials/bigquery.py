@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import concurrent.futures
+import gzip
+import io
+import shutil
 import string
-import subprocess
 import tempfile
 import time
 import uuid
@@ -15,6 +18,7 @@ PROJECT = 'ebmdatalab'
 BQ_LOCATION = 'EU'
 BQ_DEFAULT_TABLE_EXPIRATION_MS = None
 DATASET_NAME = 'clinicaltrials'
+DOWNLOAD_THREADS = 8
 
 class StorageClient(object):
     '''A dumb proxy for gcs.Client'''
@@ -89,10 +93,24 @@ class Client(object):
             table = self.get_table(table_name)
         return table
 
-    def create_storage_backed_table(self, table_name, schema, gcs_path):
+    def create_storage_backed_table(self, table_name, schema, gcs_path,
+                                    compression=None, source_format='CSV'):
+        """`gcs_path` may contain a `*` wildcard, to read several files.
+        Set `compression` to `GZIP` if they are gzipped.
+
+        CSV files have fields separated by `þ`; for a single-column
+        schema, that's one JSON document per row.  With `source_format`
+        of `NEWLINE_DELIMITED_JSON`, each line is instead a JSON object
+        with a key for each column.
+        """
         gcs_client = StorageClient()
         bucket = gcs_client.bucket()
-        if bucket.get_blob(gcs_path) is None:
+        if '*' in gcs_path:
+            prefix = gcs_path.split('*', 1)[0]
+            found = next(iter(bucket.list_blobs(prefix=prefix)), None)
+        else:
+            found = bucket.get_blob(gcs_path)
+        if found is None:
             raise RuntimeError('Could not find blob at {}'.format(gcs_path))
 
         gcs_uri = 'gs://{}/{}'.format(self.project_name, gcs_path)
@@ -100,14 +118,17 @@ class Client(object):
         resource = {
             'tableReference': {'tableId': table_name},
             'externalDataConfiguration': {
-                'sourceFormat': 'CSV',
+                'sourceFormat': source_format,
                 'sourceUris': [gcs_uri],
                 'schema': {'fields': schema},
-                'csvOptions': {
-                    'fieldDelimiter': 'þ',
-                }
             }
         }
+        if source_format == 'CSV':
+            resource['externalDataConfiguration']['csvOptions'] = {
+                'fieldDelimiter': 'þ',
+            }
+        if compression:
+            resource['externalDataConfiguration']['compression'] = compression
 
         path = '/projects/{}/datasets/{}/tables'.format(
             self.project_name,
@@ -131,6 +152,20 @@ class Client(object):
             )
         return self.get_table(table_name, gcs_client)
 
+    def create_table_from_query(self, table_name, sql, cluster_by=None,
+                                substitutions=None):
+        """Replace `table_name` with a native table holding the results of
+        `sql`, clustered by the `cluster_by` columns.
+        """
+        substitutions = substitutions or {}
+        ddl = 'CREATE OR REPLACE TABLE `{}.{}.{}`'.format(
+            self.project_name, self.dataset_name, table_name)
+        if cluster_by:
+            ddl += ' CLUSTER BY {}'.format(', '.join(cluster_by))
+        ddl += ' AS\n' + interpolate_sql(sql, **substitutions)
+        self.query(ddl)
+        return self.get_table(table_name)
+
     def create_table_with_view(self, table_name, sql, legacy):
         assert '{project}' in sql
         sql = interpolate_sql(sql, project=self.project_name)
@@ -146,13 +181,17 @@ class Client(object):
             table.create()
         return Table(table, self.project_name)
 
-    def query(self, sql, legacy=False, **options):
+    def _begin_query(self, sql, legacy, options):
         sql = interpolate_sql(sql)
         query = self.gcbq_client.run_sync_query(sql)
         set_options(query, options)
         query.use_legacy_sql = legacy
 
         query.run()
+        return query
+
+    def query(self, sql, legacy=False, **options):
+        query = self._begin_query(sql, legacy, options)
 
         # The call to .run() might return before results are actually ready.
         # See https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs/query#timeoutMs
@@ -184,8 +223,8 @@ class Table(object):
         for row in self.get_rows():
             yield row_to_dict(row, field_names)
 
-    def insert_rows_from_query(self, sql, substitutions=None, legacy=False,
-                               **options):
+    def _begin_insert_rows_from_query(self, sql, substitutions, legacy,
+                                      options):
         substitutions = substitutions or {}
         sql = interpolate_sql(sql, **substitutions)
         default_options = {
@@ -202,7 +241,12 @@ class Table(object):
         set_options(job, options, default_options)
 
         job.begin()
+        return job
 
+    def insert_rows_from_query(self, sql, substitutions=None, legacy=False,
+                               **options):
+        job = self._begin_insert_rows_from_query(
+            sql, substitutions, legacy, options)
         wait_for_job(job)
 
     def insert_rows_from_csv(self, csv_path, **options):
@@ -238,6 +282,12 @@ class Table(object):
 
         wait_for_job(job)
 
+    def delete(self):
+        self.gcbq_table.delete()
+
+    def exporter(self, storage_prefix):
+        return TableExporter(self, storage_prefix)
+
     def delete_all_rows(self, **options):
         sql = 'DELETE FROM {} WHERE true'.format(self.qualified_name)
 
@@ -256,37 +306,46 @@ class Table(object):
 
 class TableExporter(object):
     def __init__(self, table, storage_prefix):
+        """`table` is a `Table`, or (as it used to be) a raw `gcbq`
+        table, which is wrapped in one
+        """
+        if not isinstance(table, Table):
+            table = Table(table, PROJECT)
         self.table = table
         self.storage_prefix = storage_prefix
         storage_client = StorageClient()
         self.bucket = storage_client.bucket()
 
-    def export_to_storage(self, **options):
+    def _begin_export_to_storage(self, options):
         default_options = {
             'compression': 'GZIP',
         }
 
         destination_uri = 'gs://{}/{}*.csv.gz'.format(
-            self.table.project,
+            self.table.project_name,
             self.storage_prefix,
         )
         # can we get to a client from here
         client = gcbq.Client(project=PROJECT)
         job = client.extract_table_to_storage(
             options.pop('job_name', gen_job_name()),
-            self.table,
+            self.table.gcbq_table,
             destination_uri,
         )
 
         set_options(job, options, default_options)
 
         job.begin()
+        return job
 
-        wait_for_job(job)
+    def export_to_storage(self, **options):
+        wait_for_job(self._begin_export_to_storage(options))
 
     def storage_blobs(self):
-        for blob in self.bucket.list_blobs(prefix=self.storage_prefix):
-            yield blob
+        """The shards of the export, in the order they were written
+        """
+        blobs = self.bucket.list_blobs(prefix=self.storage_prefix)
+        return sorted(blobs, key=lambda blob: blob.name)
 
     def download_from_storage(self):
         for blob in self.storage_blobs():
@@ -296,44 +355,124 @@ class TableExporter(object):
                 f.seek(0)
                 yield f
 
+    def _download_blob(self, blob):
+        f = tempfile.TemporaryFile()
+        blob.download_to_file(f)
+        f.seek(0)
+        return f
+
     def download_from_storage_and_unzip(self, f_out):
-        for i, f_zipped in enumerate(self.download_from_storage()):
-            # Unzip
-            if i == 0:
-                cmd = "gunzip -c -f %s >> %s"
-            else:
-                # When the file is split into several shards in GCS, it
-                # puts a header on every file, so we have to skip that
-                # header on all except the first shard.
-                cmd = "gunzip -c -f %s | tail -n +2 >> %s"
-            subprocess.check_call(
-                cmd % (f_zipped.name, f_out.name), shell=True)
+        """Download and decompress every shard of an export, in order, to
+        the text file `f_out`.
+
+        Shards are downloaded concurrently, and decompressed in this
+        process as they are copied.  When the table is split into
+        several shards in GCS, it puts a header on every file, so we
+        skip that header on all except the first shard.
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+                DOWNLOAD_THREADS) as executor:
+            # `map` yields in the order the blobs were listed, while
+            # later ones download in the background
+            downloads = executor.map(self._download_blob, self.storage_blobs())
+            for i, f_zipped in enumerate(downloads):
+                with f_zipped, gzip.GzipFile(fileobj=f_zipped) as gz:
+                    lines = io.TextIOWrapper(gz, encoding='utf-8', newline='')
+                    if i > 0:
+                        lines.readline()
+                    shutil.copyfileobj(lines, f_out)
 
     def delete_from_storage(self):
         for blob in self.storage_blobs():
             blob.delete()
 
 
-def wait_for_job(job, timeout_s=3600):
+def get_client(dataset_key=None, backend='bigquery', **kwargs):
+    """Return a `Client` for the named backend: `bigquery`, or `sqlite`
+    for the embedded stand-in in `local_warehouse`, which takes `path`
+    and `storage_root` arguments.
+
+    Clients for every backend provide the same methods, and their
+    tables the same methods as `Table`, including `exporter()`.
+    """
+    if backend == 'bigquery':
+        return Client(dataset_key, **kwargs)
+    if backend == 'sqlite':
+        # Imported here, as it imports this module
+        import local_warehouse
+        return local_warehouse.Client(dataset_key, **kwargs)
+    raise ValueError("Unknown warehouse backend {}".format(backend))
+
+
+def poll_intervals(initial_s=0.5, maximum_s=10, factor=1.5):
+    """Yield the time to sleep before each poll of a running job.
+
+    Short queries finish within a second or two, so we start by polling
+    often; long ones are polled less and less often, up to `maximum_s`.
+    """
+    interval = initial_s
+    while True:
+        yield interval
+        interval = min(interval * factor, maximum_s)
+
+
+def _check_timeout(jobs, t0, timeout_s):
+    if time.time() - t0 > timeout_s:
+        msg = 'Timeout waiting for job {} after {} second'.format(
+            ', '.join(job.name for job in jobs), timeout_s
+        )
+        raise TimeoutError(msg)
+
+
+def _check_errors(jobs):
+    for job in jobs:
+        if job.errors is not None:
+            raise JobError(job.errors)
+
+
+def _unfinished_job_names(client):
+    names = set()
+    for state in ['pending', 'running']:
+        names.update(job.name for job in client.list_jobs(state_filter=state))
+    return names
+
+
+def wait_for_jobs(jobs, timeout_s=3600):
+    """Wait for all of `jobs` to finish, raising `JobError` if any of them
+    failed.
+
+    Each round lists the project's unfinished jobs, rather than reloading
+    every job we are waiting for, and only the jobs which have dropped out
+    of that list are reloaded.  Listing takes two requests, so a lone job
+    is just reloaded.
+    """
     t0 = time.time()
+    pending = list(jobs)
+    intervals = poll_intervals()
 
     # Would like to use `while not job.done():` but cannot until we upgrade
     # version of g.c.bq.
     while True:
-        job.reload()
-        if job.state == 'DONE':
+        if len(pending) > 1:
+            unfinished = _unfinished_job_names(pending[0]._client)
+            finished = [job for job in pending if job.name not in unfinished]
+        else:
+            finished = pending
+        for job in finished:
+            job.reload()
+        pending = [job for job in pending if job.state != 'DONE']
+        if not pending:
             break
 
-        if time.time() - t0 > timeout_s:
-            msg = 'Timeout waiting for job {} after {} second'.format(
-                job.name, timeout_s
-            )
-            raise TimeoutError(msg)
+        _check_timeout(pending, t0, timeout_s)
+
+        time.sleep(next(intervals))
 
-        time.sleep(1)
+    _check_errors(jobs)
 
-    if job.errors is not None:
-        raise JobError(job.errors)
+
+def wait_for_job(job, timeout_s=3600):
+    wait_for_jobs([job], timeout_s=timeout_s)
 
 
 class TimeoutError(Exception):
@@ -0,0 +1,78 @@
+"""A persistent record of the JSON each study was converted to.
+
+Most of the registry is byte-for-byte identical from one day to the
+next, so we keep a SHA-1 of each study's XML alongside the line of JSON
+it produced, and reuse that line whenever the XML hasn't changed.
+
+The manifest is a SQLite database, so that the processes converting
+different chunks of the registry can share it.
+
+"""
+import hashlib
+import sqlite3
+
+
+def digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+class ConversionManifest(object):
+    def __init__(self, path, converter):
+        """Open (creating if necessary) the manifest at `path`, for JSON
+        produced by the named `converter`
+        """
+        self.converter = converter
+        self.pending = []
+        # Other workers may be writing; wait for them rather than fail
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS studies ("
+            " name TEXT PRIMARY KEY,"
+            " digest TEXT NOT NULL,"
+            " converter TEXT NOT NULL,"
+            " json TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, name, content_digest):
+        """Return the JSON previously produced for `name`, if its XML had
+        the same digest and was converted the same way, else None
+        """
+        row = self.conn.execute(
+            "SELECT json FROM studies "
+            "WHERE name = ? AND digest = ? AND converter = ?",
+            (name, content_digest, self.converter)).fetchone()
+        return row and row[0]
+
+    def put(self, name, content_digest, json):
+        """Record the JSON produced for `name`. Nothing is written until
+        `save()` is called.
+        """
+        self.pending.append((name, content_digest, self.converter, json))
+
+    def save(self):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO studies "
+                "(name, digest, converter, json) VALUES (?, ?, ?, ?)",
+                self.pending)
+        self.pending = []
+
+    def prune(self, names):
+        """Forget every study not in `names`, i.e. those no longer in the
+        registry
+        """
+        with self.conn:
+            self.conn.execute(
+                "CREATE TEMP TABLE current_names (name TEXT PRIMARY KEY)")
+            self.conn.executemany(
+                "INSERT INTO current_names VALUES (?)",
+                ((name,) for name in names))
+            deleted = self.conn.execute(
+                "DELETE FROM studies "
+                "WHERE name NOT IN (SELECT name FROM current_names)").rowcount
+            self.conn.execute("DROP TABLE current_names")
+        return deleted
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,187 @@
+"""Conditional, resumable download of the registry zip.
+
+The zip is large and slow to fetch, and doesn't change every day.  We
+keep the last complete download along with its ETag and Last-Modified
+headers, and only fetch it again when the server says it has changed.
+An interrupted download is kept as a partial file, which is resumed
+with an HTTP Range request (guarded with If-Range, so we start again
+if the file changed in the meantime).
+
+"""
+import json
+import logging
+import os
+import time
+import zipfile
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+DOWNLOADED = 'downloaded'
+UNCHANGED = 'unchanged'
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+class IncompleteDownload(Exception):
+    """The connection was closed before we received the whole file; the
+    partial download is kept so it can be resumed.
+    """
+    pass
+
+
+def _meta_path(target):
+    return target + '.meta.json'
+
+
+def _partial_path(target):
+    return target + '.partial'
+
+
+def _read_meta(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(path, meta):
+    with open(path, 'w') as f:
+        json.dump(meta, f)
+
+
+def _validators(response):
+    return {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+
+
+def _expected_size(response, offset):
+    """The total size of the file being downloaded, if the server told
+    us.
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total != '*':
+            return int(total)
+    length = response.headers.get('Content-Length')
+    if length is not None:
+        return int(length) + offset
+    return None
+
+
+def check_zip(path, expected_size=None):
+    """Raise `DownloadError` unless `path` is a complete zip file.
+
+    Member CRCs are checked later, as each member is read.
+    """
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise DownloadError(
+            "Expected {} bytes but got {}".format(expected_size, size))
+    try:
+        with zipfile.ZipFile(path) as z:
+            z.infolist()
+    except zipfile.BadZipFile as e:
+        raise DownloadError("{} is not a valid zip: {}".format(path, e))
+
+
+def _fetch_once(url, target, timeout):
+    """Make a single attempt at downloading `url` to `target`, resuming
+    any partial download.  Returns `DOWNLOADED` or `UNCHANGED`.
+    """
+    partial = _partial_path(target)
+    partial_meta_path = _meta_path(partial)
+    headers = {}
+    offset = 0
+    partial_meta = _read_meta(partial_meta_path)
+    if os.path.exists(partial) and partial_meta:
+        offset = os.path.getsize(partial)
+        validator = partial_meta.get('etag') or partial_meta.get('last_modified')
+        if offset and validator:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+    elif os.path.exists(target):
+        meta = _read_meta(_meta_path(target))
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with requests.get(url, headers=headers, stream=True,
+                      timeout=timeout) as response:
+        if response.status_code == 304:
+            return UNCHANGED
+        if response.status_code == 416:
+            # Our partial file is no use to the server; start again
+            os.remove(partial)
+            raise IncompleteDownload("Range not satisfiable")
+        if response.status_code == 206:
+            logger.info("Resuming download of %s from byte %s", url, offset)
+            mode = 'ab'
+        elif response.status_code == 200:
+            logger.info(
+                "Downloading %s. This takes at least 30 mins on a fast "
+                "connection!", url)
+            offset = 0
+            mode = 'wb'
+        else:
+            raise DownloadError("Unexpected response {} for {}".format(
+                response.status_code, url))
+        expected_size = _expected_size(response, offset)
+        if mode == 'wb':
+            _write_meta(partial_meta_path, _validators(response))
+        with open(partial, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+    size = os.path.getsize(partial)
+    if expected_size is not None and size < expected_size:
+        raise IncompleteDownload(
+            "Got {} of {} bytes".format(size, expected_size))
+    try:
+        check_zip(partial, expected_size)
+    except DownloadError:
+        os.remove(partial)
+        os.remove(partial_meta_path)
+        raise
+    os.replace(partial, target)
+    os.replace(partial_meta_path, _meta_path(target))
+    return DOWNLOADED
+
+
+def fetch(url, target, retries=5, timeout=60, backoff=5):
+    """Download `url` to `target` unless it hasn't changed since the
+    last download.
+
+    Returns `UNCHANGED` if the server says our copy is current, and
+    `DOWNLOADED` once a new copy has been downloaded and checked.
+    Dropped connections are retried (resuming where they left off) up
+    to `retries` times.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _fetch_once(url, target, timeout)
+        except (requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                IncompleteDownload) as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            wait = backoff * 2 ** (attempt - 1)
+            logger.warn(
+                "Download of %s failed (%s); retrying in %ss", url, e, wait)
+            time.sleep(wait)
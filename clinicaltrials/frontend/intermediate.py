@@ -0,0 +1,100 @@
+"""The typed file which `load_data` hands to `process_data`.
+
+`load_data` produces a CSV of ACTs and pACTs (`INTERMEDIATE_CSV_PATH`),
+which is easy for people to read, and which `process_data --input-csv`
+still accepts.  Next to it we write the same rows as an Arrow IPC file
+(`INTERMEDIATE_ARROW_PATH`), whose schema says which columns are flags
+and which are dates.  The CSV is parsed once, by Arrow's CSV reader,
+and `process_data` memory-maps the result and reads booleans and dates
+from it directly, without converting each cell itself.
+
+"""
+import csv
+
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+from frontend.local_view import COLUMNS
+
+
+# Columns holding 1 or 0 (or, for `is_fda_regulated`, true or false)
+FLAG_COLUMNS = (
+    'act_flag',
+    'included_pact_flag',
+    'has_results',
+    'pending_results',
+    'has_certificate',
+    'results_due',
+    'used_primary_completion_date',
+    'defaulted_pcd_flag',
+    'defaulted_cd_flag',
+    'is_fda_regulated',
+    'discrep_date_status',
+    'late_cert',
+    'defaulted_date',
+)
+
+DATE_COLUMNS = (
+    'start_date',
+    'available_completion_date',
+    'results_submitted_date',
+    'last_updated_date',
+    'certificate_date',
+)
+
+# Every other column is a string
+SCHEMA = pa.schema([
+    pa.field(name, pa.bool_() if name in FLAG_COLUMNS
+             else pa.date32() if name in DATE_COLUMNS
+             else pa.string())
+    for name in COLUMNS])
+
+# How to read each column from the CSV.  The CSV reader in the version
+# of pyarrow we use can't parse dates, only timestamps, so date columns
+# are read as timestamps then cast to dates
+COLUMN_TYPES = dict(
+    (field.name, pa.timestamp('s') if field.name in DATE_COLUMNS
+     else field.type)
+    for field in SCHEMA)
+
+
+def csv_to_arrow(csv_path, arrow_path):
+    """Convert the CSV at `csv_path` to an Arrow IPC file at `arrow_path`,
+    returning the number of rows.
+    """
+    with open(csv_path, newline='') as f:
+        header = next(csv.reader(f))
+    # Left to itself, Arrow would guess the type of any other column
+    # from its values, so it might differ from one file to the next
+    column_types = dict((name, pa.string()) for name in header)
+    column_types.update(COLUMN_TYPES)
+    table = pa_csv.read_csv(
+        csv_path,
+        # JSON columns can contain newlines
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types))
+    table = table.cast(pa.schema([
+        pa.field(field.name, pa.date32()) if field.name in DATE_COLUMNS
+        else field
+        for field in table.schema]))
+    with pa.OSFile(arrow_path, 'wb') as sink:
+        writer = pa.RecordBatchFileWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+    return table.num_rows
+
+
+def read_rows(arrow_path):
+    """Yield each row of the Arrow IPC file at `arrow_path` as a dict,
+    one record batch at a time.  Empty flags are False, as `Trial`'s
+    boolean fields can't be null.
+    """
+    with pa.memory_map(arrow_path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            columns = reader.get_batch(i).to_pydict()
+            for name in FLAG_COLUMNS:
+                if name in columns:
+                    columns[name] = [bool(value) for value in columns[name]]
+            for values in zip(*columns.values()):
+                yield dict(zip(columns, values))
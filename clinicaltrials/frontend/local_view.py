@@ -0,0 +1,295 @@
+"""A local implementation of `view.sql`.
+
+Reads the study records produced by `load_data`, applies the same
+rules as `view.sql` to identify ACTs and pACTs and work out whether
+their results are due, and writes the same CSV that we would otherwise
+export from BigQuery.  This lets the whole import run on one machine,
+without uploading the registry to Cloud Storage and waiting for a
+query job and an export.
+
+Each rule below mirrors the SQL it replaces, including its handling of
+NULLs: a comparison involving a missing value is never true.
+
+"""
+import csv
+import datetime
+import gzip
+import re
+
+from frontend import study_record
+from frontend.study_record import add_months
+
+
+# Columns of the CSV, in the order `view.sql` selects them
+COLUMNS = (
+    'nct_id',
+    'act_flag',
+    'included_pact_flag',
+    'has_results',
+    'pending_results',
+    'pending_data',
+    'has_certificate',
+    'results_due',
+    'start_date',
+    'available_completion_date',
+    'used_primary_completion_date',
+    'defaulted_pcd_flag',
+    'defaulted_cd_flag',
+    'results_submitted_date',
+    'last_updated_date',
+    'certificate_date',
+    'phase',
+    'enrollment',
+    'location',
+    'study_status',
+    'study_type',
+    'primary_purpose',
+    'sponsor',
+    'sponsor_type',
+    'collaborators',
+    'exported',
+    'fda_reg_drug',
+    'fda_reg_device',
+    'is_fda_regulated',
+    'url',
+    'title',
+    'official_title',
+    'brief_title',
+    'discrep_date_status',
+    'late_cert',
+    'defaulted_date',
+    'condition',
+    'condition_mesh',
+    'intervention',
+    'intervention_mesh',
+    'keywords',
+)
+
+# The date FDAAA 2007's Final Rule came into effect
+EFFECTIVE_DATE = datetime.date(2017, 1, 18)
+
+ACT_PHASES = (
+    'Phase 1/Phase 2',
+    'Phase 2',
+    'Phase 2/Phase 3',
+    'Phase 3',
+    'Phase 4',
+    'N/A',
+)
+
+# Intervention types which make a trial a probable ACT
+PACT_INTERVENTION_TYPES = (
+    'Biological',
+    'Drug',
+    'Device',
+    'Genetic',
+    'Radiation',
+    'Combination Product',
+    'Diagnostic Test',
+)
+
+# These are regular expressions in `view.sql`, hence the unescaped
+# brackets and dots in the last one
+US_LOCATION_RES = [
+    re.compile(r"\b" + place + r"\b") for place in (
+        "United States",
+        "American Samoa",
+        "Guam",
+        "Northern Mariana Islands",
+        "Puerto Rico",
+        "Virgin Islands (U.S.)",
+    )
+]
+
+ONGOING_STATUSES = (
+    'Not yet recruiting',
+    'Active, not recruiting',
+    'Recruiting',
+    'Enrolling by invitation',
+    'Unknown status',
+    'Available',
+    'Suspended',
+)
+
+def to_csv_value(value):
+    """Format a value as BigQuery does when exporting CSV.
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    return str(value)
+
+
+def read_fda_regulation_snapshot(path):
+    """Read the `is_fda_regulated` field as it stood in January 2017, from
+    a CSV with `nct_id` and `is_fda_regulated` columns.
+
+    This is the local counterpart of the
+    `jan17_fda_regulation_snapshot` table in BigQuery.
+    """
+    snapshot = {}
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            value = row['is_fda_regulated'].lower()
+            if value:
+                snapshot[row['nct_id']] = value == 'true'
+    return snapshot
+
+
+def classify(study, is_fda_regulated, today):
+    """Return the `view.sql` row for a converted study, as a dict, or
+    None if it is neither an ACT nor a pACT.
+    """
+    return classify_record(
+        study_record.flatten(study), is_fda_regulated, today)
+
+
+def classify_record(record, is_fda_regulated, today):
+    """Return the `view.sql` row for a study's record (as made by
+    `study_record.flatten()`), as a dict, or None if it is neither an
+    ACT nor a pACT.
+
+    `is_fda_regulated` is the study's entry in the January 2017
+    snapshot (True, False or None), and `today` is the date which
+    `CURRENT_DATE()` would return.
+    """
+    study_type = record['study_type']
+    study_status = record['study_status']
+    phase = record['phase']
+    intervention = record['intervention']
+    primary_purpose = record['primary_purpose']
+    fda_reg_drug = record['fda_reg_drug']
+    fda_reg_device = record['fda_reg_device']
+    location = record['location']
+    start_date = record['start_date']
+    primary_completion_date = record['primary_completion_date']
+    completion_date = record['completion_date']
+    available_completion_date = record['available_completion_date']
+    certificate_date = record['certificate_date']
+
+    common = (
+        study_type == 'Interventional'
+        and phase in ACT_PHASES
+        and primary_purpose != 'Device Feasibility'
+        and study_status is not None
+        and study_status != 'Withdrawn')
+    fda_regulated = fda_reg_drug == 'Yes' or fda_reg_device == 'Yes'
+    started_before = start_date is not None and start_date < EFFECTIVE_DATE
+    completed_after = available_completion_date is not None \
+        and available_completion_date >= EFFECTIVE_DATE
+
+    is_act = common and fda_regulated \
+        and start_date is not None and start_date >= EFFECTIVE_DATE
+    # A trial which started before the rule came into force, which
+    # hasn't filled in the new regulation fields (see #92)
+    is_legacy_pact = (
+        common
+        and intervention is not None
+        and any('"{}"'.format(t) in intervention
+                for t in PACT_INTERVENTION_TYPES)
+        and completed_after
+        and started_before
+        and is_fda_regulated is not False
+        and fda_reg_drug is None
+        and fda_reg_device is None
+        and location is not None
+        and any(r.search(location) for r in US_LOCATION_RES))
+    is_pact = common and fda_regulated and started_before and completed_after
+    if not (is_act or is_legacy_pact or is_pact):
+        return None
+
+    results_due = False
+    if available_completion_date is not None:
+        one_year = add_months(available_completion_date, 12)
+        three_years = add_months(available_completion_date, 36)
+        deadline_passed = one_year + datetime.timedelta(days=30) < today
+        results_due = deadline_passed and (
+            certificate_date is None
+            or three_years + datetime.timedelta(days=30) < today)
+    late_cert = certificate_date is not None \
+        and available_completion_date is not None \
+        and certificate_date > add_months(available_completion_date, 12)
+    discrep_date_status = (
+        (primary_completion_date is None or primary_completion_date < today)
+        and completion_date is not None and completion_date < today
+        and study_status in ONGOING_STATUSES)
+    if record['used_primary_completion_date']:
+        defaulted_date = record['defaulted_pcd_flag']
+    else:
+        defaulted_date = record['defaulted_cd_flag']
+
+    return {
+        'nct_id': record['nct_id'],
+        'act_flag': int(is_act),
+        'included_pact_flag': int(is_legacy_pact or is_pact),
+        'has_results': record['has_results'],
+        'pending_results': record['pending_results'],
+        'pending_data': record['pending_data'],
+        'has_certificate': int(certificate_date is not None),
+        'results_due': int(results_due),
+        'start_date': start_date,
+        'available_completion_date': available_completion_date,
+        'used_primary_completion_date': record['used_primary_completion_date'],
+        'defaulted_pcd_flag': record['defaulted_pcd_flag'],
+        'defaulted_cd_flag': record['defaulted_cd_flag'],
+        'results_submitted_date': record['results_submitted_date'],
+        'last_updated_date': record['last_updated_date'],
+        'certificate_date': certificate_date,
+        'phase': phase,
+        'enrollment': record['enrollment'],
+        'location': location,
+        'study_status': study_status,
+        'study_type': study_type,
+        'primary_purpose': primary_purpose,
+        'sponsor': record['sponsor'],
+        'sponsor_type': record['sponsor_type'],
+        'collaborators': record['collaborators'],
+        'exported': record['exported'],
+        'fda_reg_drug': fda_reg_drug,
+        'fda_reg_device': fda_reg_device,
+        'is_fda_regulated': is_fda_regulated,
+        'url': record['url'],
+        'title': record['title'],
+        'official_title': record['official_title'],
+        'brief_title': record['brief_title'],
+        'discrep_date_status': int(discrep_date_status),
+        'late_cert': int(late_cert),
+        'defaulted_date': defaulted_date,
+        'condition': record['condition'],
+        'condition_mesh': record['condition_mesh'],
+        'intervention': intervention,
+        'intervention_mesh': record['intervention_mesh'],
+        'keywords': record['keywords'],
+    }
+
+
+def read_records(json_paths):
+    """Yield each study's record from files written by `load_data`,
+    which may be gzipped
+    """
+    for path in json_paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            for line in f:
+                yield study_record.from_line(line)
+
+
+def write_csv(json_paths, csv_path, snapshot, today):
+    """Classify every study in the JSON lines files at `json_paths`,
+    writing the ACTs and pACTs to `csv_path`.  Returns the number of
+    rows written.
+    """
+    written = 0
+    with open(csv_path, 'w', newline='') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(COLUMNS)
+        for record in read_records(json_paths):
+            row = classify_record(
+                record, snapshot.get(record['nct_id']), today)
+            if row is not None:
+                writer.writerow([to_csv_value(row[c]) for c in COLUMNS])
+                written += 1
+    return written
@@ -3,35 +3,112 @@ import logging
 import sys
 import traceback
 
-from bigquery import Client
 from bigquery import StorageClient
-from bigquery import TableExporter
-from bigquery import wait_for_job
+from bigquery import get_client
 from bigquery import gen_job_name
 import xmltodict
 import os
 import subprocess
-import json
-import glob
 import datetime
-import tempfile
 import shutil
 import requests
 import contextlib
+import concurrent.futures
+import glob
+import gzip
+import queue
 import re
+import threading
+import zipfile
 from google.cloud.exceptions import NotFound
 from xml.parsers.expat import ExpatError
 
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.conf import settings
 
+from frontend import downloader
+from frontend import intermediate
+from frontend import local_view
+from frontend import study_record
+from frontend.run_report import RunReport
+from frontend.stage_runner import Stage
+from frontend.stage_runner import StageRunner
+from frontend.conversion_manifest import ConversionManifest
+from frontend.conversion_manifest import digest
+from frontend.snapshot_archive import SnapshotArchive
+from frontend.study_converter import ConversionError
+from frontend.study_converter import study_to_dict
+
 
 logger = logging.getLogger(__name__)
 
+# Study records inside AllPublicXML.zip, e.g. `NCT0000xxxx/NCT00000102.xml`
+STUDY_MEMBER_RE = re.compile(r"NCT[^/]*/[^/]+\.xml$")
+
+
+# Chunk size for resumable uploads; must be a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_THREADS = 8
+# How many converted shards may wait for an uploader before we stop
+# converting more
+UPLOAD_QUEUE_SIZE = 4
+# How long to keep JSON uploaded by earlier runs; the snapshot archive
+# is the place to go further back
+UPLOAD_RETENTION_DAYS = 30
+
+UPLOAD_DATE_RE = re.compile(r"raw_clincialtrials_json_(\d{4}-\d{2}-\d{2})")
+
+
+def raw_json_date_path():
+    return os.path.join(settings.WORKING_DIR, 'raw_json_date')
+
+
+def raw_json_date():
+    """The day the registry in `WORKING_DIR` was converted, as ISO 8601.
+
+    The JSON is named after that day rather than today, so that while
+    the registry is unchanged it keeps the same name, and the stages
+    which use it aren't run again the next day.
+    """
+    try:
+        with open(raw_json_date_path()) as f:
+            return f.read().strip()
+    except OSError:
+        return datetime.date.today().isoformat()
+
+
+def start_raw_json():
+    """Date the JSON we're about to convert today
+    """
+    with open(raw_json_date_path(), 'w') as f:
+        f.write(datetime.date.today().isoformat())
+
 
 def raw_json_name():
-    date = datetime.datetime.now().strftime('%Y-%m-%d')
-    return "raw_clincialtrials_json_{}.csv".format(date)
+    return "raw_clincialtrials_json_{}.csv".format(raw_json_date())
+
+
+def raw_json_shard_name(i):
+    return "{}-{:04d}.gz".format(raw_json_name(), i)
+
+
+def raw_json_paths():
+    """The JSON produced by `convert_to_json()`: either gzipped shards,
+    or a single uncompressed file.
+    """
+    shards = sorted(glob.glob(os.path.join(
+        glob.escape(settings.WORKING_DIR), raw_json_name() + '-*.gz')))
+    return shards or [os.path.join(settings.WORKING_DIR, raw_json_name())]
+
+
+def raw_json_storage_path():
+    """Where `upload_to_cloud()` puts the JSON: a wildcard for shards.
+    """
+    if raw_json_paths()[0].endswith('.gz'):
+        return os.path.join(
+            settings.STORAGE_PREFIX, raw_json_name() + '-*.gz')
+    return os.path.join(settings.STORAGE_PREFIX, raw_json_name())
 
 
 def postprocessor(path, key, value):
@@ -45,44 +122,102 @@ def postprocessor(path, key, value):
     return key, value
 
 
-def wget_file(target, url):
-    subprocess.check_call(["wget", "-q", "-O", target, url])
+def xmltodict_study_to_dict(content):
+    """Convert the whole of a study's XML to a dict
+    """
+    return xmltodict.parse(
+        content,
+        item_depth=0,
+        postprocessor=postprocessor)
+
+
+# `iterparse` only keeps the fields used by view.sql; `xmltodict`
+# keeps the whole study, which is slower but handy for ad-hoc queries
+CONVERTERS = {
+    'iterparse': study_to_dict,
+    'xmltodict': xmltodict_study_to_dict,
+}
 
 
-def download_and_extract():
-    """Clean up from past runs, then download into a temp location and move the
-    result into place.
+def registry_zip_path():
+    """Location of the last complete download of the registry.
+
+    This lives outside `WORKING_DIR`, which is cleared on each run, so
+    that we can tell whether the registry has changed since.
     """
-    logger.info("Downloading. This takes at least 30 mins on a fast connection!")
-    url = 'https://clinicaltrials.gov/AllPublicXML.zip'
+    return os.path.join(settings.WORKING_VOLUME, 'AllPublicXML.zip')
 
-    # download and extract
-    container = tempfile.mkdtemp(
-        prefix=settings.STORAGE_PREFIX.rstrip(os.sep), dir=settings.WORKING_VOLUME)
-    try:
-        data_file = os.path.join(container, "data.zip")
-        wget_file(data_file, url)
-        # Can't "wget|unzip" in a pipe because zipfiles have index at end of file.
+
+def download_and_extract(force=False):
+    """Download the registry if it has changed since the last run, then
+    clean up from past runs.
+
+    Returns False, having done nothing else, if the registry is
+    unchanged (unless `force` is set).  Studies are streamed straight
+    out of the zip by `convert_to_json()`, so nothing is extracted.
+    """
+    logger.info("Checking whether the registry has changed")
+    result = downloader.fetch(settings.REGISTRY_URL, registry_zip_path())
+    if result == downloader.UNCHANGED:
+        logger.info("Registry unchanged since the last download")
+        if not force:
+            return False
+    for path in (settings.INTERMEDIATE_CSV_PATH,
+                 settings.INTERMEDIATE_ARROW_PATH):
         with contextlib.suppress(OSError):
-            shutil.rmtree(settings.WORKING_DIR)
-        subprocess.check_call(["unzip", "-q", "-o", "-d", settings.WORKING_DIR, data_file])
-    finally:
-        shutil.rmtree(container)
+            os.remove(path)
+    with contextlib.suppress(OSError):
+        shutil.rmtree(settings.WORKING_DIR)
+    os.makedirs(settings.WORKING_DIR)
+    return True
 
 
-def upload_to_cloud():
-    # XXX we should periodically delete old ones of these
-    logger.info("Uploading to cloud")
-    client = StorageClient()
-    bucket = client.get_bucket()
+def upload_shard(path):
+    """Upload one file of JSON, with a resumable upload session, so
+    that a failed chunk is retried rather than the whole file.
+    """
+    bucket = StorageClient().get_bucket()
     blob = bucket.blob(
-        "{}{}".format(settings.STORAGE_PREFIX, raw_json_name()),
-        chunk_size=1024*1024
+        "{}{}".format(settings.STORAGE_PREFIX, os.path.basename(path)),
+        chunk_size=UPLOAD_CHUNK_SIZE
     )
-    with open(os.path.join(settings.WORKING_DIR, raw_json_name()), 'rb') as f:
+    with open(path, 'rb') as f:
         blob.upload_from_file(f)
 
 
+def delete_uploaded_shards():
+    """Remove shards left by an earlier run today, which would otherwise
+    match our wildcard
+    """
+    bucket = StorageClient().get_bucket()
+    for blob in bucket.list_blobs(
+            prefix=settings.STORAGE_PREFIX + raw_json_name() + '-'):
+        blob.delete()
+
+
+def delete_old_uploads():
+    """Remove JSON uploaded more than `UPLOAD_RETENTION_DAYS` days ago
+    """
+    cutoff = (datetime.date.today() -
+              datetime.timedelta(days=UPLOAD_RETENTION_DAYS)).isoformat()
+    bucket = StorageClient().get_bucket()
+    for blob in bucket.list_blobs(
+            prefix=settings.STORAGE_PREFIX + 'raw_clincialtrials_json_'):
+        match = UPLOAD_DATE_RE.search(blob.name)
+        if match and match.group(1) < cutoff:
+            blob.delete()
+
+
+def upload_to_cloud():
+    logger.info("Uploading to cloud")
+    delete_old_uploads()
+    paths = raw_json_paths()
+    if len(paths) > 1 or paths[0].endswith('.gz'):
+        delete_uploaded_shards()
+    with concurrent.futures.ThreadPoolExecutor(UPLOAD_THREADS) as executor:
+        list(executor.map(upload_shard, paths))
+
+
 def notify_slack(message):
     """Posts the message to #general
     """
@@ -100,75 +235,376 @@ def notify_slack(message):
         )
 
 
-def convert_to_json():
-    logger.info("Converting to JSON...")
-    dpath = os.path.join(settings.WORKING_DIR, 'NCT*/')
-    files = [x for x in sorted(glob.glob(dpath + '*.xml'))]
+def list_studies():
+    """Return the sorted names of every study in the registry zip.
+    """
+    with zipfile.ZipFile(registry_zip_path()) as z:
+        return sorted(
+            name for name in z.namelist() if STUDY_MEMBER_RE.match(name))
+
+
+def iter_studies(names):
+    """Yield `(name, xml_bytes)` for each of the named studies, reading
+    them directly from the registry zip.
+    """
+    with zipfile.ZipFile(registry_zip_path()) as z:
+        for name in names:
+            yield name, z.read(name)
+
+
+def archive_path():
+    """Location of the snapshot archive, which lives outside
+    `WORKING_DIR` so it survives from one run to the next.
+    """
+    return os.path.join(settings.WORKING_VOLUME, 'snapshot_archive.sqlite')
+
+
+def archive_snapshot():
+    """Record today's registry in the snapshot archive
+    """
+    archive = SnapshotArchive(archive_path())
+    names = list_studies()
+    studies = (
+        # `NCT0000xxxx/NCT00000102.xml` -> `NCT00000102`
+        (os.path.splitext(os.path.basename(name))[0], content)
+        for name, content in iter_studies(names))
+    changed = archive.add_snapshot(datetime.date.today().isoformat(), studies)
+    archive.close()
+    logger.info("Archived %s studies, %s changed since the last snapshot",
+                len(names), changed)
+    return {'studies': len(names), 'changed': changed}
+
+
+def manifest_path():
+    """Location of the conversion manifest, which lives outside
+    `WORKING_DIR` so it survives from one run to the next.
+    """
+    return os.path.join(settings.WORKING_VOLUME, 'conversion_manifest.sqlite')
+
+
+def manifest_key(converter):
+    """What the manifest records the lines it holds were made by
+    """
+    return '{}/record-v{}'.format(converter, study_record.RECORD_VERSION)
+
+
+def convert_studies(names, target, converter='iterparse', use_manifest=True):
+    """Convert the named studies to their records (see `study_record`),
+    writing one line of JSON per study to `target`, in the order
+    given.  `target` is gzipped if its name ends with `.gz`.
+
+    With `use_manifest`, studies whose XML is unchanged since they were
+    last converted are not parsed again; the JSON they produced last
+    time is reused.
+    """
+    to_dict = CONVERTERS[converter]
+    manifest = None
+    if use_manifest:
+        manifest = ConversionManifest(manifest_path(), manifest_key(converter))
     start = datetime.datetime.now()
-    completed = 0
-    with open(os.path.join(settings.WORKING_DIR, raw_json_name()), 'w') as f2:
-        for source in files:
-            logger.info("Converting %s", source)
-            with open(source, 'rb') as f:
+    completed = reused = 0
+    opener = gzip.open if target.endswith('.gz') else open
+    with opener(target, 'wt') as f2:
+        for source, content in iter_studies(names):
+            content_digest = digest(content)
+            line = manifest and manifest.get(source, content_digest)
+            if line:
+                reused += 1
+            else:
+                logger.info("Converting %s", source)
                 try:
-                    f2.write(
-                        json.dumps(
-                            xmltodict.parse(
-                                f,
-                                item_depth=0,
-                                postprocessor=postprocessor)
-                        ) + "\n")
-                except ExpatError:
+                    line = study_record.to_line(to_dict(content))
+                except (ExpatError, ConversionError):
                     logger.warn("Unable to parse %s", source)
+                else:
+                    if manifest:
+                        manifest.put(source, content_digest, line)
+            if line:
+                f2.write(line + "\n")
+
+            completed += 1
+            if completed % 100 == 0:
+                elapsed = datetime.datetime.now() - start
+                per_file = elapsed.total_seconds() / completed
+                remaining = int(per_file * (len(names) - completed) / 60.0)
+                logger.info("%s minutes remaining", remaining)
+    if manifest:
+        manifest.save()
+        manifest.close()
+    logger.info(
+        "Converted %s studies, reused %s unchanged ones",
+        completed - reused, reused)
+    return completed
+
+
+def split_into_chunks(items, count):
+    """Split `items` into at most `count` contiguous, roughly equal
+    chunks, preserving order.
+    """
+    size, extra = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def convert_to_json(workers=1, converter='iterparse', use_manifest=True,
+                    shards=None):
+    """Convert every study to a single file of JSON lines, or, given a
+    number of `shards`, to that many gzipped files.
+
+    With more than one worker, the sorted study list is split into
+    contiguous chunks which are converted in parallel processes, each
+    to its own shard; unless we want shards, these are then
+    concatenated in order, so the output is identical to a
+    single-process run.  Returns the number of studies.
+    """
+    logger.info("Converting to JSON...")
+    start_raw_json()
+    files = list_studies()
+    target = os.path.join(settings.WORKING_DIR, raw_json_name())
+    if shards:
+        _convert_to_shards(files, shards, workers, converter, use_manifest)
+    elif workers <= 1:
+        convert_studies(files, target, converter, use_manifest)
+    else:
+        _convert_in_parallel(
+            files, target, workers, converter, use_manifest)
+    if use_manifest:
+        prune_manifest(files, converter)
+    return len(files)
+
+
+def prune_manifest(files, converter):
+    manifest = ConversionManifest(manifest_path(), manifest_key(converter))
+    logger.info(
+        "Removed %s withdrawn studies from the conversion manifest",
+        manifest.prune(files))
+    manifest.close()
+
+
+def convert_and_upload(shards, workers=1, converter='iterparse',
+                       use_manifest=True):
+    """Convert every study to gzipped shards, like `convert_to_json()`,
+    uploading each shard as soon as it has been written, so that
+    parsing and uploading overlap.
+
+    Converted shards are handed to a pool of uploader threads through a
+    bounded queue.  When uploads fall behind, the queue fills up and we
+    stop starting new conversions until there's space.  Returns the
+    number of studies.
+    """
+    logger.info("Converting to JSON and uploading to cloud...")
+    start_raw_json()
+    files = list_studies()
+    chunks = split_into_chunks(files, shards)
+    delete_old_uploads()
+    delete_uploaded_shards()
+    sealed = queue.Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    errors = []
+
+    def uploader():
+        while True:
+            path = sealed.get()
+            if path is None:
+                return
+            try:
+                upload_shard(path)
+            except Exception as e:
+                # Keep draining the queue, so the producer can't block
+                errors.append(e)
+
+    in_flight = {}
+
+    def seal_finished():
+        done, _ = concurrent.futures.wait(
+            in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            future.result()
+            # Blocks while the queue is full
+            sealed.put(in_flight.pop(future))
+        if errors:
+            raise errors[0]
+
+    threads = [threading.Thread(target=uploader)
+               for _ in range(UPLOAD_THREADS)]
+    for thread in threads:
+        thread.start()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for i, chunk in enumerate(chunks):
+                if len(in_flight) >= workers:
+                    seal_finished()
+                target = os.path.join(
+                    settings.WORKING_DIR, raw_json_shard_name(i))
+                future = executor.submit(
+                    convert_studies, chunk, target, converter, use_manifest)
+                in_flight[future] = target
+            while in_flight:
+                seal_finished()
+    finally:
+        for _ in threads:
+            sealed.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    if use_manifest:
+        prune_manifest(files, converter)
+    return len(files)
+
+
+def _convert_chunks(chunks, targets, workers, converter, use_manifest):
+    logger.info("Converting %s shards with %s workers", len(chunks), workers)
+    if workers <= 1:
+        for chunk, target in zip(chunks, targets):
+            convert_studies(chunk, target, converter, use_manifest)
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        # `map` re-raises the first error from any worker
+        list(executor.map(
+            convert_studies, chunks, targets,
+            [converter] * len(chunks),
+            [use_manifest] * len(chunks)))
+
+
+def _convert_to_shards(files, count, workers, converter, use_manifest):
+    chunks = split_into_chunks(files, count)
+    targets = [
+        os.path.join(settings.WORKING_DIR, raw_json_shard_name(i))
+        for i in range(len(chunks))]
+    _convert_chunks(chunks, targets, workers, converter, use_manifest)
+
+
+def _convert_in_parallel(files, target, workers, converter, use_manifest):
+    chunks = split_into_chunks(files, workers)
+    shards = [
+        "{}.part{:04d}".format(target, i) for i in range(len(chunks))]
+    try:
+        _convert_chunks(chunks, shards, workers, converter, use_manifest)
+        with open(target, 'wb') as f_out:
+            for shard in shards:
+                with open(shard, 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+    finally:
+        for shard in shards:
+            with contextlib.suppress(OSError):
+                os.remove(shard)
 
-        completed += 1
-        if completed % 100 == 0:
-            elapsed = datetime.datetime.now() - start
-            per_file = elapsed.seconds / completed
-            remaining = int(per_file * (len(files) - completed) / 60.0)
-            logger.info("%s minutes remaining", remaining)
 
+# The schema of the `jan17_fda_regulation_snapshot` table in BigQuery
+FDA_REGULATION_SNAPSHOT_SCHEMA = [
+    {'name': 'nct_id', 'type': 'string'},
+    {'name': 'is_fda_regulated', 'type': 'boolean'},
+]
 
 
-def convert_and_download():
-    logger.info("Executing SQL in cloud and downloading results...")
-    storage_path = os.path.join(settings.STORAGE_PREFIX, raw_json_name())
-    schema = [
-        {'name': 'json', 'type': 'string'},
-    ]
-    client = Client('clinicaltrials')
-    tmp_client = Client('tmp_eu')
+def warehouse_client(backend):
+    """A client for the warehouse that runs `view.sql`.  The local
+    (`sqlite`) warehouse reads from `WORKING_VOLUME` in place of the
+    storage bucket, and needs a copy of the January 2017 snapshot.
+    """
+    if backend == 'bigquery':
+        return get_client('clinicaltrials')
+    client = get_client(
+        'clinicaltrials',
+        backend=backend,
+        path=os.path.join(settings.WORKING_DIR, 'warehouse.sqlite3'),
+        storage_root=settings.WORKING_VOLUME)
+    snapshot = client.get_or_create_table(
+        'jan17_fda_regulation_snapshot', FDA_REGULATION_SNAPSHOT_SCHEMA)
+    snapshot.insert_rows_from_csv(
+        settings.FDA_REGULATION_SNAPSHOT_PATH, skip_leading_rows=1)
+    return client
+
+
+def convert_and_download(backend='bigquery'):
+    logger.info("Executing SQL in %s and downloading results...", backend)
+    storage_path = raw_json_storage_path()
+    client = warehouse_client(backend)
     table_name = settings.PROCESSING_STORAGE_TABLE_NAME
-    tmp_table = tmp_client.dataset.table("clincialtrials_tmp_{}".format(gen_job_name()))
-    with contextlib.suppress(NotFound):
-        table = client.get_table(table_name)
-        table.gcbq_table.delete()
-
-    table = client.create_storage_backed_table(
-        table_name,
-        schema,
-        storage_path
+    external_name = table_name + '_external'
+    for name in (table_name, external_name):
+        with contextlib.suppress(NotFound):
+            client.get_table(name).delete()
+
+    external = client.create_storage_backed_table(
+        external_name,
+        study_record.SCHEMA,
+        storage_path,
+        compression='GZIP' if storage_path.endswith('.gz') else None,
+        source_format='NEWLINE_DELIMITED_JSON'
     )
-    sql_path = os.path.join(
-        settings.BASE_DIR, 'frontend/view.sql')
-    with open(sql_path, 'r') as sql_file:
-        job = table.gcbq_client.run_async_query(
-            gen_job_name(), sql_file.read().format(table_name=table_name))
-        job.destination = tmp_table
-        job.use_legacy_sql = False
-        job.write_disposition = 'WRITE_TRUNCATE'
-        job.begin()
-
-        # The call to .run_async_query() might return before results are actually ready.
-        # See https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs/query#timeoutMs
-        wait_for_job(job)
+    # Read the files in storage once, into a native table clustered by
+    # trial, which `view.sql` then queries
+    with open(os.path.join(settings.BASE_DIR, 'frontend/staging.sql')) as f:
+        table = client.create_table_from_query(
+            table_name,
+            f.read(),
+            cluster_by=['nct_id'],
+            substitutions={'table_name': external.name})
+    external.delete()
+
+    if backend == 'bigquery':
+        # The query results are only needed until they're downloaded
+        tmp_client = get_client('tmp_eu')
+    else:
+        tmp_client = client
+    tmp_table = tmp_client.get_table(
+        "clincialtrials_tmp_{}".format(gen_job_name()))
+    try:
+        sql_path = os.path.join(
+            settings.BASE_DIR, 'frontend/view.sql')
+        with open(sql_path, 'r') as sql_file:
+            # Waits for the job to finish, as `.run_async_query()` might
+            # return before results are actually ready.
+            tmp_table.insert_rows_from_query(
+                sql_file.read(), substitutions={'table_name': table.name})
+
+        # A prefix unique to this run, so we can't pick up shards left
+        # behind by an earlier export
+        t1_exporter = tmp_table.exporter(
+            settings.STORAGE_PREFIX + 'test_table-{}-'.format(gen_job_name()))
+        t1_exporter.export_to_storage()
 
+        try:
+            with open(settings.INTERMEDIATE_CSV_PATH, 'w') as f:
+                t1_exporter.download_from_storage_and_unzip(f)
+        finally:
+            t1_exporter.delete_from_storage()
+    finally:
+        # Each holds a full copy of the registry; the query may have
+        # failed before creating it
+        with contextlib.suppress(NotFound):
+            tmp_table.delete()
 
-    t1_exporter = TableExporter(tmp_table, settings.STORAGE_PREFIX + 'test_table-')
-    t1_exporter.export_to_storage()
 
-    with open(settings.INTERMEDIATE_CSV_PATH, 'w') as f:
-        t1_exporter.download_from_storage_and_unzip(f)
+def convert_locally():
+    """Produce the same CSV as `convert_and_download`, by applying the
+    rules in `view.sql` locally rather than in BigQuery.
+    """
+    logger.info("Classifying trials locally...")
+    snapshot = local_view.read_fda_regulation_snapshot(
+        settings.FDA_REGULATION_SNAPSHOT_PATH)
+    written = local_view.write_csv(
+        raw_json_paths(),
+        settings.INTERMEDIATE_CSV_PATH,
+        snapshot,
+        datetime.date.today())
+    logger.info("Wrote %s ACTs and pACTs", written)
+
+
+def write_intermediate_arrow():
+    """Write the typed copy of the CSV which `process_data` reads
+    """
+    rows = intermediate.csv_to_arrow(
+        settings.INTERMEDIATE_CSV_PATH, settings.INTERMEDIATE_ARROW_PATH)
+    logger.info("Wrote %s rows to %s", rows, settings.INTERMEDIATE_ARROW_PATH)
+    return rows
 
 
 def get_env(path):
@@ -179,17 +615,23 @@ def get_env(path):
     return env
 
 
-def process_data():
+def process_data(bulk=False, qa_from_registry=False):
     # TODO no need to call via shell any more (now we are also a command)
+    args = [
+        "{}python".format(settings.PROCESSING_VENV_BIN),
+        "{}/manage.py".format(settings.BASE_DIR),
+        "process_data",
+        "--input-arrow={}".format(settings.INTERMEDIATE_ARROW_PATH),
+        "--run-report={}".format(process_data_report_path()),
+        "--settings=frontend.settings"
+    ]
+    if bulk:
+        args.append("--bulk")
+    if qa_from_registry:
+        args.append("--qa-source=registry")
     try:
         subprocess.check_output(
-            [
-                "{}python".format(settings.PROCESSING_VENV_BIN),
-                "{}/manage.py".format(settings.BASE_DIR),
-                "process_data",
-                "--input-csv={}".format(settings.INTERMEDIATE_CSV_PATH),
-                "--settings=frontend.settings"
-            ],
+            args,
             stderr=subprocess.STDOUT,
             env=get_env(settings.PROCESSING_ENV_PATH))
         notify_slack("Today's data uploaded to FDAAA staging: "
@@ -204,19 +646,184 @@ def process_data():
         sys.exit(1)
 
 
+STAGE_NAMES = ['download', 'archive', 'convert', 'upload', 'query', 'process']
+
+
+def run_report_path():
+    return os.path.join(
+        os.path.dirname(settings.INTERMEDIATE_CSV_PATH), 'run_report.json')
+
+
+def process_data_report_path():
+    return os.path.join(
+        os.path.dirname(settings.INTERMEDIATE_CSV_PATH),
+        'process_data_report.json')
+
+
+def stage_marker_dir():
+    return os.path.join(settings.WORKING_VOLUME, 'load_data_stages')
+
+
+def build_stages(options):
+    """The stages of the pipeline, for the given command-line options.
+    Uploading is only needed when querying in BigQuery, and is part of
+    the convert stage in `--pipeline` mode; archiving only happens with
+    `--archive`.
+    """
+    engine = options['engine']
+    if options['pipeline']:
+        def convert():
+            return {'studies': convert_and_upload(
+                options['shards'],
+                workers=options['workers'],
+                converter=options['converter'],
+                use_manifest=not options['reconvert'])}
+    else:
+        def convert():
+            return {'studies': convert_to_json(
+                workers=options['workers'],
+                converter=options['converter'],
+                use_manifest=not options['reconvert'],
+                shards=options['shards'])}
+    def query():
+        if engine == 'local':
+            convert_locally()
+        else:
+            convert_and_download(backend=engine)
+        return {'rows': write_intermediate_arrow()}
+    stages = [
+        # Always run, as it's how we find out whether the registry has
+        # changed; if it hasn't, the zip is untouched and nothing after
+        # it needs running again
+        Stage('download',
+              lambda: download_and_extract(force=options['force']),
+              outputs=lambda: [registry_zip_path()],
+              always=True),
+        Stage('archive', archive_snapshot),
+        Stage('convert',
+              convert,
+              outputs=raw_json_paths,
+              options={'converter': options['converter'],
+                       'shards': options['shards'],
+                       'pipeline': options['pipeline'],
+                       'record_version': study_record.RECORD_VERSION}),
+        Stage('upload', upload_to_cloud),
+        Stage('query',
+              query,
+              outputs=lambda: [settings.INTERMEDIATE_CSV_PATH,
+                               settings.INTERMEDIATE_ARROW_PATH],
+              options={'engine': engine}),
+        Stage('process', lambda: process_data(
+            bulk=options['bulk_import'],
+            qa_from_registry=options['qa_from_registry'])),
+    ]
+    if engine != 'bigquery' or options['pipeline']:
+        stages = [stage for stage in stages if stage.name != 'upload']
+    if not options['archive']:
+        stages = [stage for stage in stages if stage.name != 'archive']
+    return stages
+
+
 class Command(BaseCommand):
     help = '''Generate a CSV that can be consumed by the `process_data` command, and run that command
     '''
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Run the pipeline even if the registry hasn't changed "
+            "since the last download")
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help="Number of processes to use when converting XML to JSON")
+        parser.add_argument(
+            '--shards',
+            type=int,
+            help="Write the JSON as this many gzipped files, which are "
+            "uploaded in parallel, rather than as one uncompressed file")
+        parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help="Upload each shard as soon as it has been converted, "
+            "rather than after converting them all. Needs --shards")
+        parser.add_argument(
+            '--converter',
+            choices=sorted(CONVERTERS),
+            default='iterparse',
+            help="How to convert XML to JSON. `iterparse` only keeps "
+            "the fields used by view.sql; `xmltodict` keeps everything")
+        parser.add_argument(
+            '--reconvert',
+            action='store_true',
+            help="Convert every study, rather than reusing the JSON from "
+            "the last run for studies whose XML hasn't changed")
+        parser.add_argument(
+            '--archive',
+            action='store_true',
+            help="Record each new download of the registry in the "
+            "snapshot archive, which keeps every version of every study")
+        parser.add_argument(
+            '--bulk-import',
+            action='store_true',
+            help="Run `process_data --bulk`, which creates or updates "
+            "every trial at once rather than one at a time")
+        parser.add_argument(
+            '--qa-from-registry',
+            action='store_true',
+            help="Run `process_data --qa-source=registry`, which reads "
+            "QA history from the download, scraping only what it can't")
+        parser.add_argument(
+            '--engine',
+            choices=['bigquery', 'sqlite', 'local'],
+            default='bigquery',
+            help="Where to run the logic in view.sql: in BigQuery; in an "
+            "embedded SQLite stand-in for BigQuery; or in Python (`local`). "
+            "The last two need no network access, but need "
+            "FDA_REGULATION_SNAPSHOT_PATH")
+        parser.add_argument(
+            '--from-stage',
+            choices=STAGE_NAMES,
+            help="Run this stage and every one after it, even if they "
+            "are up to date")
+        parser.add_argument(
+            '--only-stage',
+            choices=STAGE_NAMES,
+            help="Run just this stage")
+
     def handle(self, *args, **options):
-        with contextlib.suppress(OSError):
-            os.remove(settings.INTERMEDIATE_CSV_PATH)
+        if options['pipeline'] and not options['shards']:
+            raise CommandError("--pipeline needs --shards")
+        if options['pipeline'] and options['engine'] != 'bigquery':
+            raise CommandError("--pipeline only applies to --engine=bigquery")
+        from_stage = options['from_stage']
+        if options['force'] and not options['only_stage']:
+            from_stage = from_stage or 'download'
+        report = RunReport('load_data')
+        runner = StageRunner(
+            build_stages(options), stage_marker_dir(), report=report)
+        for name in (from_stage, options['only_stage']):
+            if name is not None and name not in runner.names:
+                raise CommandError(
+                    "There is no {} stage with --engine={}".format(
+                        name, options['engine']))
         try:
-            download_and_extract()
-            convert_to_json()
-            upload_to_cloud()
-            convert_and_download()
-            process_data()
+            ran = runner.run(
+                from_stage=from_stage, only_stage=options['only_stage'])
+            if ran == ['download']:
+                notify_slack("FDAAA import skipped: ClinicalTrials.gov "
+                             "data unchanged since the last run")
+            else:
+                if 'process' in ran:
+                    with contextlib.suppress(OSError):
+                        report.include(
+                            process_data_report_path(), 'process_data.')
+                notify_slack(report.summary())
         except:
             notify_slack("Error in FDAAA import: {}".format(traceback.format_exc()))
             raise
+        finally:
+            with contextlib.suppress(OSError):
+                report.write(run_report_path())
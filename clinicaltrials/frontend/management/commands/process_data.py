@@ -1,24 +1,33 @@
+from collections import defaultdict
 from datetime import date
-from lxml.etree import tostring
 import csv
 import datetime
+import io
 import logging
+import os
 import re
 
+from django.conf import settings
 from django.db import transaction
 from django.db.models import Sum
 from django.db import connection
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.utils.text import slugify
+from psycopg2.extras import execute_values
 
+from frontend import intermediate
+from frontend import qa_scraper
+from frontend import qa_table
+from frontend.results_cache import ResultsCache
+from frontend.run_report import RunReport
 from frontend.models import Trial
 from frontend.models import TrialQA
 from frontend.models import Sponsor
 from frontend.models import Ranking
 from frontend.models import date
-import requests
-from lxml import html
-import dateparser
+from frontend.trial_computer import compute_metadata_bulk
+from frontend.trial_computer import compute_metadata_in_db
 
 
 logger = logging.getLogger(__name__)
@@ -26,78 +35,224 @@ logger = logging.getLogger(__name__)
 # The date cc.gov first started recording cancellations
 EARLIEST_CANCELLATION_DATE = date(2018, 7, 5)
 
-def set_qa_metadata(trial):
-    """Scrape `Results Submitted` tab on website for interim reporting
+# How many scraped results pages to save in each transaction
+QA_BATCH_SIZE = 100
+
+# How many rows `--bulk` sends to the database at once
+BULK_BATCH_SIZE = 5000
+
+# The temporary table `--bulk` copies the input into
+STAGING_COLUMNS = (
+    ('position', 'integer'),
+    ('sponsor_slug', 'text'),
+    ('sponsor', 'text'),
+    ('is_industry_sponsor', 'boolean'),
+    ('nct_id', 'text'),
+    ('url', 'text'),
+    ('title', 'text'),
+    ('has_certificate', 'boolean'),
+    ('has_results', 'boolean'),
+    ('results_due', 'boolean'),
+    ('included_pact_flag', 'boolean'),
+    ('start_date', 'date'),
+    ('available_completion_date', 'date'),
+    ('results_submitted_date', 'date'),
+)
+
+# As when importing row by row, a sponsor is named after the first row
+# which mentions it, and otherwise the last row for each sponsor or
+# trial wins
+UPSERT_SPONSORS_SQL = (
+    "INSERT INTO frontend_sponsor "
+    " (slug, name, is_industry_sponsor, updated_date) "
+    "SELECT sponsor_slug, "
+    " (ARRAY_AGG(sponsor ORDER BY position))[1], "
+    " (ARRAY_AGG(is_industry_sponsor ORDER BY position DESC))[1], %s "
+    "FROM process_data_staging "
+    "GROUP BY sponsor_slug "
+    "ON CONFLICT (slug) DO UPDATE SET "
+    " is_industry_sponsor = EXCLUDED.is_industry_sponsor, "
+    " updated_date = EXCLUDED.updated_date")
+
+# `first_seen_date` is only set for new trials, and a trial keeps its
+# last known completion date if it no longer has one
+UPSERT_TRIALS_SQL = (
+    "INSERT INTO frontend_trial "
+    " (registry_id, publication_url, title, has_exemption, has_results, "
+    "  results_due, is_pact, sponsor_id, start_date, completion_date, "
+    "  reported_date, first_seen_date, updated_date, status, "
+    "  previous_status) "
+    "SELECT DISTINCT ON (nct_id) "
+    " nct_id, url, title, has_certificate, has_results, "
+    " results_due, included_pact_flag, sponsor_slug, start_date, "
+    " available_completion_date, results_submitted_date, %s, %s, %s, %s "
+    "FROM process_data_staging "
+    "ORDER BY nct_id, position DESC "
+    "ON CONFLICT (registry_id) DO UPDATE SET "
+    " publication_url = EXCLUDED.publication_url, "
+    " title = EXCLUDED.title, "
+    " has_exemption = EXCLUDED.has_exemption, "
+    " has_results = EXCLUDED.has_results, "
+    " results_due = EXCLUDED.results_due, "
+    " is_pact = EXCLUDED.is_pact, "
+    " sponsor_id = EXCLUDED.sponsor_id, "
+    " start_date = EXCLUDED.start_date, "
+    " completion_date = COALESCE("
+    "  EXCLUDED.completion_date, frontend_trial.completion_date), "
+    " reported_date = EXCLUDED.reported_date, "
+    " updated_date = EXCLUDED.updated_date "
+    "RETURNING id")
+
+def set_qa_metadata(trial, page):
+    """Read the `Results Submitted` tab on website for interim reporting
     (this means results have been submitted at some point, and are
     under QA).
 
-    Store this data in a TrialQA table
+    Store this data in a TrialQA table.  `page` is the HTML of the tab,
+    as fetched by `scrape_qa_metadata`.
 
     """
-    registry_id = trial.registry_id
-    url = "https://clinicaltrials.gov/ct2/show/results/{}".format(registry_id)
-    content = html.fromstring(requests.get(url).text)
-    table = content.xpath("//table[.//th//text()[contains(., 'Submission Cycle')]]")
-    if table:
-        for row in table[0].xpath(".//tr"):
-            if len(row.xpath(".//td")) == 0:
-                continue
-            else:
-                # if Cancelled, loop over submitted dates. See #146
-                # for a description of cancellations
-                cancelled = re.findall(
-                    r"\n\s+([^<>]*)<br/>.*?cancell?ed.*? (?:-|on) (.*?)\)<br/>",
-                    tostring(row).decode('utf8').replace("&#13;", ""), # carriage return
-                    re.I|re.DOTALL)
-                # Oh god, sometimes it's returned and cancelled on the
-                # same day or something
-                for submitted_date, cancelled_date in cancelled:
-                    submitted_date = dateparser.parse(submitted_date)
-                    if "unknown" in cancelled_date.lower():
-                        cancelled_date = EARLIEST_CANCELLATION_DATE
-                        cancellation_date_inferred = True
-                    else:
-                        cancelled_date = dateparser.parse(cancelled_date)
-                        cancellation_date_inferred = False
-                    logger.info(
-                        "Setting cancellation info for %s: %s -> %s",
-                        trial,
-                        submitted_date,
-                        cancelled_date)
-                    # Assumes you can't submit twice on same day
-                    qa, _ = TrialQA.objects.get_or_create(
-                        submitted_to_regulator=submitted_date,
-                        trial=trial)
-                    qa.cancelled_by_sponsor = cancelled_date
-                    qa.cancellation_date_inferred = cancellation_date_inferred
-                    qa.save()
-
-                # Take the date on the last line, to cater for cases
-                # where there are many dates (specifically,
-                # cancellation; but given this was added to the output
-                # unexpectedly, and similar additions may come in the
-                # future, defaulting to the most recent date is the
-                # most conservative approach)
-                submitted = [
-                    x.strip()
-                    for x in row.xpath(".//td[1]")[0].text_content().split("\n")
-                    if x.strip()][-1]
-                if re.findall(r"cancell?ed", submitted, re.I):
-                    # The last event was a cancellation; no further submissions
-                    continue
-                submitted = submitted and dateparser.parse(submitted) or None
-                returned = row.xpath(".//td[2]")[0].text.strip()
-                returned = returned and dateparser.parse(returned) or None
-                qa, created = TrialQA.objects.get_or_create(
-                    submitted_to_regulator=submitted,
-                    trial=trial)
-                if returned:
-                    qa.returned_to_sponsor = returned
-                    qa.save()
-    else:
+    set_qa_cycles(trial, qa_table.parse_qa_table(page))
+
+
+def set_qa_cycles(trial, cycles):
+    """Store the QA `cycles` of `trial` (see `qa_table`) in the TrialQA
+    table; None means the trial isn't, and hasn't been, in QA.
+    """
+    if cycles is None:
         deleted, _ = trial.trialqa_set.all().delete()
         if deleted:
             trial.save()
+        return
+    for cancellations, submission in cycles:
+        # See #146 for a description of cancellations
+        for submitted_date, cancelled_date in cancellations:
+            cancellation_date_inferred = cancelled_date is None
+            if cancellation_date_inferred:
+                cancelled_date = EARLIEST_CANCELLATION_DATE
+            logger.info(
+                "Setting cancellation info for %s: %s -> %s",
+                trial,
+                submitted_date,
+                cancelled_date)
+            # Assumes you can't submit twice on same day
+            qa, _ = TrialQA.objects.get_or_create(
+                submitted_to_regulator=submitted_date,
+                trial=trial)
+            qa.cancelled_by_sponsor = cancelled_date
+            qa.cancellation_date_inferred = cancellation_date_inferred
+            qa.save()
+
+        if submission is None:
+            # The last event was a cancellation; no further submissions
+            continue
+        # This is the date on the last line, to cater for cases where
+        # there are many dates (specifically, cancellation; but given
+        # this was added to the output unexpectedly, and similar
+        # additions may come in the future, defaulting to the most
+        # recent date is the most conservative approach)
+        qa, created = TrialQA.objects.get_or_create(
+            submitted_to_regulator=submission.submitted,
+            trial=trial)
+        if submission.returned:
+            qa.returned_to_sponsor = submission.returned
+            qa.save()
+
+
+def set_qa_metadata_from_registry(trials, pending_data):
+    """Store the QA history of each of `trials` from `pending_data`,
+    which maps NCT ids to the `pending_data` of the rows imported which
+    have any (see `qa_table.parse_pending_results`), a batch at a time.
+
+    Returns the trials it couldn't resolve, whose results pages still
+    need scraping.  That includes those with no pending results, which
+    tells us nothing, so their existing QA history is left to the
+    scraper rather than cleared.
+    """
+    unresolved = []
+    batch = []
+
+    def save(batch):
+        with transaction.atomic():
+            for trial, cycles in batch:
+                set_qa_cycles(trial, cycles)
+
+    for trial in trials:
+        if trial.registry_id not in pending_data:
+            # Not in this import, or without pending results
+            unresolved.append(trial)
+            continue
+        try:
+            cycles = qa_table.parse_pending_results(
+                pending_data[trial.registry_id])
+        except ValueError as e:
+            logger.info("Can't read QA history of %s: %s", trial, e)
+            unresolved.append(trial)
+            continue
+        batch.append((trial, cycles))
+        if len(batch) >= QA_BATCH_SIZE:
+            save(batch)
+            batch = []
+    save(batch)
+    return unresolved
+
+
+def results_cache_path():
+    """Location of the results page cache, which lives outside
+    `WORKING_DIR` so it survives from one run to the next.
+    """
+    return os.path.join(settings.WORKING_VOLUME, 'results_page_cache.sqlite')
+
+
+def scrape_qa_metadata(trials, workers, requests_per_second, cache=None):
+    """Fetch the results pages of `trials` concurrently (see
+    `qa_scraper`), saving what we find a batch at a time.  With a
+    `ResultsCache`, pages which haven't changed since they were last
+    saved are skipped.
+
+    Returns the number of pages which were `unchanged`, and which
+    `failed` to be fetched; trials whose pages failed are left as they
+    were.
+    """
+    trials = {trial.registry_id: trial for trial in trials}
+    scraper = qa_scraper.Scraper(
+        settings.RESULTS_PAGE_URL,
+        workers=workers,
+        requests_per_second=requests_per_second)
+    known = cache.get_many(trials) if cache else {}
+    counts = {'unchanged': 0, 'failed': 0}
+    batch = []
+
+    def save(batch):
+        with transaction.atomic():
+            for trial, page in batch:
+                if not page.unchanged:
+                    set_qa_metadata(trial, page.text)
+        # Only once what's on the pages has been saved, so that a
+        # failed run doesn't skip them next time
+        if cache:
+            cache.put_many([
+                (trial.registry_id, page.etag, page.last_modified,
+                 page.digest)
+                for trial, page in batch])
+
+    try:
+        for registry_id, page in scraper.scrape(list(trials), known):
+            if page is None:
+                counts['failed'] += 1
+                continue
+            if page.unchanged:
+                counts['unchanged'] += 1
+            batch.append((trials[registry_id], page))
+            if len(batch) >= QA_BATCH_SIZE:
+                save(batch)
+                batch = []
+        save(batch)
+    finally:
+        scraper.close()
+    if cache:
+        cache.evict()
+    return counts
 
 
 def _compute_ranks():
@@ -169,6 +324,145 @@ def truthy(val):
     return bool(int(val))
 
 
+def read_csv_rows(path):
+    """Yield each row of a CSV generated by `load_data`, with the flags
+    we use turned into booleans, as they are in the Arrow file.
+    """
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            for name in ('has_certificate', 'has_results', 'results_due',
+                         'included_pact_flag'):
+                row[name] = truthy(row[name])
+            yield row
+
+
+def record_pending_data(rows, pending_data):
+    """Pass `rows` through, noting in the dict `pending_data`, by NCT id,
+    the `pending_data` of each which might be in QA and has any.
+    """
+    for row in rows:
+        if (row.get('pending_data') and row['results_due']
+                and not row['has_results']):
+            pending_data[row['nct_id']] = row['pending_data']
+        yield row
+
+
+class SponsorResolver(object):
+    """Find the slug of each sponsor named in an import, slugifying
+    each distinct name once, and remember what to write to each
+    sponsor so that `save()` can write it just once.
+    """
+    def __init__(self, today):
+        self.today = today
+        self.slugs = {}
+        # slug -> [name, is_industry_sponsor]
+        self.sponsors = {}
+
+    def resolve(self, name, is_industry_sponsor):
+        slug = self.slugs.get(name)
+        if slug is None:
+            slug = self.slugs[name] = slugify(name)
+        if slug in self.sponsors:
+            # A new sponsor is named after the first row which
+            # mentions it, but takes its type from the last
+            self.sponsors[slug][1] = is_industry_sponsor
+        else:
+            self.sponsors[slug] = [name, is_industry_sponsor]
+        return slug
+
+    def save(self):
+        """Create the new sponsors and update the existing ones
+        """
+        existing = set(Sponsor.objects.filter(
+            pk__in=list(self.sponsors)).order_by().values_list(
+                'pk', flat=True))
+        Sponsor.objects.bulk_create([
+            Sponsor(slug=slug, name=name,
+                    is_industry_sponsor=is_industry_sponsor,
+                    updated_date=self.today)
+            for slug, (name, is_industry_sponsor) in self.sponsors.items()
+            if slug not in existing])
+        for is_industry_sponsor in (True, False):
+            Sponsor.objects.filter(pk__in=[
+                slug for slug in existing
+                if self.sponsors[slug][1] == is_industry_sponsor
+            ]).update(
+                is_industry_sponsor=is_industry_sponsor,
+                updated_date=self.today)
+
+
+def copy_value(value):
+    """Format a value for Postgres' `COPY` text format
+    """
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace(
+        '\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def staging_row(position, row):
+    """The values for `STAGING_COLUMNS` from a row of the input
+    """
+    return (
+        position,
+        slugify(row['sponsor']),
+        row['sponsor'],
+        row['sponsor_type'] == 'Industry',
+        row['nct_id'],
+        row['url'],
+        row['title'],
+        row['has_certificate'],
+        row['has_results'],
+        row['results_due'],
+        row['included_pact_flag'],
+        # Dates are empty strings in the CSV, and None in the Arrow file
+        row['start_date'] or None,
+        row['available_completion_date'] or None,
+        row['results_submitted_date'] or None,
+    )
+
+
+def copy_to_staging(cursor, lines):
+    cursor.copy_expert(
+        "COPY process_data_staging FROM STDIN",
+        io.StringIO("".join(lines)))
+
+
+def update_metadata(trial_ids):
+    """Compute the metadata of the given trials, as `Trial.save()`
+    does, and write it back a batch at a time.
+    """
+    for i in range(0, len(trial_ids), BULK_BATCH_SIZE):
+        batch = trial_ids[i:i + BULK_BATCH_SIZE]
+        trials = list(Trial.objects.filter(pk__in=batch))
+        qa_events_by_trial = defaultdict(list)
+        for event in TrialQA.objects.filter(trial_id__in=batch):
+            qa_events_by_trial[event.trial_id].append(event)
+        compute_metadata_bulk(trials, qa_events_by_trial)
+        values = [
+            (trial.pk, trial.days_late, trial.finable_days_late,
+             trial.status, trial.previous_status)
+            for trial in trials]
+        with connection.cursor() as c:
+            execute_values(
+                c,
+                "UPDATE frontend_trial SET "
+                " days_late = v.days_late, "
+                " finable_days_late = v.finable_days_late, "
+                " status = v.status, "
+                " previous_status = v.previous_status "
+                "FROM (VALUES %s) AS v "
+                " (id, days_late, finable_days_late, status, previous_status) "
+                "WHERE frontend_trial.id = v.id",
+                values,
+                template="(%s, %s::integer, %s::integer, %s, %s)",
+                page_size=BULK_BATCH_SIZE)
+
+
 class Command(BaseCommand):
     help = '''Import a CSV that has been generated by the `load_data.py` script.
 
@@ -178,38 +472,152 @@ class Command(BaseCommand):
         parser.add_argument(
             '--input-csv',
             type=str)
+        parser.add_argument(
+            '--input-arrow',
+            type=str,
+            help="Import the typed Arrow file written by `load_data`, "
+            "rather than a CSV")
+        parser.add_argument(
+            '--run-report',
+            type=str,
+            help="Write timings and other measurements of each step "
+            "to this JSON file")
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help="Copy the input into the database and create or update "
+            "every sponsor and trial at once, rather than one row at a time")
+        parser.add_argument(
+            '--metadata',
+            choices=['python', 'sql'],
+            default='python',
+            help="With --bulk, compute each trial's lateness and status "
+            "in Python, or with one UPDATE in the database")
+        parser.add_argument(
+            '--scrape-workers',
+            type=int,
+            default=1,
+            help="Fetch this many results pages at once when scraping "
+            "for QA metadata")
+        parser.add_argument(
+            '--scrape-rate',
+            type=float,
+            default=5,
+            help="When scraping, make no more than this many requests "
+            "a second")
+        parser.add_argument(
+            '--scrape-cache',
+            action='store_true',
+            help="Remember each results page, and skip those which "
+            "haven't changed since the last run")
+        parser.add_argument(
+            '--qa-source',
+            choices=['scrape', 'registry'],
+            default='scrape',
+            help="Read the QA history of each trial from its results "
+            "page, or from the pending results in the input, scraping "
+            "only those it doesn't settle")
 
     def handle(self, *args, **options):
-        f = open(options['input_csv'])
-        logger.info("Creating new trials and sponsors from %s", options['input_csv'])
-        with transaction.atomic():
+        if options['metadata'] == 'sql' and not options['bulk']:
+            raise CommandError("--metadata=sql needs --bulk")
+        if options['input_arrow']:
+            input_path = options['input_arrow']
+            rows = intermediate.read_rows(input_path)
+        else:
+            input_path = options['input_csv']
+            rows = read_csv_rows(input_path)
+        pending_data = {}
+        if options['qa_source'] == 'registry':
+            rows = record_pending_data(rows, pending_data)
+        logger.info("Creating new trials and sponsors from %s", input_path)
+        report = RunReport('process_data')
+        with report.stage('import') as counters:
             # We don't use auto_now on models for `today`, purely so
             # we can mock this in tests.
             today = date.today()
-            for row in csv.DictReader(f):
-                # Create / update sponsor
-                d = {
-                    'name': row['sponsor'],
-                    'is_industry_sponsor': row['sponsor_type'] == 'Industry',
-                    'updated_date': today
-                }
-                sponsor, created = Sponsor.objects.get_or_create(
-                    pk=slugify(row['sponsor']), defaults=d)
-                if not created:
-                    sponsor.updated_date = today
-                    sponsor.is_industry_sponsor = d['is_industry_sponsor']
-                    sponsor.save()
+            if options['bulk']:
+                counters['rows'], trial_ids = self.bulk_import_rows(
+                    rows, today)
+            else:
+                counters['rows'] = self.import_rows(rows, today)
+
+        if options['bulk']:
+            with report.stage('metadata') as counters:
+                counters['rows'] = len(trial_ids)
+                if options['metadata'] == 'sql':
+                    compute_metadata_in_db(trial_ids)
+                else:
+                    update_metadata(trial_ids)
+
+        # Now scrape trials that might be in QA (these would be
+        # flagged as having no results, but if in QA we consider
+        # them submitted until QA finishes)
+        with report.stage('scrape_qa') as counters:
+            possible_results = Trial.objects.filter(
+                results_due=True, has_results=False)
+            counters['rows'] = possible_results.count()
+            if options['qa_source'] == 'registry':
+                possible_results = set_qa_metadata_from_registry(
+                    possible_results, pending_data)
+                counters['from_registry'] = (
+                    counters['rows'] - len(possible_results))
+                logger.info("Set QA metadata for %s trials from the registry",
+                            counters['from_registry'])
+            logger.info(
+                "Scraping %s trials for QA metadata", len(possible_results))
+            cache = None
+            if options['scrape_cache']:
+                cache = ResultsCache(results_cache_path())
+            counters.update(scrape_qa_metadata(
+                possible_results,
+                options['scrape_workers'],
+                options['scrape_rate'],
+                cache=cache))
+            if cache:
+                cache.close()
+
+        # Update the status of trials that no longer appear in the dataset
+        with report.stage('zombies') as counters:
+            zombies = Trial.objects.filter(
+                updated_date__lt=today).exclude(status=Trial.STATUS_NO_LONGER_ACT)
+            counters['rows'] = zombies.count()
+            logger.info("Marking %s zombie trials", counters['rows'])
+            zombies.update(
+                status=Trial.STATUS_NO_LONGER_ACT, updated_date=today)
+
+        # This should only happen after Trial statuses have been set
+        logger.info("Setting current rankings")
+        with report.stage('rankings'):
+            set_current_rankings()
+
+        if options['run_report']:
+            report.write(options['run_report'])
+
+    def import_rows(self, rows, today):
+        """Create or update a Sponsor and Trial for each row, returning
+        the number of rows.
+        """
+        count = 0
+        sponsors = SponsorResolver(today)
+        with transaction.atomic():
+            for row in rows:
+                count += 1
+                # Sponsors are written once, at the end; the foreign
+                # key from each trial isn't checked until we commit
+                sponsor_id = sponsors.resolve(
+                    row['sponsor'], row['sponsor_type'] == 'Industry')
 
                 # Create / update Trial
                 d = {
                     'registry_id': row['nct_id'],
                     'publication_url': row['url'],
                     'title': row['title'],
-                    'has_exemption': truthy(row['has_certificate']),
-                    'has_results': truthy(row['has_results']),
-                    'results_due': truthy(row['results_due']),
-                    'is_pact': truthy(row['included_pact_flag']),
-                    'sponsor_id': sponsor.pk,
+                    'has_exemption': row['has_certificate'],
+                    'has_results': row['has_results'],
+                    'results_due': row['results_due'],
+                    'is_pact': row['included_pact_flag'],
+                    'sponsor_id': sponsor_id,
                     'start_date': row['start_date'],
                     'first_seen_date': today,
                     'updated_date': today,
@@ -225,23 +633,35 @@ class Command(BaseCommand):
                             setattr(instance, attr, value)
                     instance.updated_date = today
                     instance.save()
+            sponsors.save()
+        return count
 
-
-        # Now scrape trials that might be in QA (these would be
-        # flagged as having no results, but if in QA we consider
-        # them submitted until QA finishes)
-        possible_results = Trial.objects.filter(results_due=True, has_results=False)
-        logger.info("Scraping %s trials for QA metadata", possible_results.count())
-        for trial in possible_results:
-            set_qa_metadata(trial)
-
-        # Update the status of trials that no longer appear in the dataset
-        zombies = Trial.objects.filter(
-            updated_date__lt=today).exclude(status=Trial.STATUS_NO_LONGER_ACT)
-        logger.info("Marking %s zombie trials", zombies.count())
-        zombies.update(
-            status=Trial.STATUS_NO_LONGER_ACT, updated_date=today)
-
-        # This should only happen after Trial statuses have been set
-        logger.info("Setting current rankings")
-        set_current_rankings()
+    def bulk_import_rows(self, rows, today):
+        """Copy the rows into a temporary table, then create or update
+        every Sponsor and Trial from it with one query each.  Returns
+        the number of rows and the ids of the trials, whose metadata
+        still needs computing (see `update_metadata()`).
+        """
+        count = 0
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute(
+                "CREATE TEMPORARY TABLE process_data_staging ({}) "
+                "ON COMMIT DROP".format(", ".join(
+                    "{} {}".format(*column) for column in STAGING_COLUMNS)))
+            lines = []
+            for row in rows:
+                lines.append("\t".join(
+                    copy_value(value)
+                    for value in staging_row(count, row)) + "\n")
+                count += 1
+                if len(lines) >= BULK_BATCH_SIZE:
+                    copy_to_staging(c, lines)
+                    lines = []
+            copy_to_staging(c, lines)
+            c.execute(UPSERT_SPONSORS_SQL, [today])
+            c.execute(UPSERT_TRIALS_SQL, [
+                today, today, Trial.STATUS_ONGOING, Trial.STATUS_ONGOING])
+            trial_ids = [row[0] for row in c.fetchall()]
+            # In case we're inside a longer transaction
+            c.execute("DROP TABLE process_data_staging")
+        return count, trial_ids
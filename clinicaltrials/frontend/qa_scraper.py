@@ -0,0 +1,158 @@
+"""Fetch many trials' results pages from ClinicalTrials.gov at once.
+
+Pages are fetched by a pool of worker threads which share one
+`requests.Session`, so connections are kept alive and reused, and one
+`RateLimiter`, so that however many workers there are we make no more
+than a fixed number of requests per second.  Requests which time out,
+fail to connect, or are answered with a status which suggests trying
+again later are retried with exponential backoff.
+
+Given what we knew of a page last time (see `results_cache`), we ask
+the server for it only if it has changed, and if it's sent anyway,
+check whether its body is the same.
+
+"""
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from frontend.conversion_manifest import digest
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses which mean the server may answer if we ask again later
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# How many pages to queue for each worker
+QUEUED_PER_WORKER = 2
+
+# A results page as fetched.  `text` is None when the server told us
+# the page hadn't changed; `unchanged` is also set when it sent the
+# same page again.
+Page = collections.namedtuple(
+    'Page', 'text etag last_modified digest unchanged')
+
+
+class ScrapeError(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """Spaces out calls to `wait()`, from any number of threads, so that
+    they return no more than `rate` times a second.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class Scraper(object):
+    def __init__(self, url_template, workers=8, requests_per_second=5,
+                 timeout=30, retries=3, backoff=2):
+        """Fetch `url_template`, formatted with each id, using `workers`
+        threads.
+        """
+        self.url_template = url_template
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _fetch_once(self, url, known):
+        headers = {}
+        if known and known['etag']:
+            headers['If-None-Match'] = known['etag']
+        if known and known['last_modified']:
+            headers['If-Modified-Since'] = known['last_modified']
+        self.limiter.wait()
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code in RETRY_STATUSES:
+            raise ScrapeError("{} returned {}".format(
+                url, response.status_code))
+        if response.status_code == 304 and known:
+            return Page(None, known['etag'], known['last_modified'],
+                        known['digest'], True)
+        content_digest = digest(response.content)
+        return Page(
+            response.text,
+            response.headers.get('ETag'),
+            response.headers.get('Last-Modified'),
+            content_digest,
+            bool(known) and known['digest'] == content_digest)
+
+    def fetch(self, id, known=None):
+        """The `Page` for `id`, retrying failures up to `retries` times.
+        `known` is what we last knew of it, as from
+        `ResultsCache.get_many()`.
+        """
+        url = self.url_template.format(id)
+        attempt = 0
+        while True:
+            try:
+                return self._fetch_once(url, known)
+            except (requests.ConnectionError,
+                    requests.Timeout,
+                    ScrapeError) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                wait = self.backoff * 2 ** (attempt - 1)
+                logger.warn(
+                    "Fetching %s failed (%s); retrying in %ss", url, e, wait)
+                time.sleep(wait)
+
+    def _fetch_or_none(self, id, known):
+        try:
+            return self.fetch(id, known)
+        except (requests.RequestException, ScrapeError) as e:
+            logger.error("Giving up on %s: %s", id, e)
+            return None
+
+    def scrape(self, ids, known=None):
+        """Yield `(id, page)` for each of `ids`, in order; `page` is a
+        `Page`, or None if it couldn't be fetched.  `known` maps ids to
+        what we last knew of their pages.
+        """
+        known = known or {}
+        executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        # Only a few pages are queued ahead of the one we're waiting
+        # for, so if we're stopped early, because saving a page failed,
+        # little is fetched for nothing
+        pending = collections.deque()
+        try:
+            for id in ids:
+                pending.append((id, executor.submit(
+                    self._fetch_or_none, id, known.get(id))))
+                if len(pending) > self.workers * QUEUED_PER_WORKER:
+                    id, future = pending.popleft()
+                    yield id, future.result()
+            while pending:
+                id, future = pending.popleft()
+                yield id, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,170 @@
+"""Parse the QA table on a trial's results page.
+
+The "Submission Cycle" table on `/ct2/show/results/NCT...` has a row
+for each cycle of quality control review.  The first cell lists, one
+per line, each date results were submitted, each followed by a line
+like `(Canceled on May 15, 2018)` if the sponsor cancelled that
+submission; the second cell holds the date the last submission was
+returned to the sponsor, if it has been.
+
+Dates are nearly always written the same way, so we try `strptime`
+with the few formats the registry uses before falling back to
+`dateparser`, which is much slower; its results are memoized, as the
+same dates turn up on many pages.
+
+The registry download carries the same history, in each study's
+`pending_results` element: the dates results were `submitted`, each
+followed by the date they were `returned` or the `submission_canceled`,
+if either has happened.  `study_converter` keeps those events in
+order, and `parse_pending_results` reads them into the same `Cycle`s;
+where it can't, the results page must be scraped instead.
+
+"""
+import collections
+import datetime
+import functools
+import json
+import re
+
+import dateparser
+from lxml import html
+
+
+# Tried, in order, before `dateparser`
+DATE_FORMATS = ('%B %d, %Y', '%b %d, %Y', '%Y-%m-%d')
+
+CANCELLED_RE = re.compile(r"cancell?ed", re.I)
+CANCELLATION_DATE_RE = re.compile(
+    r"cancell?ed.*?\s(?:-|on)\s+(.*?)\)", re.I)
+
+# A submission which the sponsor cancelled; `cancelled` is None if the
+# registry doesn't know when
+Cancellation = collections.namedtuple('Cancellation', 'submitted cancelled')
+
+# The last submission in a cycle, if it wasn't cancelled, and the date
+# it was returned to the sponsor, if it has been
+Submission = collections.namedtuple('Submission', 'submitted returned')
+
+# The cancellations in a cycle, then its last `Submission`, or None if
+# that was cancelled too
+Cycle = collections.namedtuple('Cycle', 'cancellations submission')
+
+
+@functools.lru_cache(maxsize=4096)
+def _dateparser_parse(text):
+    parsed = dateparser.parse(text)
+    return parsed and parsed.date()
+
+
+def parse_date(text):
+    """The date written in `text`, or None if it's empty or can't be
+    parsed
+    """
+    text = text.strip()
+    if not text:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, date_format).date()
+        except ValueError:
+            pass
+    return _dateparser_parse(text)
+
+
+def _lines(cell):
+    return [line.strip() for line in cell.text_content().split("\n")
+            if line.strip()]
+
+
+def _parse_cycle(submitted_cell, returned_cell):
+    lines = _lines(submitted_cell)
+    cancellations = []
+    for submitted, line in zip(lines, lines[1:]):
+        match = CANCELLATION_DATE_RE.search(line)
+        if match:
+            cancelled = match.group(1)
+            cancellations.append(Cancellation(
+                parse_date(submitted),
+                None if "unknown" in cancelled.lower()
+                else parse_date(cancelled)))
+    # The date on the last line is the one that counts (see
+    # `set_qa_metadata`), unless it was cancelled
+    if not lines or CANCELLED_RE.search(lines[-1]):
+        return Cycle(cancellations, None)
+    return Cycle(cancellations, Submission(
+        parse_date(lines[-1]), parse_date(returned_cell.text or '')))
+
+
+def parse_qa_table(page):
+    """The `Cycle`s in the QA table of the results page `page`, or None
+    if it doesn't have one
+    """
+    content = html.fromstring(page)
+    table = content.xpath(
+        "//table[.//th//text()[contains(., 'Submission Cycle')]]")
+    if not table:
+        return None
+    cycles = []
+    for row in table[0].iter('tr'):
+        cells = row.findall('td')
+        if cells:
+            cycles.append(_parse_cycle(cells[0], cells[1]))
+    return cycles
+
+
+def parse_pending_results(pending_data):
+    """The `Cycle`s described by `pending_data`, the `pending_results` of
+    a study as JSON (see `study_record`): a list of events, in the order
+    the registry lists them.
+
+    Raises `ValueError` if `pending_data` is empty, isn't in order (as
+    when converted by `xmltodict`), or doesn't make sense, since then
+    it can't tell us anything about the trial.
+    """
+    if not pending_data:
+        raise ValueError("No pending results")
+    events = json.loads(pending_data)
+    if not isinstance(events, list) or not events:
+        raise ValueError("Pending results not in order")
+    cycles = []
+    cancellations = []
+    submitted = None
+    for event in events:
+        if not isinstance(event, dict) or len(event) != 1:
+            raise ValueError("Unexpected pending result {!r}".format(event))
+        (kind, value), = event.items()
+        if isinstance(value, dict):
+            # In case the element ever gains attributes
+            value = value.get('text')
+        value = value or ''
+        if kind == 'submitted':
+            if submitted is not None:
+                raise ValueError(
+                    "Submission of {} never ended".format(submitted))
+            submitted = parse_date(value)
+            if submitted is None:
+                raise ValueError("Can't parse date {!r}".format(value))
+            continue
+        if submitted is None:
+            raise ValueError("{} follows no submission".format(kind))
+        if kind == 'submission_canceled':
+            cancelled = None
+            if "unknown" not in value.lower():
+                cancelled = parse_date(value)
+                if cancelled is None:
+                    raise ValueError("Can't parse date {!r}".format(value))
+            cancellations.append(Cancellation(submitted, cancelled))
+        elif kind == 'returned':
+            returned = parse_date(value)
+            if returned is None:
+                raise ValueError("Can't parse date {!r}".format(value))
+            cycles.append(Cycle(cancellations, Submission(submitted, returned)))
+            cancellations = []
+        else:
+            raise ValueError("Unexpected pending result {!r}".format(kind))
+        submitted = None
+    if submitted is not None:
+        cycles.append(Cycle(cancellations, Submission(submitted, None)))
+    elif cancellations:
+        cycles.append(Cycle(cancellations, None))
+    return cycles
@@ -0,0 +1,81 @@
+"""What we last saw of each trial's results page.
+
+Most results pages are the same from one day to the next.  For each
+page we keep the `ETag` and `Last-Modified` headers it was served with
+and a SHA-1 of its body, so that the scraper can ask the server
+whether the page has changed (see `qa_scraper`), and so that we can
+tell when a page which was sent again anyway is identical.  Either way,
+there's no need to parse an unchanged page or save what's on it.
+
+Entries which haven't been checked for `max_age_days`, and the oldest
+entries beyond `max_entries`, are removed by `evict()`.
+
+"""
+import datetime
+import sqlite3
+
+
+class ResultsCache(object):
+    def __init__(self, path, max_age_days=30, max_entries=100000):
+        """Open (creating if necessary) the cache at `path`
+        """
+        self.max_age_days = max_age_days
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " registry_id TEXT PRIMARY KEY,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " digest TEXT NOT NULL,"
+            " checked_at TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS pages_checked_at "
+            "ON pages (checked_at)")
+        self.conn.commit()
+
+    def get_many(self, registry_ids):
+        """Map those of `registry_ids` we've seen to a dict of the
+        `etag`, `last_modified` and `digest` of their page
+        """
+        wanted = set(registry_ids)
+        return {
+            registry_id: {
+                'etag': etag, 'last_modified': last_modified,
+                'digest': digest}
+            for registry_id, etag, last_modified, digest in
+            self.conn.execute(
+                "SELECT registry_id, etag, last_modified, digest FROM pages")
+            if registry_id in wanted}
+
+    def put_many(self, pages):
+        """Record `(registry_id, etag, last_modified, digest)` for pages
+        we've just checked
+        """
+        now = datetime.datetime.utcnow().isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pages "
+                "(registry_id, etag, last_modified, digest, checked_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (page + (now,) for page in pages))
+
+    def evict(self):
+        """Remove stale entries, and the oldest beyond `max_entries`,
+        returning how many were removed
+        """
+        cutoff = (datetime.datetime.utcnow() -
+                  datetime.timedelta(days=self.max_age_days)).isoformat()
+        with self.conn:
+            deleted = self.conn.execute(
+                "DELETE FROM pages WHERE checked_at < ?", (cutoff,)).rowcount
+            deleted += self.conn.execute(
+                "DELETE FROM pages WHERE registry_id NOT IN ("
+                " SELECT registry_id FROM pages"
+                " ORDER BY checked_at DESC LIMIT ?)",
+                (self.max_entries,)).rowcount
+        return deleted
+
+    def close(self):
+        self.conn.close()
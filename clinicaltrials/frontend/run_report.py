@@ -0,0 +1,153 @@
+"""Measure where the time and memory go in each stage of an import.
+
+A `RunReport` records, for each stage it's asked to measure:
+
+ * wall-clock and CPU time (including any child processes which
+   finished during the stage, such as conversion workers)
+ * counters the stage reports itself, such as rows or files processed
+ * bytes read and written by this process (on Linux)
+ * peak RSS of this process and its children so far
+ * the number of database queries run
+ * the lines which allocated the most memory, when `tracemalloc` is
+   tracing (for example, with `PYTHONTRACEMALLOC=1` in the environment)
+
+and is written out as JSON, with a short summary for Slack.
+
+"""
+import contextlib
+import datetime
+import json
+import resource
+import time
+import tracemalloc
+
+from django.db import connections
+
+
+# How many allocating lines to record per stage
+TRACEMALLOC_TOP = 10
+
+
+def _io_counters():
+    """Bytes read and written by this process, or `None` where /proc
+    isn't available
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(fields['rchar']), int(fields['wchar'])
+
+
+def _cpu_seconds():
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss_kb():
+    return max(resource.getrusage(who).ru_maxrss
+               for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+class QueryCounter(object):
+    """A database execute wrapper which counts queries
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _top_allocators(before, after):
+    stats = after.compare_to(before, 'lineno')[:TRACEMALLOC_TOP]
+    return [
+        {'location': str(stat.traceback),
+         'size_kb': round(stat.size_diff / 1024, 1),
+         'count': stat.count_diff}
+        for stat in stats]
+
+
+class RunReport(object):
+    def __init__(self, command):
+        self.command = command
+        self.started_at = datetime.datetime.now()
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the code run in this context as the stage `name`.
+        Yields a dict, to which the stage can add its own counters.
+        """
+        counters = {}
+        queries = QueryCounter()
+        snapshot = tracemalloc.is_tracing() and tracemalloc.take_snapshot()
+        io_before = _io_counters()
+        cpu_before = _cpu_seconds()
+        t0 = time.monotonic()
+        status = 'failed'
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(queries))
+                yield counters
+            status = 'ok'
+        finally:
+            entry = {
+                'name': name,
+                'status': status,
+                'wall_s': round(time.monotonic() - t0, 3),
+                'cpu_s': round(_cpu_seconds() - cpu_before, 3),
+                'peak_rss_kb': _peak_rss_kb(),
+                'db_queries': queries.count,
+            }
+            io_after = _io_counters()
+            if io_before and io_after:
+                entry['bytes_read'] = io_after[0] - io_before[0]
+                entry['bytes_written'] = io_after[1] - io_before[1]
+            if snapshot and tracemalloc.is_tracing():
+                entry['top_allocators'] = _top_allocators(
+                    snapshot, tracemalloc.take_snapshot())
+            entry.update(counters)
+            self.stages.append(entry)
+
+    def include(self, path, prefix):
+        """Add the stages from the report at `path`, written by another
+        command, naming them with `prefix`.
+        """
+        with open(path) as f:
+            report = json.load(f)
+        for entry in report['stages']:
+            entry['name'] = prefix + entry['name']
+            self.stages.append(entry)
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': datetime.datetime.now().isoformat(),
+            'stages': self.stages,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def summary(self):
+        lines = ["{} run report:".format(self.command)]
+        for entry in self.stages:
+            line = "{name}: {wall_s:.1f}s wall, {cpu_s:.1f}s CPU, " \
+                   "peak RSS {rss:.0f} MB".format(
+                       rss=entry['peak_rss_kb'] / 1024, **entry)
+            for counter in ('rows', 'files', 'studies', 'db_queries'):
+                if entry.get(counter):
+                    line += ", {} {}".format(entry[counter], counter)
+            if entry['status'] != 'ok':
+                line += " ({})".format(entry['status'])
+            lines.append(line)
+        return "\n".join(lines)
@@ -276,3 +276,16 @@ STORAGE_PREFIX = 'clinicaltrials/'
 WORKING_VOLUME = '/mnt/volume-lon1-01/'   # should have at least 10GB space
 WORKING_DIR = os.path.join(WORKING_VOLUME, STORAGE_PREFIX)
 INTERMEDIATE_CSV_PATH = os.path.join(WORKING_VOLUME, STORAGE_PREFIX, 'clinical_trials.csv')
+# The same rows as INTERMEDIATE_CSV_PATH, typed, for `process_data`
+INTERMEDIATE_ARROW_PATH = os.path.join(WORKING_VOLUME, STORAGE_PREFIX, 'clinical_trials.arrow')
+
+# Where to download the registry from
+REGISTRY_URL = 'https://clinicaltrials.gov/AllPublicXML.zip'
+
+# Where to scrape each trial's results (and QA) page from, by NCT id
+RESULTS_PAGE_URL = 'https://clinicaltrials.gov/ct2/show/results/{}'
+
+# A CSV export of the `jan17_fda_regulation_snapshot` table in
+# BigQuery, used when classifying trials with `load_data --engine=local`
+FDA_REGULATION_SNAPSHOT_PATH = os.path.join(
+    WORKING_VOLUME, 'jan17_fda_regulation_snapshot.csv')
@@ -0,0 +1,143 @@
+"""A compact history of the registry.
+
+Each day's registry is almost all the same as the day before's, so
+rather than keep a full copy of every day, we store each version of a
+study's XML once, compressed and keyed by its SHA-1, and for each day
+record only the studies which were added, changed or withdrawn since
+the last snapshot.  The registry as it stood on any day can be rebuilt
+from those changes, to replay an old import or to compare two days.
+
+The archive is a SQLite database, like the conversion manifest.
+
+"""
+import sqlite3
+import zlib
+
+from frontend.conversion_manifest import digest
+
+
+# How many rows to insert at once
+BATCH_SIZE = 1000
+
+
+class SnapshotArchive(object):
+    def __init__(self, path):
+        """Open (creating if necessary) the archive at `path`
+        """
+        self.conn = sqlite3.connect(path, timeout=600)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " digest TEXT PRIMARY KEY,"
+            " content BLOB NOT NULL);"
+            # `digest` is NULL when the study was withdrawn that day
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " day TEXT NOT NULL,"
+            " nct_id TEXT NOT NULL,"
+            " digest TEXT,"
+            " PRIMARY KEY (nct_id, day));"
+            "CREATE INDEX IF NOT EXISTS changes_day ON changes (day);"
+            "CREATE TABLE IF NOT EXISTS days ("
+            " day TEXT PRIMARY KEY,"
+            " studies INTEGER NOT NULL,"
+            " changed INTEGER NOT NULL);")
+        self.conn.commit()
+
+    def days(self):
+        """The days which have a snapshot, oldest first, as ISO 8601
+        strings
+        """
+        return [row[0] for row in self.conn.execute(
+            "SELECT day FROM days ORDER BY day")]
+
+    def index(self, day):
+        """Map the NCT id of every study in the registry as it stood on
+        `day` to the digest of its XML
+        """
+        index = {}
+        rows = self.conn.execute(
+            "SELECT nct_id, digest FROM changes WHERE day <= ? "
+            "ORDER BY nct_id, day", (day,))
+        for nct_id, content_digest in rows:
+            # Later changes replace earlier ones
+            index[nct_id] = content_digest
+        return {k: v for k, v in index.items() if v is not None}
+
+    def add_snapshot(self, day, studies):
+        """Record the registry on `day`, from `(nct_id, xml_bytes)` pairs
+        for every study in it, returning the number of studies added,
+        changed or withdrawn since the last snapshot.
+
+        Adding a snapshot for a day which already has one replaces it;
+        days before the latest snapshot can't be added.
+        """
+        days = self.days()
+        if days and day < days[-1]:
+            raise ValueError(
+                "Can't add a snapshot for {}, before the latest ({})".format(
+                    day, days[-1]))
+        with self.conn:
+            self.conn.execute("DELETE FROM changes WHERE day = ?", (day,))
+            previous = self.index(day)
+            seen = set()
+            changes = []
+            blobs = []
+            for nct_id, content in studies:
+                seen.add(nct_id)
+                content_digest = digest(content)
+                if previous.get(nct_id) != content_digest:
+                    blobs.append((content_digest, zlib.compress(content)))
+                    changes.append((day, nct_id, content_digest))
+                if len(blobs) >= BATCH_SIZE:
+                    self._insert_blobs(blobs)
+                    blobs = []
+            self._insert_blobs(blobs)
+            changes.extend(
+                (day, nct_id, None) for nct_id in previous
+                if nct_id not in seen)
+            self.conn.executemany(
+                "INSERT INTO changes (day, nct_id, digest) VALUES (?, ?, ?)",
+                changes)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO days (day, studies, changed) "
+                "VALUES (?, ?, ?)", (day, len(seen), len(changes)))
+        return len(changes)
+
+    def _insert_blobs(self, blobs):
+        # Another study, or an earlier version of this one, may have
+        # had identical XML
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO blobs (digest, content) VALUES (?, ?)",
+            blobs)
+
+    def diff(self, day, since):
+        """Map the NCT id of every study which differs between the
+        registry on `since` and on `day` to a pair of digests, either of
+        which is None if the study wasn't in the registry on that day
+        """
+        old = self.index(since)
+        new = self.index(day)
+        return {
+            nct_id: (old.get(nct_id), new.get(nct_id))
+            for nct_id in set(old) | set(new)
+            if old.get(nct_id) != new.get(nct_id)}
+
+    def content(self, content_digest):
+        """The XML with the given digest
+        """
+        row = self.conn.execute(
+            "SELECT content FROM blobs WHERE digest = ?",
+            (content_digest,)).fetchone()
+        if row is None:
+            raise KeyError(content_digest)
+        return zlib.decompress(row[0])
+
+    def studies(self, day):
+        """Yield `(nct_id, xml_bytes)` for every study in the registry as
+        it stood on `day`, in order of NCT id
+        """
+        for nct_id, content_digest in sorted(self.index(day).items()):
+            yield nct_id, self.content(content_digest)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,167 @@
+"""Run a pipeline as a series of stages, resuming where it left off.
+
+When a stage finishes, we write a marker recording a fingerprint of
+its inputs (the state of the stage before it, plus its options) and of
+the files it produced.  On the next run, a stage is skipped if its
+marker matches: its inputs are the same as last time, and its outputs
+haven't been changed or removed since.  So a run that failed near the
+end picks up at the stage that failed, and a stage whose upstream has
+changed is run again, along with everything after it.
+
+Files are fingerprinted by size and modification time, which is cheap
+even for the multi-gigabyte files we deal with.
+
+Given a `RunReport`, each stage that runs is measured by it; a stage
+can report its own counters (such as rows processed) by returning a
+dict.
+
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class Stage(object):
+    def __init__(self, name, run, outputs=None, options=None, always=False):
+        """`run` is called with no arguments to perform the stage.
+        `outputs` returns a list of the paths it produces, and `options`
+        is anything else (JSON-serialisable) which affects its result.
+        A stage with `always` set is never skipped.
+        """
+        self.name = name
+        self.run = run
+        self.outputs = outputs or list
+        self.options = options
+        self.always = always
+
+
+def fingerprint_files(paths):
+    fingerprints = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            fingerprints[path] = None
+        else:
+            fingerprints[path] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def _digest(value):
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True).encode('utf8')).hexdigest()
+
+
+@contextlib.contextmanager
+def _no_report(name):
+    yield {}
+
+
+class StageRunner(object):
+    def __init__(self, stages, marker_dir, report=None):
+        self.stages = stages
+        self.marker_dir = marker_dir
+        self.report = report
+
+    @property
+    def names(self):
+        return [stage.name for stage in self.stages]
+
+    def _marker_path(self, stage):
+        return os.path.join(self.marker_dir, stage.name + '.json')
+
+    def read_marker(self, stage):
+        try:
+            with open(self._marker_path(stage)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_marker(self, stage, inputs, outputs):
+        os.makedirs(self.marker_dir, exist_ok=True)
+        marker = {
+            'completed_at': datetime.datetime.now().isoformat(),
+            'inputs': inputs,
+            'outputs': outputs,
+        }
+        with open(self._marker_path(stage), 'w') as f:
+            json.dump(marker, f, indent=2)
+        return marker
+
+    def _clear_marker(self, stage):
+        try:
+            os.remove(self._marker_path(stage))
+        except FileNotFoundError:
+            pass
+
+    def is_stale(self, stage, inputs):
+        marker = self.read_marker(stage)
+        return (
+            marker is None
+            or marker['inputs'] != inputs
+            or marker['outputs'] != fingerprint_files(stage.outputs()))
+
+    def _inputs(self, stage, upstream):
+        return {'upstream': upstream, 'options': stage.options}
+
+    def _state(self, marker):
+        """What a stage passes to the next one as its input
+        """
+        return marker and _digest([marker['inputs'], marker['outputs']])
+
+    def _run_stage(self, stage, inputs):
+        logger.info("Running stage %s", stage.name)
+        self._clear_marker(stage)
+        measure = self.report.stage if self.report else _no_report
+        with measure(stage.name) as counters:
+            result = stage.run()
+            if isinstance(result, dict):
+                counters.update(result)
+            outputs = fingerprint_files(stage.outputs())
+            files = [f for f in outputs.values() if f is not None]
+            if files:
+                counters['files'] = len(files)
+        return self._write_marker(stage, inputs, outputs)
+
+    def run(self, from_stage=None, only_stage=None):
+        """Run each stage which is incomplete or stale, in order, and
+        return the names of those which were run.
+
+        With `from_stage`, that stage and every one after it is run
+        regardless.  With `only_stage`, just that stage is run.
+        """
+        for name in (from_stage, only_stage):
+            if name is not None and name not in self.names:
+                raise ValueError("Unknown stage {}".format(name))
+        upstream = None
+        forced = False
+        ran = []
+        for stage in self.stages:
+            inputs = self._inputs(stage, upstream)
+            if only_stage is not None:
+                if stage.name == only_stage:
+                    self._run_stage(stage, inputs)
+                    ran.append(stage.name)
+                    break
+                upstream = self._state(self.read_marker(stage))
+                continue
+            forced = forced or stage.name == from_stage
+            if from_stage is not None and not forced:
+                # Before the stage we were asked to start from
+                upstream = self._state(self.read_marker(stage))
+                continue
+            if forced or stage.always or self.is_stale(stage, inputs):
+                marker = self._run_stage(stage, inputs)
+                ran.append(stage.name)
+            else:
+                logger.info("Skipping stage %s, which is up to date",
+                            stage.name)
+                marker = self.read_marker(stage)
+            upstream = self._state(marker)
+        return ran
@@ -0,0 +1,11 @@
+-- Copies the study records written by load_data from the external
+-- table over Cloud Storage into native storage, so that view.sql
+-- scans columns rather than re-reading the files in GCS.
+--
+-- Each record already has the fields view.sql uses extracted and
+-- typed (see frontend/study_record.py), alongside the whole study as
+-- JSON for ad-hoc queries.
+
+SELECT *
+FROM
+   ebmdatalab.clinicaltrials.{table_name}
@@ -0,0 +1,153 @@
+"""Convert registry XML for a single study to the dict from which we
+make its record (see `study_record`).
+
+The historic converter (`xmltodict` plus `load_data.postprocessor`)
+builds a dict for every element of a study, including enormous
+subtrees like `clinical_results` which are then thrown away.  This
+converter walks the document with `lxml.etree.iterparse`, and only
+turns the top-level elements that `study_record` actually reads into
+Python values.  libxml2 still parses every element into its own tree,
+in C; an unwanted element is deleted when the next wanted one ends, or
+with the rest of the tree once the study has been parsed, so peak
+memory still includes it.
+
+For the elements it keeps, the output is identical to the historic
+converter's, i.e. attribute and `#text` keys lose their prefixes,
+repeated elements become lists, and whitespace is stripped.  The
+exception is `pending_results`, whose children (each date results
+were submitted, returned or cancelled) would be grouped by name, losing
+their order; we keep them as a list of one-key dicts, in document
+order, so that `qa_table` can read a trial's QA history from them.
+
+"""
+from io import BytesIO
+import json
+
+from lxml import etree
+
+
+# Children of `clinical_study` which are extracted by `study_record`
+VIEW_FIELDS = (
+    'brief_title',
+    'completion_date',
+    'condition',
+    'condition_browse',
+    'disposition_first_submitted',
+    'enrollment',
+    'id_info',
+    'intervention',
+    'intervention_browse',
+    'keyword',
+    'last_update_submitted',
+    'location',
+    'location_countries',
+    'official_title',
+    'overall_status',
+    'oversight_info',
+    'pending_results',
+    'phase',
+    'primary_completion_date',
+    'required_header',
+    'results_first_submitted',
+    'sponsors',
+    'start_date',
+    'study_design_info',
+    'study_type',
+)
+
+
+# Children of `clinical_study` whose own children are kept in order
+ORDERED_FIELDS = (
+    'pending_results',
+)
+
+
+class ConversionError(Exception):
+    pass
+
+
+def _push(item, key, value):
+    """Add `value` to `item` under `key`, turning repeated keys into
+    lists, exactly as `xmltodict` does.
+    """
+    if item is None:
+        item = {}
+    if key in item:
+        existing = item[key]
+        if isinstance(existing, list):
+            existing.append(value)
+        else:
+            item[key] = [existing, value]
+    else:
+        item[key] = value
+    return item
+
+
+def element_to_value(elem):
+    """Return the `xmltodict`-compatible value for an element: a dict if
+    it has attributes or children, otherwise its stripped text (or None
+    if it has none).
+    """
+    item = None
+    for key, value in elem.attrib.items():
+        item = _push(item, key, value)
+    data = [elem.text] if elem.text else []
+    for child in elem:
+        if isinstance(child.tag, str):
+            item = _push(item, child.tag, element_to_value(child))
+        if child.tail:
+            data.append(child.tail)
+    data = ''.join(data).strip() or None
+    if item is None:
+        return data
+    if data:
+        item = _push(item, 'text', data)
+    return item
+
+
+def element_to_events(elem):
+    """Return the children of an element as a list of one-key dicts, in
+    order, or None if it has none.
+    """
+    events = [{child.tag: element_to_value(child)} for child in elem
+              if isinstance(child.tag, str)]
+    return events or None
+
+
+def study_to_dict(content, fields=VIEW_FIELDS):
+    """Parse the XML `content` of a study, returning a dict of the form
+    `{'clinical_study': {...}}` containing only the named top-level
+    `fields`.
+    """
+    study = {}
+    root = None
+    try:
+        # Only elements named in `fields` generate events; everything
+        # else is left to libxml2, and deleted below once a wanted
+        # element after it has ended
+        for _, elem in etree.iterparse(
+                BytesIO(content), events=('end',), tag=fields):
+            parent = elem.getparent()
+            if parent is None or parent.getparent() is not None:
+                # Not a direct child of `clinical_study`
+                continue
+            root = parent
+            if elem.tag in ORDERED_FIELDS:
+                value = element_to_events(elem)
+            else:
+                value = element_to_value(elem)
+            _push(study, elem.tag, value)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del root[0]
+    except etree.XMLSyntaxError as e:
+        raise ConversionError(str(e))
+    if root is None:
+        raise ConversionError("No study fields found")
+    return {root.tag: study}
+
+
+def study_to_json(content, fields=VIEW_FIELDS):
+    """Convert the XML `content` of a study to a line of JSON.
+    """
+    return json.dumps(study_to_dict(content, fields=fields))
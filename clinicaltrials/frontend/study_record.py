@@ -0,0 +1,270 @@
+"""The flat, typed record we write for each study.
+
+`view.sql` used to pull every field it needs out of each study's JSON
+with `JSON_EXTRACT`, and to parse the same dates with `PARSE_DATE` and
+`REGEXP_CONTAINS` several times over.  Instead, when converting the
+registry, we extract those fields once, here, parse the dates, and
+write each study as one line of JSON holding just those values, along
+with the converted study itself (as a string, in `json`) for ad-hoc
+queries.  BigQuery reads the lines as newline-delimited JSON with
+`SCHEMA`, so `view.sql` only ever reads plain, typed columns.
+
+The extraction follows the SQL it replaces, including its handling of
+missing values, so the results are the same.
+
+"""
+import calendar
+import datetime
+import functools
+import json
+import re
+
+
+# Bump this whenever `flatten()` changes, so that studies are
+# converted again rather than reused from the conversion manifest
+RECORD_VERSION = 3
+
+# The columns of each record, in the order `view.sql` used to extract
+# them
+SCHEMA = [
+    {'name': 'nct_id', 'type': 'STRING'},
+    {'name': 'study_type', 'type': 'STRING'},
+    {'name': 'study_status', 'type': 'STRING'},
+    {'name': 'phase', 'type': 'STRING'},
+    {'name': 'start_date', 'type': 'DATE'},
+    {'name': 'available_completion_date', 'type': 'DATE'},
+    {'name': 'used_primary_completion_date', 'type': 'INTEGER'},
+    {'name': 'primary_completion_date', 'type': 'DATE'},
+    {'name': 'defaulted_pcd_flag', 'type': 'INTEGER'},
+    {'name': 'completion_date', 'type': 'DATE'},
+    {'name': 'defaulted_cd_flag', 'type': 'INTEGER'},
+    {'name': 'primary_purpose', 'type': 'STRING'},
+    {'name': 'fda_reg_drug', 'type': 'STRING'},
+    {'name': 'fda_reg_device', 'type': 'STRING'},
+    {'name': 'exported', 'type': 'STRING'},
+    {'name': 'results_submitted_date', 'type': 'DATE'},
+    {'name': 'last_updated_date', 'type': 'DATE'},
+    {'name': 'pending_results', 'type': 'INTEGER'},
+    {'name': 'pending_data', 'type': 'STRING'},
+    {'name': 'has_results', 'type': 'INTEGER'},
+    {'name': 'certificate_date', 'type': 'DATE'},
+    {'name': 'location', 'type': 'STRING'},
+    {'name': 'sponsor', 'type': 'STRING'},
+    {'name': 'sponsor_type', 'type': 'STRING'},
+    {'name': 'collaborators', 'type': 'STRING'},
+    {'name': 'enrollment', 'type': 'STRING'},
+    {'name': 'title', 'type': 'STRING'},
+    {'name': 'official_title', 'type': 'STRING'},
+    {'name': 'brief_title', 'type': 'STRING'},
+    {'name': 'url', 'type': 'STRING'},
+    {'name': 'condition', 'type': 'STRING'},
+    {'name': 'condition_mesh', 'type': 'STRING'},
+    {'name': 'intervention', 'type': 'STRING'},
+    {'name': 'intervention_mesh', 'type': 'STRING'},
+    {'name': 'keywords', 'type': 'STRING'},
+    {'name': 'json', 'type': 'STRING'},
+]
+
+DATE_FIELDS = [
+    field['name'] for field in SCHEMA if field['type'] == 'DATE']
+
+DAY_PRECISION_RE = re.compile(r"\d,")
+
+
+def extract(study, *path):
+    """Follow `path` through nested dicts, like BigQuery's JSONPath, or
+    return None if it leads nowhere.
+    """
+    value = study
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def extract_scalar(study, *path):
+    """Like BigQuery's `JSON_EXTRACT_SCALAR`: None unless the value is a
+    string.
+    """
+    value = extract(study, *path)
+    return value if isinstance(value, str) else None
+
+
+def to_json(value):
+    """Like BigQuery's `JSON_EXTRACT`: the value serialised as compact
+    JSON.
+    """
+    if value is None:
+        return None
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def to_trimmed_json(value):
+    """`TRIM(JSON_EXTRACT(...), '"')`, i.e. strings are unquoted but
+    anything else is left as JSON.
+    """
+    value = to_json(value)
+    return value and value.strip('"')
+
+
+def add_months(d, months):
+    """Add calendar months, clamping to the end of shorter months, as
+    BigQuery's `DATE_ADD` does.
+    """
+    month = d.month - 1 + months
+    year = d.year + month // 12
+    month = month % 12 + 1
+    day = min(d.day, calendar.monthrange(year, month)[1])
+    return d.replace(year=year, month=month, day=day)
+
+
+def safe_parse_date(text, date_format):
+    """`SAFE.PARSE_DATE(date_format, text)`: `None` if `text` isn't a
+    date in `date_format`
+    """
+    try:
+        return datetime.datetime.strptime(text, date_format).date()
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def parse_full_date(text):
+    """`SAFE.PARSE_DATE("%B %e, %Y", text)`
+    """
+    if text is None:
+        return None
+    return safe_parse_date(text, "%B %d, %Y")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_registry_date(text):
+    """Parse a registry date, which is either a full date or just a
+    month; the latter is taken as the last day of that month.  Either
+    way, text which isn't a date gives `None`.
+    """
+    if text is None:
+        return None
+    if DAY_PRECISION_RE.search(text):
+        return parse_full_date(text)
+    start = safe_parse_date(text, "%B %Y")
+    if start is None:
+        return None
+    return add_months(start, 1) - datetime.timedelta(days=1)
+
+
+def has_day_precision(text):
+    return text is not None and bool(DAY_PRECISION_RE.search(text))
+
+
+def date_text(study, field):
+    """The text of a date element, which may or may not have a `type`
+    attribute.
+    """
+    return extract_scalar(study, field, 'text') or \
+        extract_scalar(study, field)
+
+
+def flatten(study):
+    """Extract the fields of a converted study (a dict of the form
+    `{'clinical_study': {...}}`) which `view.sql` uses.  Dates which
+    can't be parsed are left empty.
+    """
+    study = study.get('clinical_study')
+    phase = to_trimmed_json(extract(study, 'phase'))
+    start_date = parse_registry_date(date_text(study, 'start_date'))
+    pcd_text = extract_scalar(study, 'primary_completion_date', 'text')
+    primary_completion_date = parse_registry_date(pcd_text)
+    completion_date = parse_registry_date(
+        date_text(study, 'completion_date'))
+    # Only a primary completion date with a `type` is used
+    used_primary_completion_date = pcd_text is not None
+    if used_primary_completion_date:
+        available_completion_date = primary_completion_date
+    else:
+        available_completion_date = completion_date
+    cd_text = extract_scalar(study, 'completion_date', 'text')
+    cd_scalar = extract_scalar(study, 'completion_date')
+    results_first_submitted = extract_scalar(
+        study, 'results_first_submitted')
+    enrollment = extract(study, 'enrollment', 'text')
+    if enrollment is None:
+        enrollment = extract(study, 'enrollment')
+    official_title = to_trimmed_json(extract(study, 'official_title'))
+    brief_title = to_trimmed_json(extract(study, 'brief_title'))
+    return {
+        'nct_id': to_trimmed_json(extract(study, 'id_info', 'nct_id')),
+        'study_type': to_trimmed_json(extract(study, 'study_type')),
+        'study_status': to_trimmed_json(extract(study, 'overall_status')),
+        'phase': phase and phase.strip(),
+        'start_date': start_date,
+        'available_completion_date': available_completion_date,
+        'used_primary_completion_date': int(used_primary_completion_date),
+        'primary_completion_date': primary_completion_date,
+        'defaulted_pcd_flag': int(
+            pcd_text is not None and not has_day_precision(pcd_text)),
+        'completion_date': completion_date,
+        'defaulted_cd_flag': int(not (
+            has_day_precision(cd_text) or has_day_precision(cd_scalar)
+            or (cd_text is None and cd_scalar is None))),
+        'primary_purpose': to_trimmed_json(
+            extract(study, 'study_design_info', 'primary_purpose')),
+        'fda_reg_drug': to_trimmed_json(
+            extract(study, 'oversight_info', 'is_fda_regulated_drug')),
+        'fda_reg_device': to_trimmed_json(
+            extract(study, 'oversight_info', 'is_fda_regulated_device')),
+        'exported': to_trimmed_json(
+            extract(study, 'oversight_info', 'is_us_export')),
+        'results_submitted_date': parse_full_date(results_first_submitted),
+        'last_updated_date': parse_full_date(
+            extract_scalar(study, 'last_update_submitted')),
+        'pending_results': int(extract(study, 'pending_results') is not None),
+        'pending_data': to_trimmed_json(extract(study, 'pending_results')),
+        'has_results': int(results_first_submitted is not None),
+        'certificate_date': parse_full_date(
+            extract_scalar(study, 'disposition_first_submitted')),
+        'location': to_trimmed_json(extract(study, 'location_countries')),
+        'sponsor': to_trimmed_json(
+            extract(study, 'sponsors', 'lead_sponsor', 'agency')),
+        'sponsor_type': to_trimmed_json(
+            extract(study, 'sponsors', 'lead_sponsor', 'agency_class')),
+        'collaborators': to_trimmed_json(
+            extract(study, 'sponsors', 'collaborator')),
+        'enrollment': to_trimmed_json(enrollment),
+        'title': official_title if official_title is not None else brief_title,
+        'official_title': official_title,
+        'brief_title': brief_title,
+        'url': to_trimmed_json(extract(study, 'required_header', 'url')),
+        'condition': to_json(extract(study, 'condition')),
+        'condition_mesh': to_json(extract(study, 'condition_browse')),
+        'intervention': to_json(extract(study, 'intervention')),
+        'intervention_mesh': to_json(extract(study, 'intervention_browse')),
+        'keywords': to_json(extract(study, 'keyword')),
+    }
+
+
+def _default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def to_line(study):
+    """The line of JSON we write for a converted study
+    """
+    record = flatten(study)
+    record['json'] = json.dumps(study)
+    return json.dumps(record, default=_default)
+
+
+def from_line(line):
+    """The record from a line written by `to_line()`, with its dates
+    parsed
+    """
+    record = json.loads(line)
+    for name in DATE_FIELDS:
+        if record[name] is not None:
+            record[name] = datetime.datetime.strptime(
+                record[name], '%Y-%m-%d').date()
+    return record
@@ -0,0 +1,81 @@
+"""Compare `qa_table.parse_qa_table` with how `set_qa_metadata` used to
+parse the QA table, over the results page fixtures.
+
+Run from the `clinicaltrials` directory with:
+
+    python -m frontend.tests.benchmark_qa_table
+
+"""
+import glob
+import os
+import re
+import timeit
+
+import dateparser
+from lxml import html
+from lxml.etree import tostring
+
+from frontend import qa_table
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', '*.html')
+
+
+def _legacy_date(text):
+    parsed = text and dateparser.parse(text) or None
+    return parsed and parsed.date()
+
+
+def legacy_parse_qa_table(page):
+    """The parsing `set_qa_metadata` used to do: each row serialised
+    with `tostring()` and searched with a regex, and every date parsed
+    by `dateparser`
+    """
+    content = html.fromstring(page)
+    table = content.xpath("//table[.//th//text()[contains(., 'Submission Cycle')]]")
+    if not table:
+        return None
+    cycles = []
+    for row in table[0].xpath(".//tr"):
+        if len(row.xpath(".//td")) == 0:
+            continue
+        cancellations = []
+        cancelled = re.findall(
+            r"\n\s+([^<>]*)<br/>.*?cancell?ed.*? (?:-|on) (.*?)\)<br/>",
+            tostring(row).decode('utf8').replace("&#13;", ""),
+            re.I|re.DOTALL)
+        for submitted_date, cancelled_date in cancelled:
+            cancellations.append(qa_table.Cancellation(
+                _legacy_date(submitted_date),
+                None if "unknown" in cancelled_date.lower()
+                else _legacy_date(cancelled_date)))
+        submitted = [
+            x.strip()
+            for x in row.xpath(".//td[1]")[0].text_content().split("\n")
+            if x.strip()][-1]
+        if re.findall(r"cancell?ed", submitted, re.I):
+            cycles.append(qa_table.Cycle(cancellations, None))
+            continue
+        returned = row.xpath(".//td[2]")[0].text.strip()
+        cycles.append(qa_table.Cycle(cancellations, qa_table.Submission(
+            _legacy_date(submitted), _legacy_date(returned))))
+    return cycles
+
+
+def main(number=20):
+    pages = []
+    for path in sorted(glob.glob(FIXTURES)):
+        with open(path) as f:
+            pages.append(f.read())
+    for page in pages:
+        assert qa_table.parse_qa_table(page) == legacy_parse_qa_table(page)
+    for name, parse in [('legacy', legacy_parse_qa_table),
+                        ('qa_table', qa_table.parse_qa_table)]:
+        seconds = timeit.timeit(
+            lambda: [parse(page) for page in pages], number=number)
+        print("{:>10}: {:.2f} ms per page".format(
+            name, 1000 * seconds / (number * len(pages))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import gzip
+import io
+import itertools
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+from django.test import TestCase
+
+import bigquery
+
+
+class FakeBlob(object):
+    def __init__(self, name, text):
+        self.name = name
+        self.content = gzip.compress(text.encode('utf8'))
+
+    def download_to_file(self, f):
+        f.write(self.content)
+
+
+class FakeClient(object):
+    """Holds the jobs, which move on by a round each time we sleep
+    """
+    def __init__(self):
+        self.jobs = []
+        self.rounds = 0
+        self.list_calls = 0
+
+    def sleep(self, seconds):
+        self.rounds += 1
+
+    def list_jobs(self, state_filter=None):
+        self.list_calls += 1
+        if state_filter == 'pending':
+            return []
+        return [job for job in self.jobs if not job.finished()]
+
+
+class FakeJob(object):
+    def __init__(self, client, name, rounds_until_done, errors=None):
+        self._client = client
+        self.name = name
+        self.rounds_until_done = rounds_until_done
+        self.errors = errors
+        self.reloads = 0
+        self.state = 'RUNNING'
+        client.jobs.append(self)
+
+    def finished(self):
+        return self._client.rounds >= self.rounds_until_done
+
+    def reload(self):
+        self.reloads += 1
+        if self.finished():
+            self.state = 'DONE'
+
+
+class PollIntervalsTestCase(TestCase):
+    def test_poll_intervals_back_off(self):
+        intervals = list(itertools.islice(
+            bigquery.poll_intervals(initial_s=1, maximum_s=4, factor=2), 5))
+        self.assertEqual(intervals, [1, 2, 4, 4, 4])
+
+
+@patch('bigquery.poll_intervals', lambda: itertools.repeat(0))
+class WaitForJobsTestCase(TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        patcher = patch('bigquery.time.sleep', self.client.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_wait_for_jobs(self):
+        jobs = [
+            FakeJob(self.client, 'a', 0),
+            FakeJob(self.client, 'b', 2),
+            FakeJob(self.client, 'c', 1),
+        ]
+        bigquery.wait_for_jobs(jobs)
+        # Jobs are only reloaded once they have finished
+        self.assertEqual([job.reloads for job in jobs], [1, 1, 1])
+        # Two rounds of listing, then `b` is reloaded by itself
+        self.assertEqual(self.client.list_calls, 4)
+
+    def test_wait_for_job(self):
+        job = FakeJob(self.client, 'a', 2)
+        bigquery.wait_for_job(job)
+        self.assertEqual(job.reloads, 3)
+        self.assertEqual(self.client.list_calls, 0)
+
+    def test_wait_for_jobs_raises_errors(self):
+        jobs = [
+            FakeJob(self.client, 'a', 0),
+            FakeJob(self.client, 'b', 1, errors=[{'reason': 'x'}]),
+        ]
+        with self.assertRaises(bigquery.JobError):
+            bigquery.wait_for_jobs(jobs)
+        self.assertEqual(jobs[1].state, 'DONE')
+
+    def test_wait_for_jobs_times_out(self):
+        with self.assertRaises(bigquery.TimeoutError):
+            bigquery.wait_for_jobs(
+                [FakeJob(self.client, 'a', 10)], timeout_s=-1)
+
+
+class TableExporterTestCase(TestCase):
+    @patch('bigquery.StorageClient')
+    def test_download_from_storage_and_unzip(self, storage_client_mock):
+        blobs = [
+            FakeBlob('test_table-x-000000000001.csv.gz', 'a,b\n3,4\n5,6\n'),
+            FakeBlob('test_table-x-000000000000.csv.gz', 'a,b\n1,"2\r\n"\n'),
+            FakeBlob('test_table-x-000000000002.csv.gz', 'a,b\n'),
+        ]
+        bucket = storage_client_mock.return_value.bucket.return_value
+        bucket.list_blobs.return_value = blobs
+        exporter = bigquery.TableExporter(MagicMock(), 'test_table-x-')
+
+        f_out = io.StringIO(newline='')
+        exporter.download_from_storage_and_unzip(f_out)
+
+        bucket.list_blobs.assert_called_once_with(prefix='test_table-x-')
+        self.assertEqual(f_out.getvalue(), 'a,b\n1,"2\r\n"\n3,4\n5,6\n')
+
+    @patch('bigquery.gcbq.Client')
+    @patch('bigquery.StorageClient', MagicMock())
+    def test_accepts_raw_table(self, gcbq_client_mock):
+        raw_table = MagicMock()
+        exporter = bigquery.TableExporter(raw_table, 'test_table-x-')
+        self.assertIsInstance(exporter.table, bigquery.Table)
+        exporter._begin_export_to_storage({'job_name': 'job'})
+        gcbq_client_mock.return_value.extract_table_to_storage \
+            .assert_called_once_with(
+                'job', raw_table, 'gs://ebmdatalab/test_table-x-*.csv.gz')
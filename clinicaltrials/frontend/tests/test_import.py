@@ -1,23 +1,36 @@
 from datetime import date
 from datetime import timedelta
 from unittest import mock
+import csv
+import json
 import os
+import shutil
+import tempfile
 
 from django.conf import settings
 from django.core.management import call_command
 from django.test import TestCase
+from django.utils.text import slugify
+import pyarrow as pa
 
+from frontend import intermediate
 from frontend.models import Ranking
+from frontend.models import Sponsor
 from frontend.models import Trial
+from frontend.models import TrialQA
 
 from frontend.trial_computer import qa_start_dates
 from frontend.management.commands.process_data import EARLIEST_CANCELLATION_DATE
+from frontend.management.commands.process_data import SponsorResolver
+from frontend.tests.test_qa_table import PENDING_DATA
 
 
 class DummyResponse(object):
     def __init__(self, content):
-        self.content = content
-        self.text = str(content)
+        self.status_code = 200
+        self.headers = {}
+        self.content = content.encode('utf-8')
+        self.text = content
 
 
 def mock_ccgov_results(fixture_id):
@@ -31,7 +44,7 @@ def mock_ccgov_results(fixture_id):
 
 
 
-def ccgov_results_by_url(url):
+def ccgov_results_by_url(url, **kwargs):
     fixture_id = url.split('/')[-1]
     return mock_ccgov_results(fixture_id)
 
@@ -42,7 +55,7 @@ class CommandsTestCase(TestCase):
         self.yesterday = self.today - timedelta(days=1)
         self.last_year = self.today - timedelta(days=366)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     def test_import(self, datetime_mock):
         "Does a simple import create expected rankings and sponsors?"
@@ -86,7 +99,111 @@ class CommandsTestCase(TestCase):
         self.assertEqual(Ranking.objects.count(), 3)
 
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('frontend.trial_computer.date')
+    def test_import_arrow(self, datetime_mock):
+        "Does importing the typed Arrow file give the same trials as the CSV?"
+        datetime_mock.today = mock.Mock(return_value=self.today)
+        sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv')
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        sample_arrow = os.path.join(tmp, 'sample_bq.arrow')
+        self.assertEqual(intermediate.csv_to_arrow(sample_csv, sample_arrow), 6)
+
+        report_path = os.path.join(tmp, 'report.json')
+        call_command(
+            'process_data', input_arrow=sample_arrow, run_report=report_path)
+
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(
+            [stage['name'] for stage in report['stages']],
+            ['import', 'scrape_qa', 'zombies', 'rankings'])
+        self.assertEqual(report['stages'][0]['rows'], 6)
+
+        overdue = Trial.objects.get(registry_id='overdue')
+        self.assertEqual(overdue.status, 'overdue')
+        self.assertEqual(overdue.days_late, 61)
+        self.assertEqual(overdue.completion_date, date(2016, 11, 1))
+        overdueinqa = Trial.objects.get(registry_id='overdueinqa')
+        self.assertEqual(overdueinqa.status, 'reported-late')
+        self.assertTrue(overdueinqa.results_due)
+        self.assertFalse(overdueinqa.has_exemption)
+
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('frontend.trial_computer.date')
+    def test_import_arrow_with_empty_flags(self, datetime_mock):
+        "Are empty flags in the Arrow file imported as False?"
+        datetime_mock.today = mock.Mock(return_value=self.today)
+        sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv')
+        with open(sample_csv) as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            row['has_certificate'] = ''
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        empty_csv = os.path.join(tmp, 'empty_flags.csv')
+        with open(empty_csv, 'w') as f:
+            writer = csv.DictWriter(f, list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        empty_arrow = os.path.join(tmp, 'empty_flags.arrow')
+        intermediate.csv_to_arrow(empty_csv, empty_arrow)
+        self.assertEqual(
+            {row['has_certificate']
+             for row in intermediate.read_rows(empty_arrow)},
+            {False})
+
+        call_command('process_data', input_arrow=empty_arrow)
+        self.assertEqual(Trial.objects.count(), 6)
+        self.assertFalse(
+            Trial.objects.filter(has_exemption=True).exists())
+
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('frontend.trial_computer.date')
+    @mock.patch('frontend.management.commands.process_data.date')
+    def test_bulk_import(self, mock_date_1, mock_date_2):
+        "Does a bulk import give the same trials and sponsors as row by row?"
+        mock_date_1.today = mock.Mock(return_value=self.today)
+        mock_date_2.today = mock.Mock(return_value=self.today)
+        sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq.csv')
+
+        def imported():
+            trials = list(Trial.objects.order_by('registry_id').values())
+            for trial in trials:
+                del trial['id']
+            return (trials,
+                    list(Sponsor.objects.order_by('slug').values()),
+                    list(Ranking.objects.order_by('sponsor', 'date').values(
+                        'sponsor', 'date', 'rank', 'due', 'days_late')))
+
+        call_command('process_data', input_csv=sample_csv)
+        expected = imported()
+        Ranking.objects.all().delete()
+        Trial.objects.all().delete()
+        Sponsor.objects.all().delete()
+        call_command('process_data', input_csv=sample_csv, bulk=True)
+        self.assertEqual(imported(), expected)
+        Ranking.objects.all().delete()
+        Trial.objects.all().delete()
+        Sponsor.objects.all().delete()
+        call_command('process_data', input_csv=sample_csv, bulk=True,
+                     metadata='sql')
+        self.assertEqual(imported(), expected)
+
+        # Import again the next day
+        tomorrow = self.today + timedelta(days=1)
+        mock_date_1.today = mock.Mock(return_value=tomorrow)
+        mock_date_2.today = mock.Mock(return_value=tomorrow)
+        call_command('process_data', input_csv=sample_csv, bulk=True)
+        overdue = Trial.objects.get(registry_id='overdue')
+        self.assertEqual(overdue.days_late, 62)
+        self.assertEqual(overdue.previous_status, 'overdue')
+        self.assertEqual(overdue.updated_date, tomorrow)
+        self.assertEqual(overdue.first_seen_date, self.today)
+        self.assertEqual(overdue.sponsor.updated_date, tomorrow)
+
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     @mock.patch('frontend.management.commands.process_data.date')
     def test_second_import(self, mock_date_1, mock_date_2):
@@ -120,7 +237,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(overdue.updated_date, tomorrow)
         self.assertEqual(overdue.first_seen_date, self.today)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.models.date')
     def test_second_import_with_disappeared_trials(self, datetime_mock):
         """Is the disappearance of a trial from the CSV reflected in our
@@ -144,7 +261,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(Trial.objects.visible().count(), 0)
         self.assertNotEqual(Trial.objects.first().updated_date, self.last_year)
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.models.date')
     def test_third_import_with_reappearing_trials(self, datetime_mock):
         """Is the disappearance of a trial from the CSV reflected in our
@@ -172,7 +289,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(overdue.status, 'overdue')
         self.assertEqual(overdue.previous_status, 'no-longer-act')
 
-    @mock.patch('requests.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
     @mock.patch('frontend.trial_computer.date')
     def test_qa(self, datetime_mock):
         "Does a simple import create expected rankings and sponsors?"
@@ -247,7 +364,99 @@ class CommandsTestCase(TestCase):
         self.assertEqual(qa[2].submitted_to_regulator, date(2018, 5, 17))
 
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
+    @mock.patch('frontend.trial_computer.date')
+    def test_qa_from_registry(self, datetime_mock, requests_mock):
+        "Is QA read from pending results the same as from results pages?"
+        datetime_mock.today = mock.Mock(return_value=self.today)
+        requests_mock.side_effect = ccgov_results_by_url
+        sample_csv = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq_qa.csv')
+        with open(sample_csv) as f:
+            rows = list(csv.DictReader(f))
+        pending = dict(PENDING_DATA)
+        # Present but empty, which tells us nothing
+        pending['overdueinqa_uncancelled'] = None
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        pending_csv = os.path.join(tmp, 'pending.csv')
+        with open(pending_csv, 'w') as f:
+            writer = csv.DictWriter(
+                f, list(rows[0]) + ['pending_results', 'pending_data'])
+            writer.writeheader()
+            for row in rows:
+                events = pending[row['nct_id']]
+                row['pending_results'] = int(events is not None)
+                row['pending_data'] = json.dumps(events) if events else ''
+                writer.writerow(row)
+        pending_arrow = os.path.join(tmp, 'pending.arrow')
+        intermediate.csv_to_arrow(pending_csv, pending_arrow)
+
+        def all_qa():
+            return [
+                (qa.trial.registry_id, qa.submitted_to_regulator,
+                 qa.returned_to_sponsor, qa.cancelled_by_sponsor,
+                 qa.cancellation_date_inferred)
+                for qa in TrialQA.objects.order_by(
+                    'trial__registry_id', 'submitted_to_regulator')]
+
+        report_path = os.path.join(tmp, 'report.json')
+        call_command('process_data', input_arrow=pending_arrow,
+                     qa_source='registry', run_report=report_path)
+        # Only the trial without pending results is scraped
+        self.assertEqual(
+            [call[0][0] for call in requests_mock.call_args_list],
+            [settings.RESULTS_PAGE_URL.format('overdueinqa_uncancelled')])
+        with open(report_path) as f:
+            report = json.load(f)
+        scrape_qa = report['stages'][1]
+        self.assertEqual(scrape_qa['rows'], 6)
+        self.assertEqual(scrape_qa['from_registry'], 5)
+        from_registry = all_qa()
+
+        TrialQA.objects.all().delete()
+        call_command('process_data', input_csv=sample_csv)
+        self.assertEqual(from_registry, all_qa())
+
+    @mock.patch('requests.Session.get', mock.Mock(side_effect=ccgov_results_by_url))
+    @mock.patch('frontend.trial_computer.date')
+    def test_qa_from_registry_keeps_history_without_pending_results(
+            self, datetime_mock):
+        "Does a trial with empty pending results keep its QA history?"
+        datetime_mock.today = mock.Mock(return_value=self.today)
+        sample_csv = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/sample_bq_qa.csv')
+        call_command('process_data', input_csv=sample_csv)
+        self.assertEqual(Trial.objects.get(
+            registry_id='overdueinqa').trialqa_set.count(), 3)
+
+        with open(sample_csv) as f:
+            rows = list(csv.DictReader(f))
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        empty_csv = os.path.join(tmp, 'empty_pending.csv')
+        with open(empty_csv, 'w') as f:
+            writer = csv.DictWriter(
+                f, list(rows[0]) + ['pending_results', 'pending_data'])
+            writer.writeheader()
+            for row in rows:
+                row['pending_results'] = 0
+                row['pending_data'] = ''
+                writer.writerow(row)
+        with mock.patch(
+                'frontend.management.commands.process_data'
+                '.scrape_qa_metadata') as scrape_mock:
+            scrape_mock.return_value = {}
+            call_command(
+                'process_data', input_csv=empty_csv, qa_source='registry')
+        # Every trial is left to the scraper, rather than cleared
+        self.assertEqual(
+            sorted(trial.registry_id for trial in scrape_mock.call_args[0][0]),
+            sorted(row['nct_id'] for row in rows))
+        self.assertEqual(Trial.objects.get(
+            registry_id='overdueinqa').trialqa_set.count(), 3)
+
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     def test_import_twice(self, datetime_mock, requests_mock):
         "Is importing idempotent?"
@@ -256,12 +465,12 @@ class CommandsTestCase(TestCase):
         sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
+        def month_1_results(url, **kwargs):
             return mock_ccgov_results('overdueinqa_month_1')
         requests_mock.side_effect = month_1_results
         call_command('process_data', *args, **opts)
 
-        def month_2_results(arg):
+        def month_2_results(url, **kwargs):
             return mock_ccgov_results('overdueinqa_month_2')
         requests_mock.side_effect = month_2_results
         call_command('process_data', *args, **opts)
@@ -272,7 +481,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(qa[0].submitted_to_regulator, date(2017, 11, 13))
         self.assertEqual(qa[0].returned_to_sponsor, date(2017, 12, 11))
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     @mock.patch('frontend.models.date')
     def test_import_and_qa(self, date_mock_1, date_mock_2, requests_mock):
@@ -285,7 +494,7 @@ class CommandsTestCase(TestCase):
         sample_csv = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
+        def month_1_results(url, **kwargs):
             # However, the QA means it's not overdue after all - Nov 13 2017
             return mock_ccgov_results('nolongeroverdueinqa')
         requests_mock.side_effect = month_1_results
@@ -296,7 +505,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(trial.previous_status, 'ongoing')
 
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.get')
     @mock.patch('frontend.trial_computer.date')
     def test_import_with_disappearing_qa(self, datetime_mock, requests_mock):
         "If QA table disappears, trial should revert to overdue"
@@ -306,7 +515,7 @@ class CommandsTestCase(TestCase):
             settings.BASE_DIR, 'frontend/tests/fixtures/two_months_qa.csv')
         opts = {'input_csv': sample_csv}
 
-        def month_1_results(arg):
+        def month_1_results(url, **kwargs):
             return mock_ccgov_results('overdueinqa_month_1')
         requests_mock.side_effect = month_1_results
         call_command('process_data', *args, **opts)
@@ -317,7 +526,7 @@ class CommandsTestCase(TestCase):
         self.assertEqual(trial.status, Trial.STATUS_REPORTED_LATE)
         self.assertEqual(trial.trialqa_set.count(), 1)
 
-        def month_2_results(arg):
+        def month_2_results(url, **kwargs):
             return mock_ccgov_results('no_qa')
         requests_mock.side_effect = month_2_results
         call_command('process_data', *args, **opts)
@@ -326,3 +535,51 @@ class CommandsTestCase(TestCase):
         qa_count = trial.trialqa_set.count()
         self.assertEqual(qa_count, 0)
         self.assertEqual(trial.status, Trial.STATUS_OVERDUE)
+
+
+class IntermediateTestCase(TestCase):
+    def test_arrow_schema_is_fixed(self):
+        expected_csv = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/expected_trials_data.csv')
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        arrow_path = os.path.join(tmp, 'expected.arrow')
+        intermediate.csv_to_arrow(expected_csv, arrow_path)
+        with pa.memory_map(arrow_path) as source:
+            schema = pa.ipc.open_file(source).schema
+        self.assertTrue(schema.equals(intermediate.SCHEMA), schema)
+        row = next(intermediate.read_rows(arrow_path))
+        # Not inferred as a number, or as null when the column is empty
+        self.assertIsInstance(row['enrollment'], str)
+        self.assertEqual(row['exported'], '')
+
+
+class SponsorResolverTestCase(TestCase):
+    def test_writes_each_sponsor_once(self):
+        Sponsor.objects.create(
+            name='Old Sponsor', is_industry_sponsor=False,
+            updated_date=date(2017, 1, 1))
+        resolver = SponsorResolver(date(2018, 1, 1))
+        with mock.patch(
+                'frontend.management.commands.process_data.slugify',
+                side_effect=slugify) as slugify_mock:
+            for _ in range(100):
+                self.assertEqual(
+                    resolver.resolve('Old Sponsor', False), 'old-sponsor')
+            self.assertEqual(resolver.resolve('New Sponsor', False),
+                             'new-sponsor')
+            self.assertEqual(resolver.resolve('new sponsor', True),
+                             'new-sponsor')
+            resolver.resolve('Old Sponsor', True)
+        self.assertEqual(slugify_mock.call_count, 3)
+
+        # Find existing sponsors, create new ones, and update the
+        # existing (industry) one
+        with self.assertNumQueries(3):
+            resolver.save()
+        old = Sponsor.objects.get(pk='old-sponsor')
+        self.assertTrue(old.is_industry_sponsor)
+        self.assertEqual(old.updated_date, date(2018, 1, 1))
+        new = Sponsor.objects.get(pk='new-sponsor')
+        self.assertEqual(new.name, 'New Sponsor')
+        self.assertTrue(new.is_industry_sponsor)
@@ -1,30 +1,113 @@
 """Integration test for load_data.py script
 """
+import contextlib
 import csv
+import datetime
+import gzip
+import http.server
+import json
 import os
 import shutil
 import tempfile
+import threading
 from datetime import date
+from datetime import timedelta
 from unittest import mock
 from django.conf import settings
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
 from unittest.mock import patch
 import pathlib
 
+from frontend import downloader
+from frontend import study_record
+from frontend.snapshot_archive import SnapshotArchive
+from frontend.management.commands.load_data import UPLOAD_RETENTION_DAYS
+from frontend.management.commands.load_data import archive_path
+from frontend.management.commands.load_data import convert_and_download
+from frontend.management.commands.load_data import convert_and_upload
+from frontend.management.commands.load_data import convert_locally
+from frontend.management.commands.load_data import convert_to_json
+from frontend.management.commands.load_data import delete_old_uploads
+from frontend.management.commands.load_data import raw_json_name
+from frontend.management.commands.load_data import raw_json_paths
+from frontend.management.commands.load_data import raw_json_storage_path
+from frontend.management.commands.load_data import registry_zip_path
+from frontend.management.commands.load_data import run_report_path
+from frontend.management.commands.load_data import stage_marker_dir
+
+
+def stage_marker_path(name):
+    return os.path.join(stage_marker_dir(), name + '.json')
+
 
 CMD_ROOT = 'frontend.management.commands.load_data'
 
+FIXTURE_ZIP = os.path.join(
+    settings.BASE_DIR, 'frontend/tests/fixtures/data.zip')
+
+
+class RegistryHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in for ClinicalTrials.gov, which serves `body` with an ETag
+    and supports conditional and Range requests.
+    """
+    body = b''
+    etag = '"v1"'
+    truncate_next_response = False
+    requests_seen = []
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests_seen.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == cls.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if self.headers.get('Range') \
+           and self.headers.get('If-Range') == cls.etag:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(cls.body) - 1, len(cls.body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', cls.etag)
+        self.send_header('Content-Length', str(len(cls.body) - start))
+        self.end_headers()
+        content = cls.body[start:]
+        if cls.truncate_next_response:
+            # Simulate a dropped connection
+            cls.truncate_next_response = False
+            content = content[:len(content) // 2]
+        self.wfile.write(content)
 
-def wget_copy_fixture(data_file, url):
-    test_zip = os.path.join(
-        settings.BASE_DIR, 'frontend/tests/fixtures/data.zip')
-    shutil.copy(test_zip, data_file)
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def registry_server(body):
+    with open(body, 'rb') as f:
+        RegistryHandler.body = f.read()
+    RegistryHandler.etag = '"v1"'
+    RegistryHandler.truncate_next_response = False
+    RegistryHandler.requests_seen = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), RegistryHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/AllPublicXML.zip'.format(
+            server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
 
 
 class LoadTestCase(TestCase):
-    @patch(CMD_ROOT + '.wget_file', side_effect=wget_copy_fixture)
     @patch(CMD_ROOT + '.notify_slack')
     @patch(CMD_ROOT + '.process_data')
     @override_settings(
@@ -35,15 +118,21 @@ class LoadTestCase(TestCase):
         PROCESSING_STORAGE_TABLE_NAME='current_raw_json_test',
         WORKING_VOLUME=os.path.join(tempfile.gettempdir(), 'fdaaa_data'),
         WORKING_DIR=os.path.join(tempfile.gettempdir(), 'fdaaa_data', 'work'),
-        INTERMEDIATE_CSV_PATH=os.path.join(tempfile.gettempdir(), 'clinical_trials.csv')
+        INTERMEDIATE_CSV_PATH=os.path.join(tempfile.gettempdir(), 'clinical_trials.csv'),
+        INTERMEDIATE_ARROW_PATH=os.path.join(tempfile.gettempdir(), 'clinical_trials.arrow')
     )
-    def test_produces_csv(self, process_mock, slack_mock, wget_file_mock):
+    def test_produces_csv(self, process_mock, slack_mock):
         fdaaa_web_data = os.path.join(tempfile.gettempdir(), 'fdaaa_data')
         pathlib.Path(fdaaa_web_data).mkdir(exist_ok=True)
+        for path in [registry_zip_path(), registry_zip_path() + '.meta.json']:
+            with contextlib.suppress(OSError):
+                os.remove(path)
 
         args = []
         opts = {}
-        call_command('load_data', *args, **opts)
+        with registry_server(FIXTURE_ZIP) as url:
+            with self.settings(REGISTRY_URL=url):
+                call_command('load_data', *args, **opts)
         expected_csv = os.path.join(
             settings.BASE_DIR, 'frontend/tests/fixtures/expected_trials_data.csv')
         with open(settings.INTERMEDIATE_CSV_PATH) as output_file:
@@ -51,3 +140,274 @@ class LoadTestCase(TestCase):
                 results = sorted(list(csv.reader(output_file)))
                 expected = sorted(list(csv.reader(expected_file)))
                 self.assertEqual(results, expected)
+
+
+@override_settings(
+    WORKING_VOLUME=os.path.join(tempfile.gettempdir(), 'fdaaa_convert'),
+    WORKING_DIR=os.path.join(tempfile.gettempdir(), 'fdaaa_convert', 'work')
+)
+class ConvertTestCase(TestCase):
+    def setUp(self):
+        pathlib.Path(settings.WORKING_DIR).mkdir(parents=True, exist_ok=True)
+        shutil.copy(FIXTURE_ZIP, registry_zip_path())
+
+    def tearDown(self):
+        shutil.rmtree(settings.WORKING_VOLUME)
+
+    def _converted(self, **kwargs):
+        convert_to_json(**kwargs)
+        with open(os.path.join(settings.WORKING_DIR, raw_json_name())) as f:
+            return f.read()
+
+    def test_streams_from_zip(self):
+        lines = self._converted().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertIn('"nct_id": "NCT01275365"', lines[0])
+
+    def test_parallel_conversion_is_ordered(self):
+        serial = self._converted()
+        self.assertEqual(self._converted(workers=3), serial)
+        self.assertEqual(
+            [x for x in os.listdir(settings.WORKING_DIR) if '.part' in x], [])
+
+    def test_sharded_output_is_gzipped(self):
+        serial = self._converted()
+        os.remove(os.path.join(settings.WORKING_DIR, raw_json_name()))
+        convert_to_json(workers=2, shards=3)
+        paths = raw_json_paths()
+        self.assertEqual(len(paths), 3)
+        content = ''
+        for path in paths:
+            with gzip.open(path, 'rt') as f:
+                content += f.read()
+        self.assertEqual(content, serial)
+        self.assertTrue(raw_json_storage_path().endswith('-*.gz'))
+
+    @patch(CMD_ROOT + '.UPLOAD_QUEUE_SIZE', 1)
+    @patch(CMD_ROOT + '.delete_old_uploads')
+    @patch(CMD_ROOT + '.delete_uploaded_shards')
+    @patch(CMD_ROOT + '.upload_shard')
+    def test_pipelined_conversion_uploads_every_shard(self, upload_mock, *_):
+        serial = self._converted()
+        os.remove(os.path.join(settings.WORKING_DIR, raw_json_name()))
+        convert_and_upload(4, workers=2)
+        paths = raw_json_paths()
+        self.assertEqual(len(paths), 4)
+        self.assertEqual(
+            sorted(c[0][0] for c in upload_mock.call_args_list), paths)
+        content = ''
+        for path in paths:
+            with gzip.open(path, 'rt') as f:
+                content += f.read()
+        self.assertEqual(content, serial)
+
+    @patch(CMD_ROOT + '.delete_old_uploads')
+    @patch(CMD_ROOT + '.delete_uploaded_shards')
+    @patch(CMD_ROOT + '.upload_shard', side_effect=RuntimeError("Boom"))
+    def test_pipelined_upload_failure_is_raised(self, upload_mock, *_):
+        with self.assertRaises(RuntimeError):
+            convert_and_upload(3)
+
+    def test_unchanged_studies_are_not_reconverted(self):
+        first = self._converted()
+        with patch.dict(
+                'frontend.management.commands.load_data.CONVERTERS',
+                {'iterparse': mock.Mock(side_effect=AssertionError)}):
+            self.assertEqual(self._converted(), first)
+            self.assertEqual(self._converted(workers=2), first)
+
+    def test_reconvert_ignores_manifest(self):
+        first = self._converted()
+        study = {'clinical_study': {'id_info': {'nct_id': 'NCT0'}}}
+        with patch.dict(
+                'frontend.management.commands.load_data.CONVERTERS',
+                {'iterparse': mock.Mock(return_value=study)}):
+            self.assertEqual(
+                self._converted(use_manifest=False),
+                (study_record.to_line(study) + "\n") * 5)
+        self.assertEqual(self._converted(), first)
+
+    def test_study_with_bad_date_is_kept(self):
+        study = {'clinical_study': {
+            'id_info': {'nct_id': 'NCT0'}, 'start_date': 'Sometime'}}
+        with patch.dict(
+                'frontend.management.commands.load_data.CONVERTERS',
+                {'iterparse': mock.Mock(return_value=study)}):
+            lines = self._converted(use_manifest=False).splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertIsNone(study_record.from_line(lines[0])['start_date'])
+
+
+@override_settings(
+    WORKING_VOLUME=os.path.join(tempfile.gettempdir(), 'fdaaa_stages'),
+    WORKING_DIR=os.path.join(tempfile.gettempdir(), 'fdaaa_stages', 'work'),
+    INTERMEDIATE_CSV_PATH=os.path.join(
+        tempfile.gettempdir(), 'fdaaa_stages', 'work', 'clinical_trials.csv'),
+    INTERMEDIATE_ARROW_PATH=os.path.join(
+        tempfile.gettempdir(), 'fdaaa_stages', 'work', 'clinical_trials.arrow'),
+    FDA_REGULATION_SNAPSHOT_PATH=os.path.join(
+        settings.BASE_DIR,
+        'frontend/tests/fixtures/jan17_fda_regulation_snapshot.csv'),
+)
+@patch(CMD_ROOT + '.notify_slack')
+@patch(CMD_ROOT + '.process_data')
+class StagedLoadTestCase(TestCase):
+    def setUp(self):
+        pathlib.Path(settings.WORKING_VOLUME).mkdir(exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(settings.WORKING_VOLUME)
+
+    def _load(self, url, **opts):
+        with patch(CMD_ROOT + '.convert_locally',
+                   side_effect=convert_locally) as query_mock:
+            with self.settings(REGISTRY_URL=url):
+                call_command('load_data', engine='local', **opts)
+        return query_mock.called
+
+    def test_reruns_only_what_is_needed(self, process_mock, slack_mock):
+        with registry_server(FIXTURE_ZIP) as url:
+            self.assertTrue(self._load(url))
+            self.assertEqual(process_mock.call_count, 1)
+
+            # Registry unchanged, and every stage up to date
+            self.assertFalse(self._load(url))
+            self.assertEqual(process_mock.call_count, 1)
+            self.assertIn('skipped', slack_mock.call_args[0][0])
+
+            # The last run failed after writing the CSV
+            os.remove(stage_marker_path('process'))
+            self.assertFalse(self._load(url))
+            self.assertEqual(process_mock.call_count, 2)
+
+            self.assertTrue(self._load(url, from_stage='query'))
+            self.assertEqual(process_mock.call_count, 3)
+
+            self.assertTrue(self._load(url, only_stage='query'))
+            self.assertEqual(process_mock.call_count, 3)
+
+            with self.assertRaises(CommandError):
+                self._load(url, only_stage='upload')
+
+    def test_unchanged_registry_is_skipped_the_next_day(
+            self, process_mock, slack_mock):
+        with registry_server(FIXTURE_ZIP) as url:
+            self.assertTrue(self._load(url))
+            with patch(CMD_ROOT + '.datetime', wraps=datetime) as dt_mock:
+                dt_mock.date.today.return_value = \
+                    date.today() + timedelta(days=1)
+                dt_mock.datetime.now.return_value = \
+                    datetime.datetime.now() + timedelta(days=1)
+                self.assertFalse(self._load(url))
+        self.assertEqual(process_mock.call_count, 1)
+        self.assertIn('skipped', slack_mock.call_args[0][0])
+
+    def test_writes_run_report(self, process_mock, slack_mock):
+        with registry_server(FIXTURE_ZIP) as url:
+            self._load(url)
+        with open(run_report_path()) as f:
+            report = json.load(f)
+        self.assertEqual(
+            [stage['name'] for stage in report['stages']],
+            ['download', 'convert', 'query', 'process'])
+        self.assertEqual(report['stages'][1]['studies'], 5)
+        self.assertEqual(report['stages'][2]['rows'], 5)
+        self.assertIn('load_data run report', slack_mock.call_args[0][0])
+
+    def test_archives_registry(self, process_mock, slack_mock):
+        with registry_server(FIXTURE_ZIP) as url:
+            self._load(url, archive=True)
+        archive = SnapshotArchive(archive_path())
+        today = date.today().isoformat()
+        self.assertEqual(archive.days(), [today])
+        self.assertEqual(len(archive.index(today)), 5)
+        archive.close()
+
+
+class DeleteOldUploadsTestCase(TestCase):
+    @patch(CMD_ROOT + '.StorageClient')
+    def test_deletes_only_expired_uploads(self, client_mock):
+        today = date.today()
+        names = [
+            'clinicaltrials/raw_clincialtrials_json_{}.csv'.format(
+                today - timedelta(days=days)) + suffix
+            for days, suffix in [
+                (0, ''), (UPLOAD_RETENTION_DAYS, '-0001.gz'),
+                (UPLOAD_RETENTION_DAYS + 1, ''),
+                (UPLOAD_RETENTION_DAYS + 1, '-0001.gz')]]
+        blobs = [mock.Mock() for name in names]
+        for blob, name in zip(blobs, names):
+            # `name` is special to Mock's constructor
+            blob.name = name
+        client_mock.return_value.get_bucket.return_value \
+            .list_blobs.return_value = blobs
+        delete_old_uploads()
+        self.assertEqual(
+            [blob.delete.called for blob in blobs],
+            [False, False, True, True])
+
+
+class ConvertAndDownloadTestCase(TestCase):
+    @patch(CMD_ROOT + '.raw_json_storage_path', mock.Mock(return_value='x'))
+    @patch(CMD_ROOT + '.warehouse_client', mock.Mock())
+    @patch(CMD_ROOT + '.get_client')
+    def test_query_results_are_deleted_after_failure(self, client_mock):
+        tmp_table = client_mock.return_value.get_table.return_value
+        tmp_table.exporter.return_value.export_to_storage.side_effect = \
+            RuntimeError("export failed")
+        with self.assertRaises(RuntimeError):
+            convert_and_download()
+        client_mock.assert_called_once_with('tmp_eu')
+        self.assertTrue(tmp_table.delete.called)
+
+
+class DownloadTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp, 'AllPublicXML.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _assert_downloaded(self):
+        with open(self.target, 'rb') as f1, open(FIXTURE_ZIP, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def test_unchanged_source_is_not_downloaded_again(self):
+        with registry_server(FIXTURE_ZIP) as url:
+            self.assertEqual(
+                downloader.fetch(url, self.target), downloader.DOWNLOADED)
+            self._assert_downloaded()
+            with patch('frontend.downloader.logger') as logger_mock:
+                self.assertEqual(
+                    downloader.fetch(url, self.target), downloader.UNCHANGED)
+            # We don't claim to be downloading
+            self.assertFalse(logger_mock.info.called)
+            self.assertEqual(
+                RegistryHandler.requests_seen[-1]['If-None-Match'], '"v1"')
+
+            RegistryHandler.etag = '"v2"'
+            self.assertEqual(
+                downloader.fetch(url, self.target), downloader.DOWNLOADED)
+
+    @patch('frontend.downloader.CHUNK_SIZE', 1024)
+    def test_dropped_connection_is_resumed(self):
+        with registry_server(FIXTURE_ZIP) as url:
+            RegistryHandler.truncate_next_response = True
+            self.assertEqual(
+                downloader.fetch(url, self.target, backoff=0),
+                downloader.DOWNLOADED)
+            self._assert_downloaded()
+            self.assertEqual(len(RegistryHandler.requests_seen), 2)
+            self.assertTrue(
+                RegistryHandler.requests_seen[1]['Range'].startswith('bytes='))
+            self.assertFalse(os.path.exists(self.target + '.partial'))
+
+    def test_corrupt_download_is_rejected(self):
+        not_a_zip = os.path.join(
+            settings.BASE_DIR, 'frontend/tests/fixtures/no_qa.html')
+        with registry_server(not_a_zip) as url:
+            with self.assertRaises(downloader.DownloadError):
+                downloader.fetch(url, self.target)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(self.target + '.partial'))
@@ -0,0 +1,99 @@
+import csv
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.test import TestCase
+
+from frontend import local_view
+from frontend import study_record
+from frontend.study_converter import study_to_dict
+from frontend.tests.test_study_converter import fixture_studies
+
+
+FIXTURES = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+
+# The date the fixtures were downloaded, and `expected_trials_data.csv`
+# generated
+FIXTURE_DATE = datetime.date(2018, 3, 12)
+
+
+def study(**fields):
+    fields.setdefault('id_info', {'nct_id': 'NCT00000001'})
+    fields.setdefault('study_type', 'Interventional')
+    fields.setdefault('overall_status', 'Completed')
+    fields.setdefault('phase', 'Phase 2')
+    fields.setdefault('oversight_info', {'is_fda_regulated_drug': 'Yes'})
+    return {'clinical_study': fields}
+
+
+class LocalViewTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_matches_bigquery_output(self):
+        json_path = os.path.join(self.tmp, 'data.json')
+        csv_path = os.path.join(self.tmp, 'clinical_trials.csv')
+        with open(json_path, 'w') as f:
+            for _, content in fixture_studies():
+                f.write(study_record.to_line(study_to_dict(content)) + "\n")
+        snapshot = local_view.read_fda_regulation_snapshot(
+            os.path.join(FIXTURES, 'jan17_fda_regulation_snapshot.csv'))
+
+        written = local_view.write_csv(
+            [json_path], csv_path, snapshot, FIXTURE_DATE)
+
+        self.assertEqual(written, 5)
+        with open(csv_path) as f:
+            results = list(csv.reader(f))
+        with open(os.path.join(FIXTURES, 'expected_trials_data.csv')) as f:
+            expected = list(csv.reader(f))
+        self.assertEqual(results[0], expected[0])
+        self.assertEqual(sorted(results[1:]), sorted(expected[1:]))
+
+    def test_month_only_dates_are_end_of_month(self):
+        row = local_view.classify(
+            study(start_date='January 2017',
+                  primary_completion_date={
+                      'type': 'Anticipated', 'text': 'February 2016'}),
+            None, FIXTURE_DATE)
+        self.assertEqual(row['start_date'], datetime.date(2017, 1, 31))
+        self.assertEqual(
+            row['available_completion_date'], datetime.date(2016, 2, 29))
+        self.assertEqual(row['defaulted_date'], 1)
+        self.assertEqual(row['act_flag'], 1)
+
+    def test_primary_completion_date_without_type_is_ignored(self):
+        row = local_view.classify(
+            study(start_date='January 20, 2017',
+                  primary_completion_date='March 1, 2017',
+                  completion_date='April 1, 2017'),
+            None, FIXTURE_DATE)
+        self.assertEqual(row['used_primary_completion_date'], 0)
+        self.assertEqual(
+            row['available_completion_date'], datetime.date(2017, 4, 1))
+
+    def test_legacy_pact_needs_us_location(self):
+        legacy = study(
+            start_date='January 1, 2016',
+            primary_completion_date={'type': 'Actual', 'text': 'June 1, 2017'},
+            oversight_info={},
+            intervention={'intervention_type': 'Drug'},
+            location_countries={'country': 'France'})
+        self.assertIsNone(local_view.classify(legacy, None, FIXTURE_DATE))
+        legacy['clinical_study']['location_countries'] = {
+            'country': ['France', 'United States']}
+        row = local_view.classify(legacy, None, FIXTURE_DATE)
+        self.assertEqual(row['included_pact_flag'], 1)
+        self.assertEqual(row['results_due'], 0)
+        self.assertIsNone(local_view.classify(legacy, False, FIXTURE_DATE))
+
+    def test_withdrawn_trials_are_excluded(self):
+        self.assertIsNone(local_view.classify(
+            study(start_date='January 20, 2017', overall_status='Withdrawn'),
+            None, FIXTURE_DATE))
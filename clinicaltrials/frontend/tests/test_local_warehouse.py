@@ -0,0 +1,96 @@
+import csv
+import datetime
+import os
+import pathlib
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import local_warehouse
+from frontend import study_record
+from frontend.management.commands.load_data import convert_and_download
+from frontend.management.commands.load_data import convert_to_json
+from frontend.management.commands.load_data import registry_zip_path
+from frontend.management.commands.load_data import warehouse_client
+from frontend.tests.test_load_data import FIXTURE_ZIP
+
+
+FIXTURES = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+WORKING_VOLUME = os.path.join(tempfile.gettempdir(), 'fdaaa_warehouse')
+
+
+class TranslateSqlTestCase(TestCase):
+    def test_strings(self):
+        self.assertEqual(
+            local_warehouse.translate_sql(
+                '''SELECT "it's", r"\\d,", "\\\\b" -- it's a comment'''),
+            r"""SELECT 'it''s', '\d,', '\b' """)
+
+    def test_functions(self):
+        self.assertEqual(
+            local_warehouse.translate_sql(
+                'SELECT DATE_ADD(IF(a, PARSE_DATE("%B", b), c), '
+                'INTERVAL 1 MONTH) < current_date() FROM x.y.z'),
+            "SELECT bq_date_add((CASE WHEN a THEN bq_parse_date('%B', b) "
+            "ELSE c END), 1, 'MONTH') < bq_current_date() FROM z")
+
+
+@override_settings(
+    STORAGE_PREFIX='clinicaltrials_test/',
+    PROCESSING_STORAGE_TABLE_NAME='current_raw_json_test',
+    WORKING_VOLUME=WORKING_VOLUME,
+    WORKING_DIR=os.path.join(WORKING_VOLUME, 'clinicaltrials_test/'),
+    INTERMEDIATE_CSV_PATH=os.path.join(
+        WORKING_VOLUME, 'clinicaltrials_test/', 'clinical_trials.csv'),
+    FDA_REGULATION_SNAPSHOT_PATH=os.path.join(
+        FIXTURES, 'jan17_fda_regulation_snapshot.csv'),
+)
+class LocalWarehouseTestCase(TestCase):
+    def setUp(self):
+        pathlib.Path(settings.WORKING_DIR).mkdir(parents=True, exist_ok=True)
+        shutil.copy(FIXTURE_ZIP, registry_zip_path())
+        # Read from gzipped shards, through a wildcard
+        convert_to_json(use_manifest=False, shards=2)
+
+    def tearDown(self):
+        shutil.rmtree(settings.WORKING_VOLUME)
+
+    @patch('local_warehouse.current_date')
+    def test_view_matches_bigquery_output(self, current_date_mock):
+        # The date `expected_trials_data.csv` was generated
+        current_date_mock.return_value = datetime.date(2018, 3, 12)
+        convert_and_download(backend='sqlite')
+        with open(settings.INTERMEDIATE_CSV_PATH) as f:
+            results = list(csv.reader(f))
+        with open(os.path.join(FIXTURES, 'expected_trials_data.csv')) as f:
+            expected = list(csv.reader(f))
+        self.assertEqual(results[0], expected[0])
+        self.assertEqual(sorted(results[1:]), sorted(expected[1:]))
+
+    def test_query_results_are_deleted(self):
+        convert_and_download(backend='sqlite')
+        client = warehouse_client('sqlite')
+        tables = client.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name LIKE 'clincialtrials_tmp_%'").fetchall()
+        self.assertEqual(tables, [])
+
+    def test_studies_are_staged_in_a_native_table(self):
+        convert_and_download(backend='sqlite')
+        client = warehouse_client('sqlite')
+        self.assertFalse(client.table_exists('current_raw_json_test_external'))
+        rows = list(client.get_table(
+            'current_raw_json_test').get_rows_as_dicts())
+        self.assertEqual(len(rows), 5)
+        self.assertIn('NCT01275365', [row['nct_id'] for row in rows])
+        self.assertEqual(
+            list(rows[0]),
+            [field['name'] for field in study_record.SCHEMA])
+        self.assertEqual(rows[0]['start_date'], '2011-05-31')
+        indexes = client.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        self.assertIn(('current_raw_json_test_cluster',), indexes)
@@ -1,5 +1,6 @@
 import datetime
 from collections import OrderedDict
+from collections import defaultdict
 
 from django.test import TestCase
 from django.core.exceptions import ValidationError
@@ -13,6 +14,9 @@ from frontend.models import Ranking
 from frontend.tests.common import simulateImport
 from frontend.tests.common import makeTrial
 from frontend.management.commands.process_data import set_current_rankings
+from frontend.trial_computer import compute_metadata
+from frontend.trial_computer import compute_metadata_bulk
+from frontend.trial_computer import compute_metadata_in_db
 from unittest.mock import patch, Mock
 
 
@@ -492,3 +496,90 @@ class SponsorTrialsLatenessTestCase(TestCase):
             results_due=True,
             completion_date='2016-01-01')
         self.assertEqual(trial.days_late, 31)
+
+
+class ComputeMetadataBulkTestCase(TestCase):
+    def setUp(self):
+        self.sponsor = Sponsor.objects.create(name="Sponsor 1")
+        self.today = date(2018, 3, 1)
+        makeTrial(self.sponsor, results_due=False)
+        makeTrial(self.sponsor, results_due=False, has_results=True,
+                  reported_date='2015-06-01')
+        makeTrial(self.sponsor, results_due=True, has_results=True,
+                  completion_date='2015-01-01', reported_date='2017-01-01')
+        makeTrial(self.sponsor, results_due=True, has_results=True,
+                  completion_date='2015-01-01', reported_date='2015-06-01')
+        makeTrial(self.sponsor, results_due=True, completion_date='2016-01-01')
+        # In the grace period
+        makeTrial(self.sponsor, results_due=True, completion_date='2017-01-31')
+        makeTrial(self.sponsor, results_due=True, completion_date='2018-01-01')
+        self._qa(
+            makeTrial(self.sponsor, results_due=True,
+                      completion_date='2015-01-01'),
+            ('2017-01-01', '2018-01-01'))
+        self._qa(
+            makeTrial(self.sponsor, results_due=True,
+                      completion_date='2016-01-01'),
+            ('2016-02-01', None), ('2016-02-03', '2016-02-04'),
+            ('2017-03-01', None))
+        # Submitted in time
+        self._qa(
+            makeTrial(self.sponsor, results_due=True,
+                      completion_date='2016-01-01'),
+            ('2016-06-01', None))
+        # Cancelled, then resubmitted twice
+        self._qa(
+            makeTrial(self.sponsor, results_due=True,
+                      completion_date='2015-01-01'),
+            ('2015-06-01', '2015-07-01'), ('2016-02-01', None),
+            ('2016-03-01', None))
+
+    def _qa(self, trial, *events):
+        for submitted, cancelled in events:
+            TrialQA.objects.create(
+                submitted_to_regulator=submitted,
+                cancelled_by_sponsor=cancelled,
+                trial=trial)
+
+    def _metadata(self, trials):
+        return [(t.registry_id, t.days_late, t.finable_days_late,
+                 t.status, t.previous_status) for t in trials]
+
+    def _expected(self):
+        trials = list(Trial.objects.order_by('pk'))
+        with patch('frontend.trial_computer.date') as date_mock:
+            date_mock.today = Mock(return_value=self.today)
+            for trial in trials:
+                compute_metadata(trial)
+        return self._metadata(trials)
+
+    def test_same_as_one_at_a_time(self):
+        expected = self._expected()
+        trials = list(Trial.objects.order_by('pk'))
+        qa_events_by_trial = defaultdict(list)
+        for event in TrialQA.objects.all():
+            qa_events_by_trial[event.trial_id].append(event)
+        with self.assertNumQueries(0):
+            compute_metadata_bulk(
+                trials, qa_events_by_trial, today=self.today)
+        self.assertEqual(self._metadata(trials), expected)
+        self.assertEqual(
+            [t.status for t in trials],
+            ['ongoing', 'reported', 'reported-late', 'reported', 'overdue',
+             'ongoing', 'ongoing', 'overdue-cancelled', 'reported-late',
+             'reported', 'reported-late'])
+
+    def test_same_in_db(self):
+        expected = self._expected()
+        # Leave one trial alone
+        Trial.objects.filter(registry_id='id_1').update(status='overdue')
+        with self.assertNumQueries(2):
+            compute_metadata_in_db(
+                Trial.objects.exclude(registry_id='id_1').values_list(
+                    'pk', flat=True),
+                today=self.today)
+        self.assertEqual(
+            self._metadata(Trial.objects.order_by('pk'))[1:],
+            expected[1:])
+        self.assertEqual(Trial.objects.get(registry_id='id_1').status,
+                         'overdue')
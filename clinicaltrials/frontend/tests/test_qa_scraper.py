@@ -0,0 +1,200 @@
+from datetime import date
+from unittest import mock
+import http.server
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase
+
+from frontend import qa_scraper
+from frontend.conversion_manifest import digest
+from frontend.management.commands.process_data import results_cache_path
+from frontend.models import Trial
+from frontend.models import TrialQA
+from frontend.results_cache import ResultsCache
+
+
+FIXTURES = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures')
+
+
+class ResultsHandler(http.server.BaseHTTPRequestHandler):
+    """A stand-in for ClinicalTrials.gov's results pages, serving the
+    fixture named after the NCT id (or an empty page).  Ids in
+    `failures` are answered with a 503 that many times first.  Pages
+    are served with an ETag, if `etags` is set, and conditional
+    requests are supported.
+    """
+    failures = {}
+    etags = False
+    requests_seen = []
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        registry_id = self.path.split('/')[-1]
+        with cls.lock:
+            cls.requests_seen.append(registry_id)
+            failing = cls.failures.get(registry_id, 0)
+            if failing:
+                cls.failures[registry_id] = failing - 1
+        if failing:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = results_page(registry_id).encode('utf8')
+        etag = '"{}"'.format(digest(body))
+        if cls.etags and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if cls.etags:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def results_page(registry_id):
+    path = os.path.join(FIXTURES, registry_id + '.html')
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read()
+    return '<html></html>'
+
+
+class ScraperTestCase(TestCase):
+    def setUp(self):
+        ResultsHandler.failures = {}
+        ResultsHandler.etags = False
+        ResultsHandler.requests_seen = []
+        self.server = ThreadingServer(('127.0.0.1', 0), ResultsHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/ct2/show/results/{{}}'.format(
+            self.server.server_address[1])
+
+    def _scraper(self, **kwargs):
+        defaults = {'workers': 4, 'requests_per_second': 0, 'backoff': 0}
+        defaults.update(kwargs)
+        scraper = qa_scraper.Scraper(self.url, **defaults)
+        self.addCleanup(scraper.close)
+        return scraper
+
+    def test_scrapes_in_order_and_retries(self):
+        ids = ['overdueinqa', 'no_qa', 'missing', 'overdueinqa_cancelled']
+        ResultsHandler.failures = {'no_qa': 2}
+        self.assertEqual(
+            [(id, page.text) for id, page in self._scraper().scrape(ids)],
+            [(id, results_page(id)) for id in ids])
+        self.assertEqual(ResultsHandler.requests_seen.count('no_qa'), 3)
+
+    def test_gives_up_after_retries(self):
+        ResultsHandler.failures = {'no_qa': 3}
+        (_, failed), (_, page) = self._scraper(retries=2).scrape(
+            ['no_qa', 'overdueinqa'])
+        self.assertIsNone(failed)
+        self.assertEqual(page.text, results_page('overdueinqa'))
+
+    def test_unchanged_pages(self):
+        ids = ['overdueinqa', 'no_qa']
+        ResultsHandler.etags = True
+        first = dict(self._scraper().scrape(ids))
+        self.assertFalse(any(page.unchanged for page in first.values()))
+        known = {
+            id: {'etag': page.etag, 'last_modified': page.last_modified,
+                 'digest': page.digest}
+            for id, page in first.items()}
+        # The server says neither page has changed
+        second = dict(self._scraper().scrape(ids, known))
+        self.assertTrue(all(page.unchanged for page in second.values()))
+        self.assertIsNone(second['no_qa'].text)
+        # The server sends the pages again, but one is the same
+        ResultsHandler.etags = False
+        known['overdueinqa']['digest'] = 'old'
+        third = dict(self._scraper().scrape(ids, known))
+        self.assertFalse(third['overdueinqa'].unchanged)
+        self.assertTrue(third['no_qa'].unchanged)
+        self.assertEqual(third['no_qa'].text, results_page('no_qa'))
+
+    def test_stopping_early_cancels_queued_pages(self):
+        pages = self._scraper(workers=1).scrape(['no_qa'] * 50)
+        next(pages)
+        pages.close()
+        # The page we read, those queued behind it, and perhaps the
+        # one being fetched as we stopped
+        self.assertLessEqual(
+            len(ResultsHandler.requests_seen), 2 + qa_scraper.QUEUED_PER_WORKER)
+
+    def test_rate_limit(self):
+        start = time.monotonic()
+        list(self._scraper(requests_per_second=20).scrape(
+            ['no_qa'] * 5))
+        # The first request needn't wait
+        self.assertGreaterEqual(time.monotonic() - start, 4 / 20)
+
+    @mock.patch('frontend.qa_scraper.time.sleep')
+    @mock.patch('frontend.trial_computer.date')
+    def test_process_data(self, datetime_mock, sleep_mock):
+        datetime_mock.today = mock.Mock(return_value=date(2018, 1, 1))
+        ResultsHandler.failures = {'overdueinqa_cancelled': 1}
+        with self.settings(RESULTS_PAGE_URL=self.url):
+            call_command(
+                'process_data',
+                input_csv=os.path.join(FIXTURES, 'sample_bq_qa.csv'),
+                scrape_workers=4,
+                scrape_rate=0)
+        qa = Trial.objects.get(registry_id='overdueinqa').trialqa_set.all()
+        self.assertEqual(len(qa), 3)
+        self.assertEqual(qa[0].returned_to_sponsor, date(2017, 12, 11))
+        qa = Trial.objects.get(
+            registry_id='overdueinqa_manycancelled').trialqa_set.all()
+        self.assertEqual(len(qa), 5)
+        qa = Trial.objects.get(
+            registry_id='overdueinqa_cancelled').trialqa_set.all()
+        self.assertEqual(len(qa), 1)
+        self.assertEqual(qa[0].submitted_to_regulator, date(2017, 10, 19))
+        sleep_mock.assert_called_once_with(2)
+
+    @mock.patch('frontend.trial_computer.date')
+    def test_process_data_skips_unchanged_pages(self, datetime_mock):
+        datetime_mock.today = mock.Mock(return_value=date(2018, 1, 1))
+        ResultsHandler.etags = True
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        sample_csv = os.path.join(FIXTURES, 'sample_bq_qa.csv')
+        with self.settings(RESULTS_PAGE_URL=self.url, WORKING_VOLUME=tmp):
+            call_command('process_data', input_csv=sample_csv,
+                         scrape_cache=True, scrape_rate=0)
+            scraped = len(ResultsHandler.requests_seen)
+            cache = ResultsCache(results_cache_path())
+            self.assertEqual(len(cache.get_many(
+                ResultsHandler.requests_seen)), scraped)
+            cache.close()
+            qa_count = TrialQA.objects.count()
+            with mock.patch(
+                    'frontend.management.commands.process_data'
+                    '.set_qa_metadata') as set_qa_metadata_mock:
+                call_command('process_data', input_csv=sample_csv,
+                             scrape_cache=True, scrape_rate=0)
+        self.assertEqual(len(ResultsHandler.requests_seen), scraped * 2)
+        self.assertFalse(set_qa_metadata_mock.called)
+        self.assertEqual(TrialQA.objects.count(), qa_count)
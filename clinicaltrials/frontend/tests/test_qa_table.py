@@ -0,0 +1,147 @@
+from datetime import date
+from unittest import mock
+import json
+import os
+
+from django.conf import settings
+from django.test import TestCase
+
+from frontend import qa_table
+from frontend.qa_table import Cancellation
+from frontend.qa_table import Cycle
+from frontend.qa_table import Submission
+from frontend.tests.benchmark_qa_table import legacy_parse_qa_table
+
+
+def fixture(name):
+    path = os.path.join(
+        settings.BASE_DIR, 'frontend/tests/fixtures/{}.html'.format(name))
+    with open(path) as f:
+        return f.read()
+
+
+class ParseDateTestCase(TestCase):
+    def test_registry_formats(self):
+        with mock.patch('frontend.qa_table.dateparser') as dateparser_mock:
+            self.assertEqual(
+                qa_table.parse_date(' November 13, 2017\n'), date(2017, 11, 13))
+            self.assertEqual(
+                qa_table.parse_date('Nov 3, 2017'), date(2017, 11, 3))
+            self.assertEqual(qa_table.parse_date('  '), None)
+        self.assertFalse(dateparser_mock.parse.called)
+
+    def test_falls_back_to_dateparser(self):
+        self.assertEqual(qa_table.parse_date('13 November 2017'),
+                         date(2017, 11, 13))
+        self.assertEqual(qa_table.parse_date('not a date'), None)
+
+
+class ParseQATableTestCase(TestCase):
+    def test_no_table(self):
+        self.assertIsNone(qa_table.parse_qa_table(fixture('no_qa')))
+
+    def test_returned(self):
+        self.assertEqual(qa_table.parse_qa_table(fixture('overdueinqa')), [
+            Cycle([], Submission(date(2017, 11, 13), date(2017, 12, 11))),
+            Cycle([], Submission(date(2017, 12, 15), date(2018, 1, 11))),
+            Cycle([], Submission(date(2018, 1, 16), None)),
+        ])
+
+    def test_cancelled(self):
+        self.assertEqual(
+            qa_table.parse_qa_table(fixture('overdueinqa_manycancelled')), [
+                Cycle([Cancellation(date(2017, 9, 25), None),
+                       Cancellation(date(2017, 9, 26), None),
+                       Cancellation(date(2017, 10, 9), None),
+                       Cancellation(date(2018, 4, 12), date(2018, 5, 14))],
+                      Submission(date(2018, 5, 14), None))])
+        self.assertEqual(
+            qa_table.parse_qa_table(fixture('overdueinqa_cancelled')), [
+                Cycle([Cancellation(date(2017, 10, 19), None)], None)])
+
+    def test_same_as_legacy_parser(self):
+        for name in ['nolongeroverdueinqa', 'overdueinqa_cancelled_after_returned',
+                     'overdueinqa_cancelled_with_dates',
+                     'overdueinqa_uncancelled', 'overdueinqa_month_1',
+                     'overdueinqa_month_2']:
+            page = fixture(name)
+            self.assertEqual(
+                qa_table.parse_qa_table(page), legacy_parse_qa_table(page),
+                name)
+
+
+def events(*pairs):
+    return [{kind: value} for kind, value in pairs]
+
+
+# The pending results of the studies whose results pages are fixtures,
+# as `study_converter` converts them
+PENDING_DATA = {
+    'overdueinqa': events(
+        ('submitted', 'November 13, 2017'),
+        ('returned', 'December 11, 2017'),
+        ('submitted', 'December 15, 2017'),
+        ('returned', 'January 11, 2018'),
+        ('submitted', 'January 16, 2018')),
+    'overdueinqa_cancelled': events(
+        ('submitted', 'October 19, 2017'),
+        ('submission_canceled', 'Unknown')),
+    'overdueinqa_uncancelled': events(
+        ('submitted', 'March 29, 2018'),
+        ('submission_canceled', 'Unknown'),
+        ('submitted', 'May 10, 2018')),
+    'overdueinqa_cancelled_with_dates': events(
+        ('submitted', 'May 4, 2018'),
+        ('submission_canceled', 'May 15, 2018'),
+        ('submitted', 'May 15, 2018'),
+        ('submission_canceled', 'May 16, 2018')),
+    'overdueinqa_manycancelled': events(
+        ('submitted', 'September 25, 2017'),
+        ('submission_canceled', 'Unknown'),
+        ('submitted', 'September 26, 2017'),
+        ('submission_canceled', 'Unknown'),
+        ('submitted', 'October 9, 2017'),
+        ('submission_canceled', 'Unknown'),
+        ('submitted', 'April 12, 2018'),
+        ('submission_canceled', 'May 14, 2018'),
+        ('submitted', 'May 14, 2018')),
+    'overdueinqa_cancelled_after_returned': events(
+        ('submitted', 'April 25, 2017'),
+        ('returned', 'August 8, 2017'),
+        ('submitted', 'October 2, 2017'),
+        ('submission_canceled', 'May 17, 2018'),
+        ('submitted', 'May 17, 2018')),
+}
+
+
+class ParsePendingResultsTestCase(TestCase):
+    def test_same_as_results_page(self):
+        for name, pending in PENDING_DATA.items():
+            self.assertEqual(
+                qa_table.parse_pending_results(json.dumps(pending)),
+                qa_table.parse_qa_table(fixture(name)),
+                name)
+
+    def test_empty(self):
+        for pending_data in [None, '', '[]']:
+            with self.assertRaises(ValueError):
+                qa_table.parse_pending_results(pending_data)
+
+    def test_not_in_order(self):
+        # As converted by `xmltodict`
+        pending = {
+            'submitted': ['March 29, 2018', 'May 10, 2018'],
+            'submission_canceled': 'Unknown'}
+        with self.assertRaises(ValueError):
+            qa_table.parse_pending_results(json.dumps(pending))
+
+    def test_nonsense(self):
+        for pending in [
+                events(('returned', 'April 1, 2018')),
+                events(('submitted', 'March 29, 2018'),
+                       ('submitted', 'April 1, 2018')),
+                events(('submitted', 'sometime')),
+                events(('submitted', 'March 29, 2018'),
+                       ('withdrawn', 'April 1, 2018'))]:
+            with self.assertRaises(ValueError):
+                qa_table.parse_pending_results(json.dumps(pending))
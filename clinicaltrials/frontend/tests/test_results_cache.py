@@ -0,0 +1,45 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import TestCase
+
+from frontend.results_cache import ResultsCache
+
+
+class ResultsCacheTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _put(self, cache, registry_id, when):
+        with mock.patch('frontend.results_cache.datetime.datetime') as dt:
+            dt.utcnow.return_value = when
+            cache.put_many([(registry_id, '"e"', None, 'd-' + registry_id)])
+
+    def test_get_many(self):
+        cache = ResultsCache(self.path)
+        cache.put_many([('NCT1', '"e1"', 'Mon', 'd1'), ('NCT2', None, None, 'd2')])
+        cache.close()
+        cache = ResultsCache(self.path)
+        self.assertEqual(cache.get_many(['NCT1', 'NCT3']), {
+            'NCT1': {'etag': '"e1"', 'last_modified': 'Mon', 'digest': 'd1'}})
+        cache.close()
+
+    def test_evicts_by_age_and_size(self):
+        cache = ResultsCache(self.path, max_age_days=30, max_entries=2)
+        now = datetime.datetime.utcnow()
+        self._put(cache, 'stale', now - datetime.timedelta(days=31))
+        for i in range(3):
+            self._put(cache, 'NCT{}'.format(i),
+                      now - datetime.timedelta(days=3 - i))
+        self.assertEqual(cache.evict(), 2)
+        self.assertEqual(
+            sorted(cache.get_many(['stale', 'NCT0', 'NCT1', 'NCT2'])),
+            ['NCT1', 'NCT2'])
+        cache.close()
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+
+from django.db import connection
+from django.test import TestCase
+
+from frontend.run_report import RunReport
+from frontend.stage_runner import Stage
+from frontend.stage_runner import StageRunner
+
+
+class RunReportTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_measures_stages(self):
+        report = RunReport('test')
+        with report.stage('query') as counters:
+            with connection.cursor() as c:
+                c.execute('SELECT 1')
+                c.execute('SELECT 2')
+            counters['rows'] = 2
+        with self.assertRaises(RuntimeError):
+            with report.stage('broken'):
+                raise RuntimeError()
+
+        query, broken = report.stages
+        self.assertEqual(query['name'], 'query')
+        self.assertEqual(query['status'], 'ok')
+        self.assertEqual(query['db_queries'], 2)
+        self.assertEqual(query['rows'], 2)
+        for measure in ('wall_s', 'cpu_s', 'peak_rss_kb'):
+            self.assertGreaterEqual(query[measure], 0)
+        self.assertNotIn('top_allocators', query)
+        self.assertEqual(broken['status'], 'failed')
+        self.assertIn('query: ', report.summary())
+        self.assertIn('2 rows, 2 db_queries', report.summary())
+
+        path = os.path.join(self.tmp, 'report.json')
+        report.write(path)
+        other = RunReport('other')
+        other.include(path, 'test.')
+        self.assertEqual(
+            [entry['name'] for entry in other.stages],
+            ['test.query', 'test.broken'])
+
+    def test_top_allocators_when_tracing(self):
+        report = RunReport('test')
+        tracemalloc.start()
+        try:
+            with report.stage('allocate'):
+                data = [str(i) for i in range(10000)]
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(report.stages[0]['top_allocators'])
+        self.assertIn(
+            'test_run_report.py',
+            report.stages[0]['top_allocators'][0]['location'])
+
+    def test_stage_runner_reports_counters(self):
+        output = os.path.join(self.tmp, 'output')
+
+        def run():
+            with open(output, 'w') as f:
+                f.write('x')
+            return {'rows': 1}
+
+        report = RunReport('test')
+        StageRunner(
+            [Stage('first', run, outputs=lambda: [output])],
+            os.path.join(self.tmp, 'markers'),
+            report=report).run()
+        self.assertEqual(report.stages[0]['name'], 'first')
+        self.assertEqual(report.stages[0]['rows'], 1)
+        self.assertEqual(report.stages[0]['files'], 1)
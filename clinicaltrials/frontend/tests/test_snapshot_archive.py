@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from frontend.conversion_manifest import digest
+from frontend.snapshot_archive import SnapshotArchive
+
+
+class SnapshotArchiveTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.archive = SnapshotArchive(os.path.join(self.tmp, 'archive.db'))
+        self.archive.add_snapshot('2018-01-01', [
+            ('NCT1', b'<a>1</a>'), ('NCT2', b'<a>2</a>')])
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.tmp)
+
+    def _blob_count(self):
+        return self.archive.conn.execute(
+            "SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def test_only_changes_are_stored(self):
+        changed = self.archive.add_snapshot('2018-01-02', [
+            ('NCT1', b'<a>1</a>'), ('NCT2', b'<a>2, again</a>'),
+            ('NCT3', b'<a>1</a>')])
+        # NCT3 is new, but its XML is already stored
+        self.assertEqual(changed, 2)
+        self.assertEqual(self._blob_count(), 3)
+        self.assertEqual(self.archive.days(), ['2018-01-01', '2018-01-02'])
+
+    def test_replays_any_day(self):
+        self.archive.add_snapshot('2018-01-03', [('NCT2', b'<a>2, again</a>')])
+        self.assertEqual(
+            list(self.archive.studies('2018-01-02')),
+            [('NCT1', b'<a>1</a>'), ('NCT2', b'<a>2</a>')])
+        self.assertEqual(
+            list(self.archive.studies('2018-01-03')),
+            [('NCT2', b'<a>2, again</a>')])
+        self.assertEqual(self.archive.index('2017-12-31'), {})
+
+    def test_diff(self):
+        self.archive.add_snapshot('2018-01-03', [
+            ('NCT2', b'<a>2, again</a>'), ('NCT3', b'<a>3</a>')])
+        self.assertEqual(
+            self.archive.diff('2018-01-03', since='2018-01-01'),
+            {'NCT1': (digest(b'<a>1</a>'), None),
+             'NCT2': (digest(b'<a>2</a>'), digest(b'<a>2, again</a>')),
+             'NCT3': (None, digest(b'<a>3</a>'))})
+
+    def test_same_day_is_replaced(self):
+        self.archive.add_snapshot('2018-01-02', [('NCT1', b'<a>1</a>')])
+        self.archive.add_snapshot('2018-01-02', [
+            ('NCT1', b'<a>1</a>'), ('NCT2', b'<a>2</a>')])
+        self.assertEqual(
+            self.archive.diff('2018-01-02', since='2018-01-01'), {})
+        with self.assertRaises(ValueError):
+            self.archive.add_snapshot('2017-12-31', [])
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from frontend.stage_runner import Stage
+from frontend.stage_runner import StageRunner
+
+
+class StageRunnerTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.calls = []
+        self.fail = set()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def _stage(self, name, content=None, **kwargs):
+        def run():
+            self.calls.append(name)
+            if name in self.fail:
+                raise RuntimeError(name)
+            if content is not None:
+                with open(self._path(name), 'w') as f:
+                    f.write(content())
+        outputs = None
+        if content is not None:
+            outputs = lambda: [self._path(name)]
+        return Stage(name, run, outputs=outputs, **kwargs)
+
+    def _runner(self, options=None):
+        self.version = getattr(self, 'version', 'v1')
+        stages = [
+            self._stage('first', lambda: self.version),
+            # Different every time, so its fingerprint changes
+            self._stage('second', lambda: 'x' * len(self.calls),
+                        options=options),
+            self._stage('third'),
+        ]
+        return StageRunner(stages, self._path('markers'))
+
+    def test_resumes_after_failure(self):
+        self.fail = {'second'}
+        with self.assertRaises(RuntimeError):
+            self._runner().run()
+        self.fail = set()
+        self.calls = []
+        self.assertEqual(self._runner().run(), ['second', 'third'])
+        self.assertEqual(self._runner().run(), [])
+
+    def test_changed_output_reruns_downstream(self):
+        self._runner().run()
+        os.remove(self._path('second'))
+        self.assertEqual(self._runner().run(), ['second', 'third'])
+        self.assertEqual(self._runner(options={'x': 1}).run(),
+                         ['second', 'third'])
+
+    def test_always_runs_but_only_cascades_on_change(self):
+        def download():
+            # Like the registry download, only touches its output when
+            # there's something new
+            self.calls.append('first')
+            path = self._path('first')
+            if not os.path.exists(path) or open(path).read() != self.version:
+                with open(path, 'w') as f:
+                    f.write(self.version)
+
+        stages = lambda: [
+            Stage('first', download, outputs=lambda: [self._path('first')],
+                  always=True),
+            self._stage('second'),
+        ]
+        self.version = 'v1'
+        StageRunner(stages(), self._path('markers')).run()
+        self.assertEqual(
+            StageRunner(stages(), self._path('markers')).run(), ['first'])
+        self.version = 'v2-longer'
+        self.assertEqual(
+            StageRunner(stages(), self._path('markers')).run(),
+            ['first', 'second'])
+
+    def test_from_and_only_stage(self):
+        self._runner().run()
+        self.assertEqual(
+            self._runner().run(from_stage='second'), ['second', 'third'])
+        self.assertEqual(self._runner().run(only_stage='second'), ['second'])
+        # Running `second` alone has changed its output, so `third` is
+        # now stale
+        self.assertEqual(self._runner().run(), ['third'])
+        with self.assertRaises(ValueError):
+            self._runner().run(from_stage='fourth')
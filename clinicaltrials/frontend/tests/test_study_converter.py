@@ -0,0 +1,77 @@
+import json
+import os
+import zipfile
+
+import xmltodict
+from django.conf import settings
+from django.test import TestCase
+
+from frontend.management.commands.load_data import postprocessor
+from frontend.study_converter import ConversionError
+from frontend.study_converter import ORDERED_FIELDS
+from frontend.study_converter import VIEW_FIELDS
+from frontend.study_converter import study_to_json
+
+
+def fixture_studies():
+    path = os.path.join(settings.BASE_DIR, 'frontend/tests/fixtures/data.zip')
+    with zipfile.ZipFile(path) as z:
+        for name in sorted(z.namelist()):
+            if name.endswith('.xml'):
+                yield name, z.read(name)
+
+
+class StudyConverterTestCase(TestCase):
+    def test_matches_xmltodict_for_view_fields(self):
+        for name, content in fixture_studies():
+            full = xmltodict.parse(
+                content, item_depth=0, postprocessor=postprocessor)
+            expected = {
+                k: v for k, v in full['clinical_study'].items()
+                if k in VIEW_FIELDS and k not in ORDERED_FIELDS}
+            study = json.loads(study_to_json(content))['clinical_study']
+            for k in ORDERED_FIELDS:
+                study.pop(k, None)
+            self.assertEqual(
+                json.dumps(study), json.dumps(expected), name)
+
+    def test_drops_unused_fields(self):
+        for name, content in fixture_studies():
+            study = json.loads(study_to_json(content))['clinical_study']
+            self.assertNotIn('clinical_results', study)
+            self.assertNotIn('eligibility', study)
+
+    def test_repeated_elements_and_attributes(self):
+        content = (b'<clinical_study><condition>A</condition>'
+                   b'<condition>B</condition>'
+                   b'<enrollment type="Actual">92</enrollment>'
+                   b'<phase/></clinical_study>')
+        self.assertEqual(
+            json.loads(study_to_json(content)),
+            {'clinical_study': {
+                'condition': ['A', 'B'],
+                'enrollment': {'type': 'Actual', 'text': '92'},
+                'phase': None}})
+
+    def test_pending_results_are_kept_in_order(self):
+        content = (b'<clinical_study><pending_results>'
+                   b'<submitted>May 4, 2018</submitted>'
+                   b'<submission_canceled>Unknown</submission_canceled>'
+                   b'<submitted>May 15, 2018</submitted>'
+                   b'<returned>June 1, 2018</returned>'
+                   b'</pending_results></clinical_study>')
+        self.assertEqual(
+            json.loads(study_to_json(content)),
+            {'clinical_study': {'pending_results': [
+                {'submitted': 'May 4, 2018'},
+                {'submission_canceled': 'Unknown'},
+                {'submitted': 'May 15, 2018'},
+                {'returned': 'June 1, 2018'}]}})
+        self.assertEqual(
+            json.loads(study_to_json(
+                b'<clinical_study><pending_results/></clinical_study>')),
+            {'clinical_study': {'pending_results': None}})
+
+    def test_invalid_xml(self):
+        with self.assertRaises(ConversionError):
+            study_to_json(b'<clinical_study><phase>')
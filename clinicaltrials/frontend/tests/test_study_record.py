@@ -0,0 +1,54 @@
+import datetime
+import json
+
+from django.test import TestCase
+
+from frontend import study_record
+
+
+class StudyRecordTestCase(TestCase):
+    def test_round_trip(self):
+        study = {'clinical_study': {
+            'id_info': {'nct_id': 'NCT00000001'},
+            'phase': ' Phase 2 ',
+            'start_date': 'February 2016',
+            'primary_completion_date': {
+                'type': 'Actual', 'text': 'March 1, 2017'},
+            'completion_date': 'April 2017',
+            'condition': ['A', 'B'],
+        }}
+        line = study_record.to_line(study)
+        raw = json.loads(line)
+        self.assertEqual(raw['start_date'], '2016-02-29')
+        self.assertEqual(json.loads(raw['json']), study)
+        self.assertEqual(
+            sorted(raw), sorted(f['name'] for f in study_record.SCHEMA))
+
+        record = study_record.from_line(line)
+        self.assertEqual(record['nct_id'], 'NCT00000001')
+        self.assertEqual(record['phase'], 'Phase 2')
+        self.assertEqual(record['start_date'], datetime.date(2016, 2, 29))
+        self.assertEqual(
+            record['available_completion_date'], datetime.date(2017, 3, 1))
+        self.assertEqual(record['completion_date'], datetime.date(2017, 4, 30))
+        self.assertEqual(record['used_primary_completion_date'], 1)
+        self.assertEqual(record['defaulted_pcd_flag'], 0)
+        self.assertEqual(record['defaulted_cd_flag'], 1)
+        self.assertEqual(record['condition'], '["A","B"]')
+        self.assertIsNone(record['certificate_date'])
+
+    def test_unparseable_date(self):
+        # Like `SAFE.PARSE_DATE`, bad dates are empty, and the rest of
+        # the study is kept
+        record = study_record.flatten({'clinical_study': {
+            'id_info': {'nct_id': 'NCT00000001'},
+            'start_date': 'Sometime',
+            'completion_date': 'Smarch 32, 2017',
+            'last_update_submitted': 'March 1, 2017',
+        }})
+        self.assertEqual(record['nct_id'], 'NCT00000001')
+        self.assertIsNone(record['start_date'])
+        self.assertIsNone(record['completion_date'])
+        self.assertIsNone(record['available_completion_date'])
+        self.assertEqual(
+            record['last_updated_date'], datetime.date(2017, 3, 1))
@@ -8,10 +8,105 @@ from datetime import date
 from dateutil.relativedelta import relativedelta
 
 from django.apps import apps
+from django.db import connection
 from django.utils.dateparse import parse_date
 
 GRACE_PERIOD = 30
 
+# `compute_metadata()` for many trials at once, as one statement.
+#
+# `events` counts, for each QA event, the cancellations at or after it
+# (in the order `qa_start_dates()` walks them backwards), so that
+# `restart_date` is the first submission since the last cancellation.
+# `lateness` follows `get_days_late()`, and the UPDATE `get_status()`.
+COMPUTE_METADATA_SQL = """
+WITH events AS (
+  SELECT
+    trial_id,
+    submitted_to_regulator,
+    COUNT(cancelled_by_sponsor) OVER (
+      PARTITION BY trial_id
+      ORDER BY submitted_to_regulator DESC, id DESC
+    ) AS cancellations_since
+  FROM frontend_trialqa
+  WHERE trial_id = ANY(%(trial_ids)s)
+),
+qa AS (
+  SELECT
+    trial_id,
+    MIN(submitted_to_regulator) AS original_start_date,
+    BOOL_OR(cancellations_since > 0) AS cancelled,
+    MIN(submitted_to_regulator) FILTER (
+      WHERE cancellations_since = 0) AS restart_date
+  FROM events
+  GROUP BY trial_id
+),
+deltas AS (
+  -- Days past the deadline for reporting on each date that might
+  -- count as the reporting date, as `_days_delta()` before it drops
+  -- zeroes
+  SELECT
+    t.id,
+    t.results_due,
+    t.has_results,
+    qa.trial_id IS NOT NULL AS in_qa,
+    qa.cancelled,
+    qa.restart_date,
+    t.reported_date - t.completion_date - 365 AS reported,
+    qa.original_start_date - t.completion_date - 365 AS original,
+    qa.restart_date - t.completion_date - 365 AS restarted,
+    %(today)s::date - t.completion_date - 365 AS today
+  FROM frontend_trial t
+  LEFT JOIN qa ON qa.trial_id = t.id
+  WHERE t.id = ANY(%(trial_ids)s)
+),
+lateness AS (
+  SELECT
+    *,
+    CASE
+      WHEN NOT results_due THEN NULL
+      WHEN has_results THEN NULLIF(GREATEST(reported, 0), 0)
+      WHEN in_qa THEN NULLIF(GREATEST(original, 0), 0)
+      WHEN today > %(grace_period)s THEN today
+    END AS min_days_late,
+    CASE
+      WHEN NOT results_due THEN NULL
+      WHEN has_results THEN NULLIF(GREATEST(reported, 0), 0)
+      WHEN restart_date IS NOT NULL THEN NULLIF(GREATEST(restarted, 0), 0)
+      WHEN in_qa AND NOT cancelled THEN NULLIF(GREATEST(original, 0), 0)
+      WHEN today > %(grace_period)s THEN today
+    END AS max_days_late
+  FROM deltas
+)
+UPDATE frontend_trial SET
+  days_late = lateness.max_days_late,
+  finable_days_late = CASE
+    WHEN lateness.max_days_late IS NULL THEN NULL
+    ELSE NULLIF(GREATEST(
+      COALESCE(lateness.min_days_late, 0) - %(fines_grace_period)s, 0), 0)
+  END,
+  previous_status = frontend_trial.status,
+  status = CASE
+    WHEN lateness.results_due AND lateness.has_results THEN
+      CASE WHEN lateness.max_days_late > 0
+        THEN %(reported_late)s ELSE %(reported)s END
+    WHEN lateness.results_due AND lateness.in_qa THEN
+      CASE
+        WHEN lateness.max_days_late IS NULL THEN %(reported)s
+        WHEN lateness.cancelled AND lateness.restart_date IS NULL
+          THEN %(overdue_cancelled)s
+        ELSE %(reported_late)s
+      END
+    WHEN lateness.results_due THEN
+      CASE WHEN lateness.max_days_late IS NOT NULL
+        THEN %(overdue)s ELSE %(ongoing)s END
+    WHEN lateness.has_results THEN %(reported)s
+    ELSE %(ongoing)s
+  END
+FROM lateness
+WHERE frontend_trial.id = lateness.id
+"""
+
 
 def _datify(trial):
     """We sometimes maninpulate data before the model has been saved, and
@@ -29,12 +124,18 @@ def _datify(trial):
             setattr(trial, field, val)
 
 
-def compute_metadata(trial):
+def compute_metadata(trial, qa_dates=None, today=None):
     """Compute days late and status for a trial.
+
+    `qa_dates`, the result of `qa_start_dates()`, is looked up if not
+    given and needed; lateness is computed as of `today`, if given.
     """
+    if qa_dates is None and trial.results_due and not trial.has_results:
+        qa_dates = qa_start_dates(trial)
     # Logic in trial status calculations depends on how many days late
     # a trial is, so this must be called before `get_status`
-    min_days_late, max_days_late = get_days_late(trial)
+    min_days_late, max_days_late = get_days_late(
+        trial, qa_dates=qa_dates, today=today)
     trial.days_late = max_days_late
     if trial.days_late:
         trial.finable_days_late = max([
@@ -45,7 +146,47 @@ def compute_metadata(trial):
     else:
         trial.finable_days_late = None
     trial.previous_status = trial.status
-    trial.status = get_status(trial)
+    trial.status = get_status(trial, qa_dates=qa_dates)
+
+
+def compute_metadata_bulk(trials, qa_events_by_trial, today=None):
+    """Compute days late and status for many trials at once, exactly
+    as `compute_metadata()` does for each, but from QA events which
+    have already been fetched.
+
+    Args:
+        trials: the trials to update in place
+        qa_events_by_trial: maps the id of each trial with any QA
+          events to a list of them, in their default order
+        today: the date to compute lateness on, if not today
+
+    """
+    today = today or date.today()
+    for trial in trials:
+        compute_metadata(
+            trial,
+            qa_dates=qa_start_dates_from_events(
+                qa_events_by_trial.get(trial.pk, [])),
+            today=today)
+
+
+def compute_metadata_in_db(trial_ids, today=None):
+    """Compute days late and status for the given trials, exactly as
+    `compute_metadata()` does, with a single UPDATE.
+    """
+    trial_class = apps.get_model('frontend', 'Trial')
+    with connection.cursor() as c:
+        c.execute(COMPUTE_METADATA_SQL, {
+            'trial_ids': list(trial_ids),
+            'today': today or date.today(),
+            'grace_period': GRACE_PERIOD,
+            'fines_grace_period': trial_class.FINES_GRACE_PERIOD,
+            'ongoing': trial_class.STATUS_ONGOING,
+            'overdue': trial_class.STATUS_OVERDUE,
+            'overdue_cancelled': trial_class.STATUS_OVERDUE_CANCELLED,
+            'reported': trial_class.STATUS_REPORTED,
+            'reported_late': trial_class.STATUS_REPORTED_LATE,
+        })
 
 
 def qa_start_dates(trial):
@@ -58,6 +199,13 @@ def qa_start_dates(trial):
     Returns:
         (original_start_date, cancelled, restart_date) triple
 
+    """
+    return qa_start_dates_from_events(list(trial.trialqa_set.all()))
+
+
+def qa_start_dates_from_events(events):
+    """As `qa_start_dates()`, from a trial's QA events, in their default
+    order (by submission date)
     """
     # We assume that the first QA submission date will, when QA is
     # complete, be treated as the date the results were first
@@ -70,12 +218,10 @@ def qa_start_dates(trial):
     restart_date = None
     original_start_date = None
     cancelled = False
-    first_event = trial.trialqa_set.first()
+    if events:
+        original_start_date = events[0].submitted_to_regulator
 
-    if first_event:
-        original_start_date = first_event.submitted_to_regulator
-
-    for event in trial.trialqa_set.order_by('-submitted_to_regulator').all():
+    for event in reversed(events):
         if event.cancelled_by_sponsor:
             cancelled = True
             break
@@ -97,7 +243,7 @@ def _days_delta(effective_reporting_date, completion_date, with_grace_period=Fal
     return days_late
 
 
-def get_days_late(trial):
+def get_days_late(trial, qa_dates=None, today=None):
     """Return the (min, max) number of days a trial is late.
 
     `min` takes into account the earliest submission of results for
@@ -107,6 +253,8 @@ def get_days_late(trial):
     cancellation, i.e. it is the least generous interpretation which
     still takes into account submission to the QA process.
 
+    `qa_dates` and `today` are as for `compute_metadata()`.
+
     """
     # Logic behind this implementation is discussed in #38 (and #146)
     min_days_late = max_days_late = None
@@ -118,7 +266,8 @@ def get_days_late(trial):
             min_days_late = max_days_late = _days_delta(
                 trial.reported_date, trial.completion_date)
         else:
-            original_start_date, cancelled, restart_date = qa_start_dates(trial)
+            original_start_date, cancelled, restart_date = \
+                qa_dates or qa_start_dates(trial)
             if original_start_date:
                 min_days_late = max_days_late = _days_delta(
                     original_start_date, trial.completion_date)
@@ -127,19 +276,19 @@ def get_days_late(trial):
             else:
                 if cancelled:
                     max_days_late = _days_delta(
-                        date.today(),
+                        today or date.today(),
                         trial.completion_date,
                         with_grace_period=True)
             no_qa = not original_start_date
             if no_qa:
                 min_days_late = max_days_late = _days_delta(
-                    date.today(),
+                    today or date.today(),
                     trial.completion_date,
                     with_grace_period=True)
     return min_days_late, max_days_late
 
 
-def get_status(trial):
+def get_status(trial, qa_dates=None):
     overdue = trial.days_late and trial.days_late > 0
     trial_class = type(trial)
     if trial.results_due:
@@ -150,7 +299,8 @@ def get_status(trial):
                 status = trial_class.STATUS_REPORTED
         else:
             # results are due, but none have been published
-            original_start_date, cancelled, restart_date = qa_start_dates(trial)
+            original_start_date, cancelled, restart_date = \
+                qa_dates or qa_start_dates(trial)
             if original_start_date:
                 # although no results have been published, they have
                 # been submitted
@@ -5,136 +5,47 @@
 -- The logic is documented here:
 --  * https://github.com/ebmdatalab/clinicaltrials-act-tracker/issues/2#issuecomment-358318279
 --  * https://github.com/ebmdatalab/clinicaltrials-act-tracker/pull/116#issue-173998549
+--
+-- It runs against the native table written by staging.sql, whose
+-- columns were extracted from each study's JSON, and its dates parsed,
+-- when the registry was converted; see frontend/study_record.py.
 
 WITH full_data_extract AS (
-SELECT TRIM(json_EXTRACT(json,
-      "$.clinical_study.id_info.nct_id"), '"') AS nct_id,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.study_type"), '"') AS study_type,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.overall_status"), '"') AS study_status,
-  TRIM(TRIM(json_EXTRACT(json,
-        "$.clinical_study.phase"), '"')) AS phase,
-   json_EXTRACT(json,
-    "$.clinical_study.intervention") AS intervention_type,
-  CASE
-    WHEN json_EXTRACT(json,  "$.clinical_study.start_date.text") IS NOT NULL THEN (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,  "$.clinical_study.start_date.text"), r"\d,"),  PARSE_DATE("%B %e, %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.start_date.text")),  DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.start_date.text")), INTERVAL 1 MONTH), INTERVAL 1 DAY)))
-    ELSE (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.start_date"), r"\d,"),
-      PARSE_DATE("%B %e, %Y",
-        JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.start_date")),
-      DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",
-            JSON_EXTRACT_SCALAR(json,
-              "$.clinical_study.start_date")), INTERVAL 1 MONTH), INTERVAL 1 DAY)))
-  END AS start_date,
-  CASE
-    WHEN json_EXTRACT(json,  "$.clinical_study.primary_completion_date.text") IS NULL THEN
-    (CASE
-    WHEN json_EXTRACT(json,  "$.clinical_study.completion_date.text") IS NOT NULL THEN (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text"), r"\d,"),  PARSE_DATE("%B %e, %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text")),  DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text")), INTERVAL 1 MONTH), INTERVAL 1 DAY)))
-    ELSE (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.completion_date"), r"\d,"),
-      PARSE_DATE("%B %e, %Y",
-        JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.completion_date")),
-      DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",
-            JSON_EXTRACT_SCALAR(json,
-              "$.clinical_study.completion_date")), INTERVAL 1 MONTH), INTERVAL 1 DAY))) END)
-    ELSE ( IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.primary_completion_date.text"), r"\d,"),
-      PARSE_DATE("%B %e, %Y",
-        JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.primary_completion_date.text")),
-      DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",
-            JSON_EXTRACT_SCALAR(json,
-              "$.clinical_study.primary_completion_date.text")), INTERVAL 1 MONTH), INTERVAL 1 DAY)))
-  END AS available_completion_date,
-  Case when JSON_EXTRACT(json, "$.clinical_study.primary_completion_date.text") IS NOT NULL then 1 else 0 end as used_primary_completion_date,
-  IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,
-        "$.clinical_study.primary_completion_date.text"), r"\d,"),
-    PARSE_DATE("%B %e, %Y",
-      JSON_EXTRACT_SCALAR(json,
-        "$.clinical_study.primary_completion_date.text")),
-    DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",
-          JSON_EXTRACT_SCALAR(json,
-            "$.clinical_study.primary_completion_date.text")), INTERVAL 1 MONTH), INTERVAL 1 DAY)) AS primary_completion_date,
-  Case when (REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json, "$.clinical_study.primary_completion_date.text"),
-      r"\d,") OR (JSON_EXTRACT(json, "$.clinical_study.primary_completion_date.text") is null)) then 0 else 1 end as defaulted_pcd_flag,
-  CASE
-    WHEN json_EXTRACT(json,  "$.clinical_study.completion_date.text") IS NOT NULL THEN (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text"), r"\d,"),  PARSE_DATE("%B %e, %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text")),  DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",  JSON_EXTRACT_SCALAR(json,  "$.clinical_study.completion_date.text")), INTERVAL 1 MONTH), INTERVAL 1 DAY)))
-    ELSE (IF(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.completion_date"), r"\d,"),
-      PARSE_DATE("%B %e, %Y",
-        JSON_EXTRACT_SCALAR(json,
-          "$.clinical_study.completion_date")),
-      DATE_SUB(DATE_ADD(PARSE_DATE("%B %Y",
-            JSON_EXTRACT_SCALAR(json,
-              "$.clinical_study.completion_date")), INTERVAL 1 MONTH), INTERVAL 1 DAY))) END AS completion_date,
- Case when
-(REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json, "$.clinical_study.completion_date.text"),
-      r"\d,") OR REGEXP_CONTAINS(JSON_EXTRACT_SCALAR(json, "$.clinical_study.completion_date"),
-      r"\d,") OR (JSON_EXTRACT_SCALAR(json, "$.clinical_study.completion_date.text") is null AND JSON_EXTRACT_SCALAR(json, "$.clinical_study.completion_date") is null))
-      then 0 else 1 end as defaulted_cd_flag,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.study_design_info.primary_purpose"), '"') AS primary_purpose,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.oversight_info.is_fda_regulated_drug"), '"') AS fda_reg_drug,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.oversight_info.is_fda_regulated_device"), '"') AS fda_reg_device,
-  TRIM(json_EXTRACT(json,
-    "$.clinical_study.oversight_info.is_us_export"), '"') AS exported,
-  json_EXTRACT(json,
-    "$.clinical_study.location") AS study_location,
-  PARSE_DATE("%B %e, %Y",
-    JSON_EXTRACT_SCALAR(json,
-      "$.clinical_study.results_first_submitted")) AS results_submitted_date,
-  PARSE_DATE("%B %e, %Y",
-    JSON_EXTRACT_SCALAR(json,
-      "$.clinical_study.last_update_submitted")) AS last_updated_date,
-  CASE
-    WHEN json_EXTRACT(json,  "$.clinical_study.pending_results") IS NOT NULL THEN 1
-    ELSE 0
-  END AS pending_results,
-  TRIM(json_EXTRACT(json,  "$.clinical_study.pending_results"), '"') AS pending_data,    
-  CASE
-    WHEN JSON_EXTRACT_SCALAR(json,"$.clinical_study.results_first_submitted") IS NOT NULL THEN 1
-    ELSE 0
-  END AS has_results,
-  PARSE_DATE("%B %e, %Y",
-    JSON_EXTRACT_SCALAR(json,
-      "$.clinical_study.disposition_first_submitted")) AS certificate_date,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.location_countries"), '"') AS location,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.sponsors.lead_sponsor.agency"), '"') AS sponsor,
-  TRIM(json_EXTRACT(json,
-      "$.clinical_study.sponsors.lead_sponsor.agency_class"), '"') AS sponsor_type,
-  TRIM(json_extract(json, "$.clinical_study.sponsors.collaborator"), '"') AS collaborators,
-  TRIM(case when (json_extract(json, "$.clinical_study.enrollment.text")) is not null then
-  (json_extract(json,
-      "$.clinical_study.enrollment.text")) else (json_extract(json, "$.clinical_study.enrollment")) end, '"') AS enrollment,
-  CASE WHEN json_EXTRACT(json,
-      "$.clinical_study.official_title") is null then
-      TRIM(json_EXTRACT(json,
-      "$.clinical_study.brief_title"), '"')
-  ELSE TRIM(json_EXTRACT(json,
-      "$.clinical_study.official_title"), '"') end AS title,
-  TRIM(JSON_Extract(json,
-      "$.clinical_study.official_title"),'"') as official_title,
-  TRIM(JSON_Extract(json,
-      "$.clinical_study.brief_title"),'"') as brief_title,
-  TRIM(JSON_EXTRACT(json,
-      "$.clinical_study.required_header.url"), '"') AS url,
-  json_EXTRACT(json,
-    "$.clinical_study.condition") AS condition,
-  json_EXTRACT(json,
-    "$.clinical_study.condition_browse") AS condition_mesh,
-  json_EXTRACT(json,
-    "$.clinical_study.intervention") AS intervention,
-  json_EXTRACT(json,
-    "$.clinical_study.intervention_browse") AS intervention_mesh,
-  json_EXTRACT(json,
-    "$.clinical_study.keyword") AS keywords
+SELECT nct_id,
+  study_type,
+  study_status,
+  phase,
+  start_date,
+  available_completion_date, --PCD if it has a type, otherwise completion date
+  used_primary_completion_date,
+  primary_completion_date,
+  defaulted_pcd_flag,
+  completion_date,
+  defaulted_cd_flag,
+  primary_purpose,
+  fda_reg_drug,
+  fda_reg_device,
+  exported,
+  results_submitted_date,
+  last_updated_date,
+  pending_results,
+  pending_data,
+  has_results,
+  certificate_date,
+  location,
+  sponsor,
+  sponsor_type,
+  collaborators,
+  enrollment,
+  title,
+  official_title,
+  brief_title,
+  url,
+  condition,
+  condition_mesh,
+  intervention,
+  intervention_mesh,
+  keywords
 FROM
    ebmdatalab.clinicaltrials.{table_name}),
 
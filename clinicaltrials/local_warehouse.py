@@ -0,0 +1,531 @@
+# -*- coding: utf-8 -*-
+"""An embedded stand-in for BigQuery and Cloud Storage.
+
+`Client`, `Table` and `TableExporter` here have the same methods as
+their counterparts in `bigquery`, but keep tables in a SQLite database
+and treat a local directory as the storage bucket.  The registry is
+small enough to fit on one machine, so this lets us run (and time) the
+whole pipeline without waiting for cloud job queues.
+
+Queries are written in BigQuery's Standard SQL, and translated to
+SQLite by `translate_sql`, which supports the subset that `view.sql`
+uses:
+
+ * double-quoted and raw (`r"..."`) string literals
+ * `project.dataset.table` names
+ * `IF(cond, a, b)`
+ * `DATE_ADD` / `DATE_SUB` with `INTERVAL n UNIT`
+ * `JSON_EXTRACT`, `JSON_EXTRACT_SCALAR`, `REGEXP_CONTAINS`,
+   `PARSE_DATE`, `CONCAT` and `CURRENT_DATE`, which are implemented as
+   Python functions.
+
+Dates are stored as ISO 8601 strings, so they compare correctly with
+date literals.
+
+"""
+import calendar
+import csv
+import datetime
+import functools
+import glob
+import gzip
+import json
+import os
+import re
+import sqlite3
+
+from google.cloud.exceptions import Conflict, NotFound
+
+from bigquery import DATASET_NAME
+from bigquery import PROJECT
+from bigquery import interpolate_sql
+from bigquery import row_to_dict
+
+
+# BigQuery types, and the SQLite types we store them as
+COLUMN_TYPES = {
+    'STRING': 'TEXT',
+    'INTEGER': 'INTEGER',
+    'FLOAT': 'REAL',
+    'BOOLEAN': 'BOOLEAN',
+    'DATE': 'TEXT',
+}
+
+sqlite3.register_converter('BOOLEAN', lambda value: value == b'1')
+
+
+def current_date():
+    return datetime.date.today()
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_json(text):
+    # A row's JSON is extracted from many times in a row, so we only
+    # want to parse it once
+    return json.loads(text)
+
+
+def _json_path(text, path):
+    if text is None:
+        return None
+    value = _parse_json(text)
+    for key in path.lstrip('$').split('.'):
+        if not key:
+            continue
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def json_extract(text, path):
+    value = _json_path(text, path)
+    if value is None:
+        return None
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def json_extract_scalar(text, path):
+    value = _json_path(text, path)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    return None
+
+
+def regexp_contains(value, pattern):
+    if value is None or pattern is None:
+        return None
+    return re.search(pattern, value) is not None
+
+
+def parse_date(fmt, text):
+    if text is None:
+        return None
+    # Python has no `%e` (day of month, optionally space-padded), but
+    # `%d` also accepts unpadded days
+    fmt = fmt.replace('%e', '%d')
+    return datetime.datetime.strptime(text, fmt).date().isoformat()
+
+
+def _add_months(d, months):
+    month = d.month - 1 + months
+    year = d.year + month // 12
+    month = month % 12 + 1
+    day = min(d.day, calendar.monthrange(year, month)[1])
+    return d.replace(year=year, month=month, day=day)
+
+
+def date_add(value, count, unit):
+    if value is None or count is None:
+        return None
+    d = datetime.date(*map(int, value.split('-')))
+    unit = unit.upper()
+    if unit == 'DAY':
+        d += datetime.timedelta(days=count)
+    elif unit == 'WEEK':
+        d += datetime.timedelta(weeks=count)
+    elif unit == 'MONTH':
+        d = _add_months(d, count)
+    elif unit == 'QUARTER':
+        d = _add_months(d, 3 * count)
+    elif unit == 'YEAR':
+        d = _add_months(d, 12 * count)
+    else:
+        raise ValueError("Unsupported date part {}".format(unit))
+    return d.isoformat()
+
+
+def date_sub(value, count, unit):
+    return date_add(value, count and -count, unit)
+
+
+def concat(*values):
+    if any(value is None for value in values):
+        return None
+    return ''.join(str(value) for value in values)
+
+
+# BigQuery functions with no SQLite equivalent: (name, arity, function)
+FUNCTIONS = [
+    ('json_extract', 2, json_extract),
+    ('json_extract_scalar', 2, json_extract_scalar),
+    ('regexp_contains', 2, regexp_contains),
+    ('parse_date', 2, parse_date),
+    ('date_add', 3, date_add),
+    ('date_sub', 3, date_sub),
+    ('concat', -1, concat),
+    ('current_date', 0, lambda: current_date().isoformat()),
+]
+
+FUNCTION_NAMES = {name for name, _, _ in FUNCTIONS}
+
+
+def connect(path):
+    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    for name, arity, function in FUNCTIONS:
+        # Prefixed, so as not to collide with SQLite's own `json_extract`
+        conn.create_function('bq_' + name, arity, function)
+    return conn
+
+
+TOKEN_RE = re.compile(r"""
+    (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<string>[rR]?(?:"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'))
+  | (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r'}
+
+
+def _tokenize(sql):
+    return [(m.lastgroup, m.group()) for m in TOKEN_RE.finditer(sql)
+            if m.lastgroup != 'comment']
+
+
+def _string_literal(token):
+    raw = token[0] in 'rR'
+    if raw:
+        token = token[1:]
+    value = token[1:-1]
+    if not raw:
+        value = re.sub(
+            r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)), value)
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _next_token(tokens, i):
+    """Index of the next non-whitespace token after `i`, or None
+    """
+    for j in range(i + 1, len(tokens)):
+        if tokens[j][0] != 'space':
+            return j
+    return None
+
+
+def _call_arguments(tokens, start):
+    """Given the index of an opening bracket, return the token lists of
+    each top-level argument, and the index of the closing bracket.
+    """
+    depth = 0
+    args = [[]]
+    for i in range(start + 1, len(tokens)):
+        kind, text = tokens[i]
+        if kind == 'other' and text == '(':
+            depth += 1
+        elif kind == 'other' and text == ')':
+            if depth == 0:
+                return args, i
+            depth -= 1
+        elif kind == 'other' and text == ',' and depth == 0:
+            args.append([])
+            continue
+        args[-1].append(tokens[i])
+    raise ValueError("Unbalanced brackets in SQL")
+
+
+def _translate_tokens(tokens):
+    out = []
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        following = _next_token(tokens, i)
+        is_call = following is not None and tokens[following] == ('other', '(')
+        if kind == 'string':
+            out.append(_string_literal(text))
+        elif kind == 'name' and text.lower() == 'if' and is_call:
+            args, end = _call_arguments(tokens, following)
+            if len(args) != 3:
+                raise ValueError("IF takes three arguments")
+            out.append("(CASE WHEN {} THEN {} ELSE {} END)".format(
+                *[_translate_tokens(arg).strip() for arg in args]))
+            i = end
+        elif kind == 'name' and text.lower() in FUNCTION_NAMES and is_call:
+            out.append('bq_' + text.lower())
+        elif kind == 'name' and text.upper() == 'INTERVAL':
+            # `INTERVAL 1 MONTH` becomes two arguments: `1, 'MONTH'`
+            count = following
+            unit = _next_token(tokens, count)
+            out.append("{}, '{}'".format(
+                tokens[count][1], tokens[unit][1].upper()))
+            i = unit
+        elif kind == 'name' and text.count('.') == 2:
+            # `project.dataset.table`; there's only one dataset
+            out.append(text.rsplit('.', 1)[1])
+        else:
+            out.append(text)
+        i += 1
+    return ''.join(out)
+
+
+def translate_sql(sql):
+    """Translate a BigQuery Standard SQL query to SQLite.
+
+    >>> translate_sql('SELECT IF(x > 1, "a", "b") FROM p.d.t')
+    "SELECT (CASE WHEN x > 1 THEN 'a' ELSE 'b' END) FROM t"
+    """
+    return _translate_tokens(_tokenize(sql))
+
+
+def _column_definitions(schema):
+    """Schemas may be lists of dicts (as for `create_storage_backed_table`)
+    or of `SchemaField`s (as from `bigquery.build_schema`).
+    """
+    columns = []
+    for field in schema:
+        if isinstance(field, dict):
+            name, field_type = field['name'], field['type']
+        else:
+            name, field_type = field.name, field.field_type
+        columns.append('"{}" {}'.format(
+            name, COLUMN_TYPES[field_type.upper()]))
+    return ', '.join(columns)
+
+
+def _value_type(values):
+    for value in values:
+        if isinstance(value, bool):
+            return 'BOOLEAN'
+        if isinstance(value, int):
+            return 'INTEGER'
+        if isinstance(value, float):
+            return 'REAL'
+        if value is not None:
+            return 'TEXT'
+    return 'TEXT'
+
+
+class QueryResults(object):
+    """Mimics the `rows` and `schema` of a BigQuery query.
+    """
+    class Field(object):
+        def __init__(self, name):
+            self.name = name
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.schema = [self.Field(d[0]) for d in cursor.description]
+
+
+class Client(object):
+    def __init__(self, dataset_key=None, path=':memory:', storage_root='.'):
+        """`path` is the SQLite database to use, and `storage_root` the
+        directory which stands in for the storage bucket.
+        """
+        self.project_name = PROJECT
+        self.dataset_key = dataset_key
+        self.dataset_name = None if dataset_key is None else DATASET_NAME
+        self.storage_root = storage_root
+        self.conn = connect(path)
+
+    def table_exists(self, table_name):
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,)).fetchone() is not None
+
+    def create_table(self, table_name, schema):
+        if self.table_exists(table_name):
+            raise Conflict("Already Exists: Table {}".format(table_name))
+        with self.conn:
+            self.conn.execute('CREATE TABLE "{}" ({})'.format(
+                table_name, _column_definitions(schema)))
+        return Table(self, table_name)
+
+    def get_table(self, table_name):
+        return Table(self, table_name)
+
+    def get_or_create_table(self, table_name, schema):
+        try:
+            table = self.create_table(table_name, schema)
+        except Conflict:
+            table = self.get_table(table_name)
+        return table
+
+    def create_storage_backed_table(self, table_name, schema, gcs_path,
+                                    compression=None, source_format='CSV'):
+        """Load files from storage into a new table.
+
+        As in BigQuery, `gcs_path` may contain a `*` wildcard, and each
+        line is one row: either fields separated by `þ`, or, with a
+        `source_format` of `NEWLINE_DELIMITED_JSON`, an object with a
+        key for each column.
+        """
+        pattern = glob.escape(os.path.join(self.storage_root, gcs_path))
+        paths = sorted(glob.glob(pattern.replace(glob.escape('*'), '*')))
+        if not paths:
+            raise RuntimeError('Could not find blob at {}'.format(gcs_path))
+        opener = gzip.open if compression == 'GZIP' else open
+        table = self.create_table(table_name, schema)
+        placeholders = ', '.join('?' * len(schema))
+        names = [field['name'] for field in schema]
+
+        def parse(line):
+            if source_format == 'NEWLINE_DELIMITED_JSON':
+                record = json.loads(line)
+                return [record.get(name) for name in names]
+            return line.rstrip('\n').split('þ', len(schema) - 1)
+
+        for path in paths:
+            with opener(path, 'rt') as f, self.conn:
+                self.conn.executemany(
+                    'INSERT INTO "{}" VALUES ({})'.format(
+                        table_name, placeholders),
+                    (parse(line) for line in f))
+        return table
+
+    def create_table_from_query(self, table_name, sql, cluster_by=None,
+                                substitutions=None):
+        """Replace `table_name` with the results of `sql`.  SQLite has no
+        clustering, so the `cluster_by` columns are indexed instead.
+        """
+        substitutions = substitutions or {}
+        sql = translate_sql(interpolate_sql(sql, **substitutions))
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS "{}"'.format(table_name))
+            self.conn.execute(
+                'CREATE TABLE "{}" AS {}'.format(table_name, sql))
+            if cluster_by:
+                self.conn.execute(
+                    'CREATE INDEX "{0}_cluster" ON "{0}" ({1})'.format(
+                        table_name,
+                        ', '.join('"{}"'.format(c) for c in cluster_by)))
+        return self.get_table(table_name)
+
+    def query(self, sql, legacy=False, **options):
+        sql = translate_sql(interpolate_sql(sql))
+        return QueryResults(self.conn.execute(sql))
+
+
+class Table(object):
+    def __init__(self, client, name):
+        self.client = client
+        self.conn = client.conn
+        self.project_name = client.project_name
+        self.name = name
+        self.dataset_name = client.dataset_name
+
+    @property
+    def qualified_name(self):
+        return '{}.{}'.format(self.dataset_name, self.name)
+
+    def _check_exists(self):
+        if not self.client.table_exists(self.name):
+            raise NotFound("Not found: Table {}".format(self.name))
+
+    def get_rows(self):
+        self._check_exists()
+        return self.conn.execute('SELECT * FROM "{}"'.format(self.name))
+
+    def get_rows_as_dicts(self):
+        rows = self.get_rows()
+        field_names = [d[0] for d in rows.description]
+        for row in rows:
+            yield row_to_dict(row, field_names)
+
+    def insert_rows_from_query(self, sql, substitutions=None, legacy=False,
+                               **options):
+        substitutions = substitutions or {}
+        sql = translate_sql(interpolate_sql(sql, **substitutions))
+        cursor = self.conn.execute(sql)
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        write_disposition = options.get('write_disposition', 'WRITE_TRUNCATE')
+        with self.conn:
+            if write_disposition == 'WRITE_TRUNCATE':
+                self.conn.execute('DROP TABLE IF EXISTS "{}"'.format(self.name))
+            self.conn.execute('CREATE TABLE IF NOT EXISTS "{}" ({})'.format(
+                self.name,
+                ', '.join('"{}" {}'.format(c, _value_type(r[i] for r in rows))
+                          for i, c in enumerate(columns))))
+            self.conn.executemany(
+                'INSERT INTO "{}" VALUES ({})'.format(
+                    self.name, ', '.join('?' * len(columns))),
+                rows)
+
+    def insert_rows_from_csv(self, csv_path, **options):
+        self._check_exists()
+        skip_leading_rows = options.get('skip_leading_rows', 0)
+        with open(csv_path) as f, self.conn:
+            if options.get('write_disposition', 'WRITE_TRUNCATE') == \
+               'WRITE_TRUNCATE':
+                self.conn.execute('DELETE FROM "{}"'.format(self.name))
+            reader = csv.reader(f)
+            for _ in range(skip_leading_rows):
+                next(reader, None)
+            for row in reader:
+                self.conn.execute(
+                    'INSERT INTO "{}" VALUES ({})'.format(
+                        self.name, ', '.join('?' * len(row))),
+                    [_csv_to_value(value) for value in row])
+
+    def delete_all_rows(self, **options):
+        self._check_exists()
+        with self.conn:
+            self.conn.execute('DELETE FROM "{}"'.format(self.name))
+
+    def delete(self):
+        self._check_exists()
+        with self.conn:
+            self.conn.execute('DROP TABLE "{}"'.format(self.name))
+
+    def exporter(self, storage_prefix):
+        return TableExporter(self, storage_prefix)
+
+
+def _csv_to_value(value):
+    if value == '':
+        return None
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return value
+
+
+def _value_to_csv(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+class TableExporter(object):
+    def __init__(self, table, storage_prefix):
+        self.table = table
+        self.storage_prefix = storage_prefix
+        self.storage_root = table.client.storage_root
+
+    def export_to_storage(self, **options):
+        """Write the table as a single gzipped CSV, named as BigQuery
+        would name the first shard of a wildcard export.
+        """
+        path = os.path.join(
+            self.storage_root, self.storage_prefix + '000000000000.csv.gz')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        rows = self.table.get_rows()
+        with gzip.open(path, 'wt', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow([d[0] for d in rows.description])
+            for row in rows:
+                writer.writerow([_value_to_csv(value) for value in row])
+
+    def storage_blobs(self):
+        return sorted(glob.glob(
+            glob.escape(os.path.join(self.storage_root, self.storage_prefix))
+            + '*'))
+
+    def download_from_storage_and_unzip(self, f_out):
+        for i, path in enumerate(self.storage_blobs()):
+            with gzip.open(path, 'rt', newline='') as f_in:
+                if i > 0:
+                    # Every shard has a header
+                    f_in.readline()
+                for line in f_in:
+                    f_out.write(line)
+
+    def delete_from_storage(self):
+        for path in self.storage_blobs():
+            os.remove(path)